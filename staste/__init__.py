@@ -1,11 +1,14 @@
 from django.conf import settings
-from redis import StrictRedis
 
-redis = StrictRedis(**getattr(settings, 'STASTE_REDIS_CONNECTION', {}))
+from staste.connections import connections, LazyClient
+from staste.batching import batch
+
+# the 'default' client (see staste.connections), connected when it's used for the first time
+redis = LazyClient(connections)
 
 if not getattr(settings, 'STASTE_METRICS_PREFIX', None):
     settings.STASTE_METRICS_PREFIX = 'staste'
 
 key_naming = getattr(settings, 'STASTE_KEY_NAMING', {})
 ALL = key_naming.get('all', '__all__')
-CHOICES = key_naming.get('choices', '__choices__')
\ No newline at end of file
+CHOICES = key_naming.get('choices', '__choices__')
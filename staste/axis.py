@@ -1,7 +1,13 @@
-from staste import redis, ALL
+import time
+
+from staste import ALL
+from staste.connections import get_redis
 
 
 class Axis(object):
+    top = None  # how many heaviest values to keep in sorted sets, see StoredChoiceAxis
+    max_choices = None  # how many recently kicked values to keep as choices, see StoredChoiceAxis
+
     def __init__(self, choices=None, value_type=str):
         self.choices = choices
         self.store_choice = self.choices is None  # Need store choices in Redis
@@ -27,8 +33,32 @@ class Axis(object):
 
         return self.value_to_string(value)
 
-    def get_choices(self, key, **kwargs):
-        return map(self.value_from_string, self.choices or redis.smembers(key))
+    def get_choices(self, key, client=None, **kwargs):
+        """client - a Redis client choices are stored in, the default one if None"""
+        if self.choices:
+            return map(self.value_from_string, self.choices)
+
+        return map(self.value_from_string, (client or get_redis()).smembers(key))
+
+    def get_choice_pages(self, key, page_size=1000, client=None, **kwargs):
+        """
+        Yields lists of choices, reading stored ones with SSCAN, page_size (a hint for Redis) at once.
+        A stored choice can be (rarely) yielded twice, if the set grows meanwhile
+        """
+        if self.choices:
+            for n in xrange(0, len(self.choices), page_size):
+                yield map(self.value_from_string, self.choices[n:n + page_size])
+            return
+
+        client = client or get_redis()
+        cursor = 0
+        while True:
+            cursor, members = client.sscan(key, cursor, count=page_size)
+            if members:
+                yield map(self.value_from_string, members)
+
+            if not cursor:
+                break
 
     def choices_from_value(self, value):
         if value is not None:
@@ -36,9 +66,56 @@ class Axis(object):
         else:
             return []
 
+    def choice_from_field_id(self, field_id, choices_filter=None):
+        """
+        Decodes a choice from its (encoded) field id part.
+        Returns None if it's not a choice get_choices() would return
+        """
+        if field_id == ALL:
+            return None
+
+        return self.value_from_string(field_id)
+
 
 class StoredChoiceAxis(Axis):
-    pass
+    def __init__(self, value_type=str, top=None, max_choices=None):
+        """
+        top - also keep up to that many heaviest values of every timespan in a sorted set,
+        so MetricaValues.iterate_top() does not read all the choices. Good for URLs, users and such
+        max_choices - keep only that many most recently kicked values as choices
+        (in a sorted set scored by the time of the last kick, not in a set growing forever).
+        Choices of a timespan are then only values kicked since it's started
+        """
+        super(StoredChoiceAxis, self).__init__(value_type=value_type)
+        self.top = top
+        self.max_choices = max_choices
+
+    def get_choices(self, key, since=None, client=None, **kwargs):
+        """since - only values kicked since then, if choices are bounded"""
+        if not self.max_choices:
+            return super(StoredChoiceAxis, self).get_choices(key, client=client, **kwargs)
+
+        min_score = time.mktime(since.timetuple()) if since is not None else '-inf'
+        return map(self.value_from_string, (client or get_redis()).zrangebyscore(key, min_score, '+inf'))
+
+    def get_choice_pages(self, key, page_size=1000, since=None, client=None, **kwargs):
+        if not self.max_choices:
+            for page in super(StoredChoiceAxis, self).get_choice_pages(key, page_size, client=client, **kwargs):
+                yield page
+            return
+
+        client = client or get_redis()
+        min_score = time.mktime(since.timetuple()) if since is not None else None
+        cursor = 0
+        while True:
+            cursor, members = client.zscan(key, cursor, count=page_size)
+            page = [self.value_from_string(member) for member, score in members
+                    if min_score is None or score >= min_score]
+            if page:
+                yield page
+
+            if not cursor:
+                break
 
 
 class HierarchicalAxis(Axis):
@@ -100,13 +177,20 @@ class HierarchicalAxis(Axis):
 
         return parts
 
-    def get_choices(self, key, choices_filter=None):
+    def get_choices(self, key, choices_filter=None, **kwargs):
         if choices_filter:
             key = u"{}:{}".format(key, self.value_to_string(choices_filter))
-            choices = super(HierarchicalAxis, self).get_choices(key)
+            choices = super(HierarchicalAxis, self).get_choices(key, **kwargs)
             return [choices_filter + (choice[0],) for choice in choices]
         else:
-            return super(HierarchicalAxis, self).get_choices(key)
+            return super(HierarchicalAxis, self).get_choices(key, **kwargs)
+
+    def get_choice_pages(self, key, page_size=1000, choices_filter=None, **kwargs):
+        if choices_filter:
+            key = u"{}:{}".format(key, self.value_to_string(choices_filter))
+
+        for page in super(HierarchicalAxis, self).get_choice_pages(key, page_size, **kwargs):
+            yield [choices_filter + (choice[0],) for choice in page] if choices_filter else page
 
     def choices_from_value(self, value):
         if value is not None:
@@ -115,4 +199,21 @@ class HierarchicalAxis(Axis):
                 for n in range(len(value))
             ]
 
-        return super(HierarchicalAxis, self).choices_from_value(value)
\ No newline at end of file
+        return super(HierarchicalAxis, self).choices_from_value(value)
+
+    def choice_from_field_id(self, field_id, choices_filter=None):
+        """Only direct children of choices_filter (or top level paths) are choices"""
+        if field_id == ALL:
+            return None
+
+        path = unicode(field_id, 'utf-8')
+        prefix = self.value_to_string(choices_filter) + u'/' if choices_filter else u''
+
+        if not path.startswith(prefix):
+            return None
+
+        child = path[len(prefix):]
+        if not child or u'/' in child:
+            return None
+
+        return choices_filter + (child,) if choices_filter else (child,)
\ No newline at end of file
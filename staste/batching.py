@@ -0,0 +1,103 @@
+"""
+Kicks of several metricas in one round-trip.
+
+Every kick() sends its own pipeline, so a request kicking 5 metricas waits for Redis 5 times.
+Within a batch, kicks are queued into one pipeline (for each Redis client, see staste.connections),
+which is sent when the batch is over:
+
+    with staste.batch():
+        pageviews_metrica.kick(page=request.path)
+        response_time_metrica.kick(value=elapsed)
+        signups_metrica.kick(plan='free')
+
+Batches are per thread, a batch within a batch is a part of the outer one.
+Kicks are sent even if the block raises an exception (then an error of sending them
+is logged, and the exception of the block is raised). Metricas with a buffer
+(see staste.buffer) are buffered as usual.
+"""
+import logging
+import threading
+
+from staste.connections import connections
+from staste.scripts import execute
+
+_local = threading.local()
+logger = logging.getLogger(__name__)
+
+
+def batch():
+    """A context manager sending kicks within it in one pipeline, see KickBatch"""
+    return KickBatch()
+
+
+def current_batch():
+    """The batch of the thread, None if kicks are sent right away"""
+    stack = getattr(_local, 'batches', None)
+    return stack[0] if stack else None
+
+
+class KickBatch(object):
+    def __init__(self):
+        self._pipelines = {}
+
+    def __enter__(self):
+        if not hasattr(_local, 'batches'):
+            _local.batches = []
+
+        _local.batches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.batches.pop()
+
+        if _local.batches:
+            # nested, kicks are in the outer batch
+            return False
+
+        try:
+            self.execute()
+        except Exception:
+            # an exception of the block is more interesting than the one of sending its kicks,
+            # which is logged not to be lost
+            if exc_type is None:
+                raise
+            logger.exception(u'Kicks of a batch are not sent')
+
+        return False
+
+    def pipeline(self, using):
+        """A pipeline of a Redis client, which is executed when the batch is over"""
+        if using not in self._pipelines:
+            self._pipelines[using] = BatchPipeline(connections.get(using).pipeline(transaction=False))
+
+        return self._pipelines[using]
+
+    def execute(self):
+        """Sends kicks queued so far"""
+        pipelines, self._pipelines = self._pipelines, {}
+        error = None
+
+        for pipeline in pipelines.itervalues():
+            try:
+                execute(pipeline.pipeline)
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+
+
+class BatchPipeline(object):
+    """Looks like a pipeline to Metrica.kick(), but execute() is left to the batch"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def execute(self):
+        pass
+
+    def __getattr__(self, attr):
+        return getattr(self.pipeline, attr)
+
+    def __len__(self):
+        return len(self.pipeline)
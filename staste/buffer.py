@@ -0,0 +1,267 @@
+"""
+In-process kick aggregation.
+
+KickAggregator and KickBuffer look like a Redis pipeline to Metrica.kick(),
+but instead of sending commands they coalesce them: increments of the same
+(hash key, field) or (top sorted set key, member) are summed, and choices sets are merged
+(bounded choices keep the latest score of a member).
+
+KickAggregator is flushed explicitly (see Metrica.kick_many()).
+KickBuffer is thread-safe and flushes itself as one pipeline every
+`max_delay` seconds or `max_events` kicks (and on process exit).
+
+Example:
+    buffer = KickBuffer(max_delay=0.5, max_events=5000)
+    metrica = Metrica(name='hot_stuff', axes=[...], buffer=buffer)
+
+Counters are eventually consistent: a kick is visible after the next flush,
+and kicks buffered in a process which gets killed are lost.
+"""
+import os
+import time
+import atexit
+import threading
+from collections import defaultdict
+
+from staste.connections import get_redis, DEFAULT_ALIAS
+from staste.scripts import top_script, execute
+
+
+class KickAggregator(object):
+    def __init__(self, using=DEFAULT_ALIAS):
+        """using - an alias of the Redis client to send everything to (see staste.connections)"""
+        self.using = using
+        self._reset()
+
+    def _reset(self):
+        self._increments = defaultdict(int)
+        self._expirations = {}
+        self._members = defaultdict(set)
+        self._uids = defaultdict(set)
+        self._scores = defaultdict(int)
+        self._tops = {}
+        self._recent = defaultdict(dict)
+        self._trims = {}
+        self._events = 0
+
+    def _state(self):
+        return (self._increments, self._expirations, self._members, self._uids, self._scores, self._tops,
+                self._recent, self._trims)
+
+    def hincrby(self, key, field, value):
+        self._increments[(key, field)] += value
+
+    def expire(self, key, seconds):
+        self._expirations[key] = seconds
+
+    def sadd(self, key, *values):
+        self._members[key].update(values)
+
+    def pfadd(self, key, *values):
+        self._uids[key].update(values)
+
+    def zadd(self, key, score, member):
+        self._recent[key][member] = max(score, self._recent[key].get(member, score))
+
+    def zremrangebyrank(self, key, start, end):
+        self._trims[key] = (start, end)
+
+    def top_increment(self, key, member, amount, top, expiration):
+        """Bumps a member of a top sorted set, see staste.scripts.TOP_LUA"""
+        self._scores[(key, member)] += amount
+        self._tops[key] = (top, expiration)
+
+    def execute(self):
+        self._events += 1
+
+    def flush(self, pipeline_size=None):
+        """
+        Sends everything aggregated to Redis.
+        pipeline_size - max commands per pipeline, everything goes in one pipeline if None
+        """
+        state = self._state()
+        self._reset()
+        self._write(state, pipeline_size)
+
+    def _write(self, state, pipeline_size=None):
+        increments, expirations, members, uids, scores, tops, recent, trims = state
+        pipe = get_redis(self.using).pipeline(transaction=False)
+        queued = 0
+
+        def commands():
+            for (key, field), value in increments.iteritems():
+                yield pipe.hincrby, (key, field, value)
+
+            for (key, member), value in scores.iteritems():
+                top, expiration = tops[key]
+                yield top_script, ([key], [member, value, top, expiration], pipe)
+
+            for key, values in uids.iteritems():
+                values = list(values)
+                step = pipeline_size or len(values) or 1
+                for n in xrange(0, len(values), step):
+                    yield pipe.pfadd, [key] + values[n:n + step]
+
+            # a key should exist before we set its expiration
+            for key, seconds in expirations.iteritems():
+                yield pipe.expire, (key, seconds)
+
+            for key, values in members.iteritems():
+                values = list(values)
+                step = pipeline_size or len(values) or 1
+                for n in xrange(0, len(values), step):
+                    yield pipe.sadd, [key] + values[n:n + step]
+
+            for key, member_scores in recent.iteritems():
+                pairs = [arg for member, score in member_scores.iteritems() for arg in (score, member)]
+                step = 2 * (pipeline_size or len(member_scores))
+                for n in xrange(0, len(pairs), step):
+                    yield pipe.zadd, [key] + pairs[n:n + step]
+
+            # sorted sets are trimmed once all the members are there
+            for key, (start, end) in trims.iteritems():
+                yield pipe.zremrangebyrank, (key, start, end)
+
+        for command, args in commands():
+            command(*args)
+            queued += 1
+
+            if pipeline_size and queued >= pipeline_size:
+                execute(pipe)
+                queued = 0
+
+        if queued:
+            execute(pipe)
+
+    def _merge(self, state):
+        increments, expirations, members, uids, scores, tops, recent, trims = state
+
+        for (key, field), value in increments.iteritems():
+            self._increments[(key, field)] += value
+
+        self._expirations.update(expirations)
+
+        for key, values in members.iteritems():
+            self._members[key].update(values)
+
+        for key, values in uids.iteritems():
+            self._uids[key].update(values)
+
+        for (key, member), value in scores.iteritems():
+            self._scores[(key, member)] += value
+
+        self._tops.update(tops)
+
+        for key, member_scores in recent.iteritems():
+            for member, score in member_scores.iteritems():
+                self.zadd(key, score, member)
+
+        self._trims.update(trims)
+
+
+class BufferPipeline(KickAggregator):
+    """Collects commands of a single kick, merged into the buffer on execute()"""
+
+    def __init__(self, buffer, using=DEFAULT_ALIAS):
+        super(BufferPipeline, self).__init__(using)
+        self.buffer = buffer
+
+    def execute(self):
+        self.buffer.add(self._state(), self.using)
+
+
+class KickBuffer(object):
+    def __init__(self, max_delay=1.0, max_events=1000):
+        """
+        max_delay - flush at least every max_delay seconds (a background thread does it)
+        max_events - flush right away when that many kicks are buffered
+
+        Kicks of metricas kept in different Redis instances are buffered separately
+        """
+        self.max_delay = max_delay
+        self.max_events = max_events
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._reset()
+
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._aggregators = {}  # Redis client alias => KickAggregator
+        self._events = 0
+
+    def pipeline(self, transaction=False, using=DEFAULT_ALIAS):
+        return BufferPipeline(self, using)
+
+    def add(self, state, using=DEFAULT_ALIAS):
+        self._ensure_flusher()
+
+        with self._lock:
+            self._aggregator(using)._merge(state)
+            self._events += 1
+            full = self._events >= self.max_events
+
+        if full:
+            self.flush()
+
+    def flush(self, pipeline_size=None):
+        """Sends everything buffered to Redis, one pipeline per Redis instance"""
+        with self._lock:
+            aggregators = self._aggregators
+            self._reset()
+
+        error = None
+        for using, aggregator in aggregators.iteritems():
+            state = aggregator._state()
+            if not any(state):
+                continue
+
+            try:
+                aggregator._write(state, pipeline_size)
+            except Exception as e:
+                # put it back, so it's sent with the next flush
+                with self._lock:
+                    self._aggregator(using)._merge(state)
+                error = e
+
+        if error is not None:
+            raise error
+
+    def _aggregator(self, using):
+        if using not in self._aggregators:
+            self._aggregators[using] = KickAggregator(using)
+
+        return self._aggregators[using]
+
+    def _ensure_flusher(self):
+        # threads do not survive fork(), so prefork servers need a flusher per process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        if self._pid is not None and self._pid != os.getpid():
+            # a forked child: whatever is buffered will be flushed by the parent
+            self._lock = threading.Lock()
+            self._reset()
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='staste-kick-buffer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.max_delay)
+            try:
+                self.flush()
+            except Exception:
+                pass  # will retry on the next tick
+
+
+# Process-wide buffer you can share between metricas
+kick_buffer = KickBuffer()
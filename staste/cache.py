@@ -0,0 +1,107 @@
+"""
+Read-through cache of values read by MetricaValues.
+
+Values are cached per (hash key, field). Once a timespan is over (last year,
+last month, an hour ago) its counters can't change, so they are cached for a long
+time; values of timespans which are not over yet are cached for a few seconds.
+
+Example:
+    metrica = Metrica(name='guest_visits', axes=[...], cache=ResultCache(open_timeout=5))
+    # or share results between processes with a Django cache
+    metrica = Metrica(name='guest_visits', axes=[...], cache=ResultCache(backend='default'))
+
+Keep in mind that kicks with dates in the past (e.g. backfills with
+Metrica.kick_many()) are not seen until cached values are gone.
+"""
+import time
+import hashlib
+import datetime
+
+from staste.utils import LRUCache
+
+
+class ResultCache(object):
+    def __init__(self, backend=None, open_timeout=10, closed_timeout=None, maxsize=10000):
+        """
+        backend - a Django cache alias (like 'default') to share values between processes.
+        If None, values are cached in an in-process LRU of maxsize values
+        open_timeout - seconds to cache values of timespans which are not over yet. 0 to not cache them
+        closed_timeout - seconds to cache values of timespans which are over.
+        None is forever (for Django caches it's 30 days)
+        """
+        self.open_timeout = open_timeout
+        self.closed_timeout = closed_timeout
+
+        if backend is not None:
+            from django.core.cache import get_cache
+            self.backend = get_cache(backend)
+            self.lru = None
+        else:
+            self.backend = None
+            self.lru = LRUCache(maxsize)
+
+    def get_rows(self, requests, rows):
+        """
+        Fills rows with cached values.
+        requests - a list of (hash_key, tp_id, [field, ...]), rows - lists of values for them
+        """
+        keys = {}
+
+        for n, (hash_key, tp_id, fields) in enumerate(requests):
+            for i, field in enumerate(fields):
+                keys[self._key(hash_key, field)] = (n, i)
+
+        for key, value in self.get_many(keys.keys()).iteritems():
+            n, i = keys[key]
+            rows[n][i] = value
+
+    def set_rows(self, requests, rows, fetched, date_axis):
+        """
+        Caches values read from Redis.
+        fetched - a list of (n, [i, ...]): rows[n][i] are read from Redis
+        """
+        now = datetime.datetime.now()
+        closed = {}
+
+        for n, indexes in fetched:
+            hash_key, tp_id, fields = requests[n]
+
+            if tp_id not in closed:
+                closed[tp_id] = date_axis.is_closed(tp_id, now)
+
+            timeout = self.closed_timeout if closed[tp_id] else self.open_timeout
+            if timeout == 0:
+                continue
+
+            for i in indexes:
+                self.set(self._key(hash_key, fields[i]), rows[n][i], timeout)
+
+    def get_many(self, keys):
+        if self.backend is not None:
+            return self.backend.get_many(keys)
+
+        values = {}
+        now = time.time()
+
+        for key in keys:
+            cached = self.lru.get(key)
+
+            if cached is not None and (cached[1] is None or cached[1] > now):
+                values[key] = cached[0]
+
+        return values
+
+    def set(self, key, value, timeout):
+        if self.backend is not None:
+            self.backend.set(key, value, timeout if timeout is not None else 30 * 24 * 60 * 60)
+        else:
+            self.lru.set(key, (value, time.time() + timeout if timeout is not None else None))
+
+    def clear(self):
+        """Forgets in-process values. Django cache values are left alone: the cache can be shared"""
+        if self.lru is not None:
+            self.lru.clear()
+
+    def _key(self, hash_key, field):
+        # safe for memcached: short and without spaces
+        return 'staste:%s' % hashlib.md5((u'%s\n%s' % (hash_key, field)).encode('utf-8')).hexdigest()
@@ -28,9 +28,16 @@ class Chart(TemplateView):
 class PieChart(Chart):
     template_name = 'staste/charts/pie.html'
     axis_keyword = None
+    iterate_all = False  # one HGETALL instead of reading stored choices, for high-cardinality axes
+    top = None  # show only that many greatest values, the axis should keep its top (see StoredChoiceAxis)
 
     def get_context_data(self):
-        values = self.get_metrica_values().iterate(self.axis_keyword)
+        if self.top:
+            values = self.get_metrica_values().iterate_top(self.axis_keyword, self.top)
+        elif self.iterate_all:
+            values = self.get_metrica_values().iterate_all(self.axis_keyword)
+        else:
+            values = self.get_metrica_values().iterate(self.axis_keyword)
 
         return {
             'name': self.axis_keyword,
@@ -148,13 +155,18 @@ class TimeserieChart(Chart):
             'scale': self.timescale,
         }
 
-        values = {}
+        choices = list(self.metrica.choices(axis_displayed))
 
         if not self.request.GET.get('hide_total', False):
-            values['total'] = self.get_metrica_values().timeserie(**timeserie_params)
+            choices.insert(0, None)  # the total
+
+        points, choices, columns = self.get_metrica_values().timeserie_by(axis_displayed, choices=choices,
+                                                                          **timeserie_params)
+
+        values = {}
 
-        for item in self.metrica.choices(axis_displayed):
-            values[item] = self.get_metrica_values().filter(**{axis_displayed: item}).timeserie(**timeserie_params)
+        for item, column in zip(choices, columns):
+            values['total' if item is None else item] = zip(points, column)
 
         return values
 
@@ -0,0 +1,184 @@
+"""
+Compaction of date scales which are not stored by Metrica.kick() (see Metrica stored_scales).
+
+Once a timespan is over (an hour, a day), its finer hashes are summed up to the hash
+of its own scale, so they can expire without losing anything: when the hash exists,
+it is read instead of summing up finer ones. Scales are compacted from the finest,
+so e.g. months are made of compacted days, and years of compacted months.
+
+Each run starts where the previous one has stopped (it's stored in a
+"<prefix>:<name>:__compacted__" hash), so it's fine to run it every few minutes:
+
+    ./manage.py staste_compact
+
+or from your code:
+
+    from staste.compaction import compact_all
+    compact_all()
+"""
+import datetime
+from collections import defaultdict
+
+from staste.dateaxis import DATE_SCALES_AND_EXPIRATIONS, DATE_SCALES_SCALE
+from staste.metrica import registry
+
+HIGH_WATER_MARK_FORMAT = '%Y-%m-%dT%H:%M'
+
+
+def compact_all(now=None, delay=60, pipeline_size=1000):
+    """Compacts all metricas created so far. Returns {name: number of hashes made}"""
+    return dict((name, compact(metrica, now, delay, pipeline_size))
+                for name, metrica in registry.items())
+
+
+def compact(metrica, now=None, delay=60, pipeline_size=1000):
+    """
+    Makes hashes of timespans which are over, for all date scales metrica does not store.
+
+    now - compact timespans which were over `delay` seconds before that. default: now
+    delay - late kicks can come in a few seconds after a timespan is over, we don't want to lose them
+    pipeline_size - max commands sent in one pipeline
+
+    Returns a number of hashes made
+    """
+    if metrica.stored_scales is None:
+        return 0
+
+    until = (now or datetime.datetime.now()) - datetime.timedelta(seconds=delay)
+    scales = [scale for scale, _ in DATE_SCALES_AND_EXPIRATIONS if scale in metrica.date_scales]
+    expirations = dict(metrica.date_axis.scales_and_expirations)
+    marks_key = u'%s:__compacted__' % metrica.key_prefix()
+    redis = metrica.redis
+    marks = redis.hgetall(marks_key)
+    made = 0
+
+    # finest first, so coarser scales are made of compacted ones
+    for n in reversed(xrange(len(scales) - 1)):
+        scale, finer = scales[n], scales[n + 1]
+
+        if scale in metrica.stored_scales:
+            continue
+
+        if scale in marks:
+            start = _bucket_end(metrica, scale, datetime.datetime.strptime(marks[scale], HIGH_WATER_MARK_FORMAT))
+        else:
+            # the first full timespan we still have finer hashes for
+            start = _bucket_end(metrica, scale, until - datetime.timedelta(seconds=expirations[finer]))
+
+        while True:
+            end = _bucket_end(metrica, scale, start)
+            if end > until:
+                break
+
+            made += _compact_bucket(metrica, scale, finer, start, expirations[scale], pipeline_size)
+            redis.hset(marks_key, scale, start.strftime(HIGH_WATER_MARK_FORMAT))
+            start = end
+
+    return made
+
+
+def _bucket_end(metrica, scale, date):
+    """The moment the timespan of a scale which date is in is over"""
+    timespan = dict((s, getattr(date, s)) for s, _ in DATE_SCALES_AND_EXPIRATIONS[:_scale_n(scale) + 1])
+    return metrica.date_axis.timespan_end(**timespan)
+
+
+def _scale_n(scale):
+    return [s for s, _ in DATE_SCALES_AND_EXPIRATIONS].index(scale)
+
+
+def _compact_bucket(metrica, scale, finer, start, expiration, pipeline_size):
+    redis = metrica.redis
+    layout = metrica.layout
+    date_axis = metrica.date_axis
+    prefix = metrica.key_prefix()
+    tp_id = date_axis.datetime_to_id(scale, DATE_SCALES_SCALE[scale](start))
+    finer_ids = date_axis.finer_ids(tp_id, finer)
+    made = 0
+
+    for postfix in metrica.hash_key_postfixes:
+        hash_key = u'%s:%s%s' % (prefix, tp_id, postfix)
+
+        finer_keys = [u'%s:%s%s' % (prefix, finer_id, postfix) for finer_id in finer_ids]
+
+        pipe = redis.pipeline(transaction=False)
+        collects = [layout.hgetall(pipe, finer_key) for finer_key in finer_keys]
+        results = iter(pipe.execute())
+
+        sums = defaultdict(int)
+        for collect in collects:
+            for field, value in collect(results).iteritems():
+                sums[field] += int(value)
+
+        if not sums:
+            continue
+
+        # a hash is read instead of finer ones as soon as it exists, so it's made aside
+        # (in every key of it, see staste.layout)
+        located = defaultdict(dict)
+        for field, value in sums.iteritems():
+            key, key_field = layout.locate(hash_key, field)
+            located[key][key_field] = value
+
+        pipe = redis.pipeline(transaction=False)
+        n = 0
+        for key, fields in located.iteritems():
+            tmp_key = u'%s:__compacting__' % key
+            pipe.delete(tmp_key)
+
+            for field, value in fields.iteritems():
+                pipe.hincrby(tmp_key, field, value)
+                n += 1
+                if n % pipeline_size == 0:
+                    pipe.execute()
+
+            if expiration:
+                pipe.expire(tmp_key, expiration)
+            pipe.rename(tmp_key, key)
+
+        if metrica.counts_uniques and not postfix:
+            # HyperLogLogs are not summed up, but merged
+            for n, field in enumerate(sums, 1):
+                uniques_key = metrica.uniques_key(hash_key, field)
+                tmp_key = u'%s:__compacting__' % uniques_key
+
+                finer_uniques_keys = [metrica.uniques_key(finer_key, field) for finer_key in finer_keys]
+                if getattr(redis, 'sharded', False):
+                    # finer HyperLogLogs are on other nodes, ShardedRedis merges them right away
+                    redis.pfmerge(tmp_key, *finer_uniques_keys)
+                else:
+                    pipe.pfmerge(tmp_key, *finer_uniques_keys)
+                if expiration:
+                    pipe.expire(tmp_key, expiration)
+                pipe.rename(tmp_key, uniques_key)
+
+                if n % pipeline_size == 0:
+                    pipe.execute()
+
+        pipe.execute()
+
+        if not postfix:
+            for axis_n, axis_kw, top in metrica.top_axes:
+                _compact_top(metrica, hash_key, finer_keys, axis_kw, top, expiration)
+
+        made += 1
+
+    return made
+
+
+def _compact_top(metrica, hash_key, finer_keys, axis_kw, top, expiration):
+    """Top values are summed up and trimmed to the top again"""
+    redis = metrica.redis
+    top_key = metrica.top_key(hash_key, axis_kw)
+    tmp_key = u'%s:__compacting__' % top_key
+
+    # no sorted set is made if no kick had a value of the axis
+    if not redis.zunionstore(tmp_key, [metrica.top_key(finer_key, axis_kw) for finer_key in finer_keys]):
+        return
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.zremrangebyrank(tmp_key, 0, -top - 1)
+    if expiration:
+        pipe.expire(tmp_key, expiration)
+    pipe.rename(tmp_key, top_key)
+    pipe.execute()
@@ -0,0 +1,98 @@
+"""
+Redis clients used by staste, by alias.
+
+Clients are created when they are asked for the first time, so importing staste does
+not connect anywhere. Every client has its own connection pool:
+
+    STASTE_REDIS_CONNECTIONS = {
+        'default': {'host': 'localhost', 'max_connections': 50},
+        'analytics': {'unix_socket_path': '/var/run/redis/analytics.sock', 'max_connections': 10},
+        'cold': {'url': 'redis://cold.example.com:6379/2'},
+    }
+
+    metrica = Metrica(name='hot_stuff', axes=[...], using='analytics')
+
+Without STASTE_REDIS_CONNECTIONS, the 'default' client is made of STASTE_REDIS_CONNECTION.
+A client with 'shards' spreads metricas across several Redis nodes, see staste.sharding.
+Clients made by your code can be plugged in too: connections.register('analytics', client)
+"""
+import threading
+
+from django.conf import settings
+from redis import StrictRedis
+
+DEFAULT_ALIAS = 'default'
+
+
+class ConnectionRegistry(object):
+    def __init__(self, configs=None):
+        """
+        configs - {alias: StrictRedis keyword arguments}, 'url' makes a client with StrictRedis.from_url(),
+        'shards' makes a staste.sharding.ShardedRedis
+        """
+        self._configs = dict(configs or {})
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def configure(self, alias, **kwargs):
+        """Sets up (or replaces) a client, which is made when it's asked for"""
+        with self._lock:
+            self._configs[alias] = kwargs
+            self._clients.pop(alias, None)
+
+    def register(self, alias, client):
+        """Plugs in a ready client"""
+        with self._lock:
+            self._configs[alias] = None
+            self._clients[alias] = client
+
+    def get(self, alias=DEFAULT_ALIAS):
+        client = self._clients.get(alias)
+        if client is not None:
+            return client
+
+        with self._lock:
+            if alias not in self._clients:
+                if alias not in self._configs:
+                    raise ValueError(u'Invalid Redis connection: {}, choices are: {}'.format(
+                        alias, self._configs.keys()))
+
+                self._clients[alias] = self._connect(dict(self._configs[alias]))
+
+            return self._clients[alias]
+
+    def aliases(self):
+        return self._configs.keys()
+
+    def _connect(self, config):
+        if 'shards' in config:
+            from staste.sharding import ShardedRedis
+            return ShardedRedis(**config)
+
+        url = config.pop('url', None)
+        if url is not None:
+            return StrictRedis.from_url(url, **config)
+
+        return StrictRedis(**config)
+
+
+class LazyClient(object):
+    """Looks like a client of an alias, which is asked for only when it's used"""
+
+    def __init__(self, registry, alias=DEFAULT_ALIAS):
+        self._registry = registry
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(self._alias), attr)
+
+
+connections = ConnectionRegistry(
+    getattr(settings, 'STASTE_REDIS_CONNECTIONS', None) or
+    {DEFAULT_ALIAS: getattr(settings, 'STASTE_REDIS_CONNECTION', {})}
+)
+
+
+def get_redis(using=DEFAULT_ALIAS):
+    """A Redis client of an alias (see STASTE_REDIS_CONNECTIONS)"""
+    return connections.get(using)
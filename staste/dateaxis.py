@@ -6,13 +6,21 @@ import datetime
 import calendar
 from dateutil import rrule
 from collections import namedtuple
-from staste import redis, ALL
+from staste import ALL
+from staste.utils import LRUCache, duration_to_seconds
 
 
 def days_to_seconds(days):
     """Converts days to seconds. No ".total_seconds()" in 2.6"""
     return days * 24 * 60 * 60
 
+
+def total_seconds(delta):
+    """timedelta.total_seconds(), which is not in 2.6"""
+    return days_to_seconds(delta.days) + delta.seconds + delta.microseconds / 1e6
+
+TIMESERIE_PLANS_CACHE_SIZE = 256
+
 # Please keep in mind that years are special-cased (I got to think about it)
 # cause their range is not hard specified, but stored in Redis instead.
 DATE_SCALES_AND_EXPIRATIONS = [
@@ -40,6 +48,13 @@ DATE_SCALES_RRULE_KWARGS = {
     'minute': {'freq': rrule.MINUTELY}
 }
 
+# scales which are stepped through without calendar logic
+DATE_SCALES_STEPS = {
+    'day': datetime.timedelta(days=1),
+    'hour': datetime.timedelta(hours=1),
+    'minute': datetime.timedelta(minutes=1)
+}
+
 # can be average
 DATE_SCALES_DELTAS = {
     'year': datetime.timedelta(days=365),
@@ -65,39 +80,113 @@ DateScale = namedtuple('DateScale', ['id', 'expiration', 'value', 'store'])
 class DateAxis(object):
     """This is a special-cased axis of DateTime"""
     default_scales = ('year', 'month', 'day', 'hour', 'minute')
+    all_id = ALL  # an id of the whole time
+
+    def __init__(self, retention=None):
+        """
+        retention - how long to keep each scale, overrides DATE_SCALES_AND_EXPIRATIONS.
+        A dict of durations (see staste.utils.duration_to_seconds), e.g. {'minute': '6h', 'hour': '7d'}.
+        0 or None means forever
+        """
+        retention = dict(retention or {})
+
+        for scale in retention:
+            if scale not in DATE_SCALES_DICT:
+                raise ValueError(u'Invalid scale: {}, choices are: {}'.format(scale, DATE_SCALES_DICT.keys()))
+
+        self.scales_and_expirations = [
+            (scale, duration_to_seconds(retention[scale] or 0) if scale in retention else expiration)
+            for scale, expiration in DATE_SCALES_AND_EXPIRATIONS
+        ]
+
+        # (since, until, max_scale, now) => timeserie points, all with a minute precision
+        self.timeserie_plans = LRUCache(TIMESERIE_PLANS_CACHE_SIZE)
     
-    def scales(self, date, allowed_scales=None):
+    def scales(self, date, allowed_scales=None, stored_scales=None):
         """
         Yields DateScale objects for all scales on which the event should be stored
         date_scales: allowed date scales {'hour': False, 'minute': False}
+        stored_scales: if specified, only these of allowed scales are stored,
+        the rest are summed up on reading (see rollup_ids()).
+        A DateScale with id None only tells to store the value
         """
         allowed_scales = allowed_scales or self.default_scales
-        yield DateScale(ALL, 0, '', False)
+        yield DateScale(self.all_id, 0, '', False)
 
-        id_parts = []
-        for scale, scale_expiration in DATE_SCALES_AND_EXPIRATIONS:
+        timespan = {}
+        for scale, scale_expiration in self.scales_and_expirations:
             if scale not in allowed_scales:
                 continue
 
             value = getattr(date, scale)
             
-            id_parts += self._datepart_format(scale, value)
+            timespan[scale] = value
             yield DateScale(
-                ':'.join(id_parts),
+                self._timespan_id(timespan) if stored_scales is None or scale in stored_scales else None,
                 scale_expiration,
                 value,
                 'years' if scale == 'year' else False
             )
 
+    def rollup_ids(self, tp_id, stored_scales):
+        """
+        Returns ids of the next finer scale to sum up values of a timespan which is not stored,
+        or None if it's stored. Finer timespans which are not stored either are summed up the same way,
+        unless they are compacted, so it goes one scale at a time.
+        'year:2011:month:10:day:7:hour:3', ('day', 'minute') => ['year:2011:month:10:day:7:hour:3:minute:0', ...]
+        'year:2011', ('day', 'minute') => ['year:2011:month:1', ...]
+        """
+        if tp_id == self.all_id:
+            return None
+
+        timespan = self.id_to_timespan(tp_id)
+        scales = [scale for scale, _ in DATE_SCALES_AND_EXPIRATIONS]
+        scale = scales[len(timespan) - 1]
+
+        if scale in stored_scales:
+            return None
+
+        if not [s for s in scales[len(timespan):] if s in stored_scales]:
+            raise ValueError(u'No stored scale is finer than {}, stored scales are: {}'.format(scale, stored_scales))
+
+        return self.finer_ids(tp_id, scales[len(timespan)])
+
+    def finer_ids(self, tp_id, finer):
+        """
+        Returns ids of all timespans of a finer scale within a timespan.
+        'year:2011:month:10:day:7', 'hour' => ['year:2011:month:10:day:7:hour:0', ...]
+        """
+        timespan = self.id_to_timespan(tp_id)
+        scales = [scale for scale, _ in DATE_SCALES_AND_EXPIRATIONS]
+
+        timespans = [timespan]
+        for sub_scale in scales[len(timespan):scales.index(finer) + 1]:
+            sub_timespans = []
+            for sub_timespan in timespans:
+                low, high = DATE_SCALES_RANGES[sub_scale](**sub_timespan)
+                sub_timespans.extend(dict(sub_timespan, **{sub_scale: val}) for val in xrange(low, high + 1))
+            timespans = sub_timespans
+
+        return [self._timespan_id(sub_timespan) for sub_timespan in timespans]
+
     def timespan_to_id(self, **timespan):
         """
         Returns an string part of the hash key for a timespan
         A timespan is a dict of date scales
         """
-        if not timespan:
-            return ALL
+        return self._timespan_id(self._checked_timespan(**timespan))
+
+    def datetime_to_id(self, max_scale, dt):
+        """Returns an string part of the hash key for a timespan of a scale which dt is in"""
+        timespan = {}
 
-        return ':'.join(self._timespan_to_id_parts(**timespan))
+        for scale, scale_expiration in DATE_SCALES_AND_EXPIRATIONS:
+            timespan[scale] = getattr(dt, scale)
+
+            if scale == max_scale:
+                return self._timespan_id(timespan)
+
+        raise ValueError('Invalid scale: %s' % max_scale)
 
     def iterate(self, mv):
         """
@@ -107,8 +196,8 @@ class DateAxis(object):
         For example, if MetricaValues is filtered by month (like .timespan(month=2)),
         this will iterate by month days.
         """
-        id_parts = self._timespan_to_id_parts(**mv._timespan)
-        scale_n = len(id_parts) / 2
+        timespan = self._checked_timespan(**mv._timespan)
+        scale_n = len(timespan)
 
         try:
             scale_ = DATE_SCALES_AND_EXPIRATIONS[scale_n]
@@ -118,7 +207,7 @@ class DateAxis(object):
         scale = scale_[0]
 
         for val in self.get_scale_range(scale, mv):
-            yield int(val), ':'.join(id_parts + self._datepart_format(scale, val))
+            yield int(val), self._timespan_id(dict(timespan, **{scale: int(val)}))
 
     def get_scale_range(self, scale, mv):
         """
@@ -128,18 +217,36 @@ class DateAxis(object):
         # okay, it's not very configurable, but I tried
         if scale == 'year':
             set_key = '%s:years' % mv.metrica.key_prefix()
-            return redis.smembers(set_key)
+            return mv.metrica.redis.smembers(set_key)
         
         return xrange(*DATE_SCALES_RANGES[scale](**mv._timespan))
 
-    def timeserie(self, since, until, max_scale=None):
+    def timeserie(self, since, until, max_scale=None, now=None):
         """
-        Returns a list of time points and scales we can have information about
+        Returns a list of time points and scales we can have information about.
+
+        The lists are cached by dates taken with a minute precision, so refreshing
+        a chart does not compute them again within a minute (points are computed
+        from the exact dates of the first call).
+        now - the current time, datetime.now() by default
         """
-        now = datetime.datetime.now()
+        if now is None:
+            now = datetime.datetime.now()
+
+        to_minute = DATE_SCALES_SCALE['minute']
+        key = (to_minute(since), to_minute(until), max_scale, to_minute(now))
+        plan = self.timeserie_plans.get(key)
+
+        if plan is None:
+            plan = tuple(self._timeserie(since, until, max_scale, now))
+            self.timeserie_plans.set(key, plan)
+
+        return plan
+
+    def _timeserie(self, since, until, max_scale, now):
         points = []
         
-        for scale, expiration in reversed(DATE_SCALES_AND_EXPIRATIONS):
+        for scale, expiration in reversed(self.scales_and_expirations):
             if max_scale:
                 if scale == max_scale:
                     max_scale = None
@@ -165,57 +272,181 @@ class DateAxis(object):
                 break
 
         for scale, point in points:
-            yield point, ':'.join(self._datetime_to_id_parts(scale, point))
+            yield point, self.datetime_to_id(scale, point)
 
     def scale_timeserie(self, scale, since, until):
-        rr = rrule.rrule(dtstart=since, until=until, **DATE_SCALES_RRULE_KWARGS[scale])
+        step = DATE_SCALES_STEPS.get(scale)
+
+        if step is None:
+            # months and years are not that regular
+            rr = rrule.rrule(dtstart=since, until=until, **DATE_SCALES_RRULE_KWARGS[scale])
+
+            for point in rr:
+                yield scale, self.scale_point(scale, point)
+            return
+
+        # the same as the rrule above: points since, since + step, ... until, scaled
+        point = self.scale_point(scale, since)
+        steps = int(total_seconds(until - since) // total_seconds(step)) + 1 if until >= since else 0
 
-        for point in rr:
-            yield scale, self.scale_point(scale, point)
+        for n in xrange(steps):
+            yield scale, point
+            point += step
 
     def scale_point(self, scale, point):
         return DATE_SCALES_SCALE[scale](point) + DATE_SCALES_DELTAS[scale] / 2
 
-    def _datetime_to_id_parts(self, max_scale, dt):
-        id_parts = []
-        
-        for scale, scale_expiration in DATE_SCALES_AND_EXPIRATIONS:
-            val = getattr(dt, scale)
-            id_parts += self._datepart_format(scale, val)
+    def id_to_timespan(self, tp_id):
+        """
+        Converts a string part of the hash key back to a timespan
+        'year:2011:month:10' => {'year': 2011, 'month': 10}
+        """
+        if tp_id == self.all_id:
+            return {}
 
-            if scale == max_scale:
-                return id_parts
+        parts = tp_id.split(':')
+        return dict((scale, int(val)) for scale, val in zip(parts[::2], parts[1::2]))
 
-        raise ValueError('Invalid scale: %s' % scale)
-    
-    def _timespan_to_id_parts(self, **timespan):
+    def timespan_start(self, **timespan):
+        """
+        Returns the moment a timespan starts, None for the whole time
+        {'year': 2011, 'month': 10} => datetime(2011, 10, 1)
+        """
+        if not timespan:
+            return None
+
+        return datetime.datetime(timespan['year'], timespan.get('month', 1), timespan.get('day', 1),
+                                 timespan.get('hour', 0), timespan.get('minute', 0))
+
+    def timespan_end(self, **timespan):
+        """
+        Returns the moment a timespan is over, None for the whole time
+        {'year': 2011, 'month': 10} => datetime(2011, 11, 1)
+        """
+        if not timespan:
+            return None
+
+        start = self.timespan_start(**timespan)
+        scale = [scale for scale, _ in DATE_SCALES_AND_EXPIRATIONS if scale in timespan][-1]
+
+        if scale == 'year':
+            return start.replace(year=start.year + 1)
+
+        if scale == 'month':
+            return datetime.datetime(start.year + start.month / 12, start.month % 12 + 1, 1)
+
+        return start + DATE_SCALES_STEPS[scale]
+
+    def is_closed(self, tp_id, now=None):
+        """Whether the timespan is over, so its values can't change anymore"""
+        end = self.timespan_end(**self.id_to_timespan(tp_id))
+        return end is not None and end <= (now or datetime.datetime.now())
+
+    def _checked_timespan(self, **timespan):
         """
-        Converts timespan (a dict of date scales) to a joinable list of id parts.
-        {'year': 2011, 'month': 10} => ['year', '2011', 'month', '10']
+        Checks a timespan (a dict of date scales) has no gaps: {'year': 2011, 'day': 7} is not fine.
+        Returns a copy of it
         """
         
         for k in timespan:
             if k not in DATE_SCALES_DICT:
                 raise TypeError('Invalid date argument: "%s"' % k)
 
-        id_parts = []
+        checked = {}
         for scale, scale_expiration in DATE_SCALES_AND_EXPIRATIONS:
             try:
-                val = timespan.pop(scale)
+                checked[scale] = timespan.pop(scale)
             except KeyError:
                 if timespan:
                     raise TypeError("You should have specified %s" % scale)
 
                 # all kwargs are gone!
                 break
-                
-            id_parts += self._datepart_format(scale, val)
 
-        return id_parts
+        return checked
+
+    def _timespan_id(self, timespan):
+        """
+        Converts timespan (a dict of date scales) to an string part of the hash key.
+        {'year': 2011, 'month': 10} => 'year:2011:month:10'
+        """
+        if not timespan:
+            return self.all_id
+
+        id_parts = []
+        for scale, scale_expiration in DATE_SCALES_AND_EXPIRATIONS:
+            if scale in timespan:
+                id_parts += self._datepart_format(scale, timespan[scale])
+
+        return ':'.join(id_parts)
 
     def _datepart_format(self, scale, val):
         return [scale, str(val)]
-        # return ["{}{}".format(scale, val)]
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+COMPACT_SCALE_LETTERS = {'year': 'y', 'month': 'M', 'day': 'd', 'hour': 'h', 'minute': 'm'}
+COMPACT_LETTER_SCALES = dict((letter, scale) for scale, letter in COMPACT_SCALE_LETTERS.items())
+
+
+class CompactDateAxis(DateAxis):
+    """
+    A DateAxis with short ids: a letter of the finest scale and a number of its timespan
+    (years, months, days, hours or minutes since 1970), see Metrica compact_keys.
+    {'year': 2011, 'month': 10, 'day': 7, 'hour': 3} => 'h366099'
+    Timespans should have no gaps, coarser scales are taken for granted
+    """
+    all_id = '*'
+
+    def _timespan_id(self, timespan):
+        if not timespan:
+            return self.all_id
+
+        if 'month' not in timespan:
+            return 'y%d' % timespan['year']
+
+        if 'day' not in timespan:
+            return 'M%d' % (timespan['year'] * 12 + timespan['month'] - 1)
+
+        days = (datetime.datetime(timespan['year'], timespan['month'], timespan['day']) - EPOCH).days
+
+        if 'hour' not in timespan:
+            return 'd%d' % days
+
+        if 'minute' not in timespan:
+            return 'h%d' % (days * 24 + timespan['hour'])
+
+        return 'm%d' % ((days * 24 + timespan['hour']) * 60 + timespan['minute'])
+
+    def id_to_timespan(self, tp_id):
+        """'M24129' => {'year': 2010, 'month': 10}"""
+        if tp_id == self.all_id:
+            return {}
+
+        scale, n = COMPACT_LETTER_SCALES[tp_id[0]], int(tp_id[1:])
+
+        if scale == 'year':
+            return {'year': n}
+
+        if scale == 'month':
+            return {'year': n // 12, 'month': n % 12 + 1}
+
+        hour = minute = None
+        if scale == 'minute':
+            n, minute = divmod(n, 60)
+        if scale in ('hour', 'minute'):
+            n, hour = divmod(n, 24)
+
+        date = EPOCH + datetime.timedelta(days=n)
+        timespan = {'year': date.year, 'month': date.month, 'day': date.day}
+
+        if hour is not None:
+            timespan['hour'] = hour
+        if minute is not None:
+            timespan['minute'] = minute
+
+        return timespan
 
 # We need only one such Axis object, and it's completely thread-safe
 DATE_AXIS = DateAxis()
\ No newline at end of file
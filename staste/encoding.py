@@ -0,0 +1,270 @@
+"""
+Compact keys and fields of metricas (see Metrica compact_keys).
+
+Hash keys are "<prefix>:h366099" instead of "<prefix>:year:2011:month:10:day:7:hour:3"
+(see staste.dateaxis.CompactDateAxis), and every axis value in hash fields is replaced
+with a small number, so "__all__:/about/:__all__" becomes ":17:". Short fields keep more
+hashes within Redis ziplist/listpack limits (hash-max-ziplist-value), which saves most memory.
+
+Numbers of values are kept in Redis, "<prefix>:__codes__:<axis>" (value => code)
+and "<prefix>:__codes__:<axis>:__values__" (code => value) hashes, and cached by every process.
+Choices sets are not changed.
+
+Values kicked before compact_keys was turned on are moved with
+
+    ./manage.py staste_migrate_keys
+
+or from your code:
+
+    from staste.encoding import migrate
+    migrate(metrica)
+"""
+import re
+
+from redis.exceptions import ResponseError
+
+from staste import ALL
+from staste.dateaxis import DATE_AXIS
+from staste.scripts import code_script
+
+# a code of values which were never kicked, so no field has it
+UNKNOWN_CODE = u'?'
+
+# a hash is moved from a copy, so kicks of the old key are not lost (see migrate)
+MIGRATING = u':__migrating__'
+
+
+class ValueCodes(object):
+    """Dictionaries of axes values of a metrica, cached in memory (codes never change)"""
+
+    def __init__(self, metrica):
+        self.metrica = metrica
+        self._codes = {}  # axis_kw => {value: code}
+        self._values = {}  # axis_kw => {code: utf-8 value}
+
+    def codes_key(self, axis_kw):
+        return u'%s:__codes__:%s' % (self.metrica.key_prefix(), axis_kw)
+
+    def values_key(self, axis_kw):
+        return u'%s:__values__' % self.codes_key(axis_kw)
+
+    def encode(self, axis_kw, value, create=False):
+        """
+        A code of a value (a field id part) of an axis. ALL is ''.
+        create - give the value a code if it has none, otherwise UNKNOWN_CODE is returned
+        """
+        if value == ALL:
+            return u''
+
+        code = self._codes.get(axis_kw, {}).get(value)
+        if code is not None:
+            return code
+
+        if create:
+            code = code_script(keys=[self.codes_key(axis_kw), self.values_key(axis_kw)], args=[value],
+                               client=self.metrica.redis)
+        else:
+            code = self.metrica.redis.hget(self.codes_key(axis_kw), value)
+            if code is None:
+                return UNKNOWN_CODE
+
+        self._remember(axis_kw, code, value)
+        return self._codes[axis_kw][value]
+
+    def prefetch(self, axis_kw, values):
+        """Reads codes of values not cached yet with one HMGET, e.g. of all choices of an axis"""
+        cached = self._codes.get(axis_kw, {})
+        missing = list(set(value for value in values if value != ALL and value not in cached))
+
+        if not missing:
+            return
+
+        for value, code in zip(missing, self.metrica.redis.hmget(self.codes_key(axis_kw), missing)):
+            if code is not None:
+                self._remember(axis_kw, code, value)
+
+    def decode(self, axis_kw, code):
+        """A value (utf-8) of a code of an axis, ALL for '', None if there is no such code"""
+        if code == '':
+            return ALL
+
+        value = self._values.get(axis_kw, {}).get(code)
+        if value is None:
+            # given by another process meanwhile
+            for known_code, known_value in self.metrica.redis.hgetall(self.values_key(axis_kw)).iteritems():
+                self._remember(axis_kw, known_code, known_value)
+
+            value = self._values[axis_kw].get(code)
+
+        return value
+
+    def _remember(self, axis_kw, code, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        code = unicode(code)
+        self._codes.setdefault(axis_kw, {})[unicode(value, 'utf-8')] = code
+        self._values.setdefault(axis_kw, {})[code] = value
+
+
+def migrate_all(pipeline_size=1000):
+    """Migrates all metricas with compact_keys created so far. Returns {name: (keys moved, keys skipped)}"""
+    from staste.metrica import registry
+
+    return dict((name, migrate(metrica, pipeline_size))
+                for name, metrica in registry.items() if metrica.codes is not None)
+
+
+def migrate(metrica, pipeline_size=1000):
+    """
+    Moves hashes (and HyperLogLogs, top sorted sets) of a metrica with compact_keys,
+    which were kicked before it had them. It's fine to run it again, while kicks go on:
+    a hash is renamed to "<key>:__migrating__" first and moved from there in one transaction,
+    so kicks of processes which still write the old key are moved by the next run,
+    and a run which has stopped halfway is finished by the next one.
+
+    Keys with fields which can't be split by axes (values with ":") are left as they are.
+    Returns a number of keys moved and a number of keys skipped
+    """
+    if metrica.codes is None:
+        raise ValueError(u'Invalid metrica: {}, it does not have compact_keys'.format(metrica.name))
+
+    prefix = metrica.key_prefix()
+    key_re = re.compile(
+        r'^%s:(?P<tp_id>%s|year:\d+(?::(?:month|day|hour|minute):\d+)*)'
+        r'(?:(?P<postfix>:__(?:len|histogram)__)?(?P<migrating>%s)?|:__(?P<kind>uniques|top)__:(?P<rest>.*))$' % (
+            re.escape(prefix), re.escape(ALL), re.escape(MIGRATING)))
+
+    redis = metrica.redis
+    moved = skipped = 0
+
+    # a sharded client is scanned node by node, see staste.sharding
+    for node in getattr(redis, 'nodes', [redis]):
+        for key in node.scan_iter(match=u'%s:*' % prefix, count=pipeline_size):
+            match = key_re.match(key)
+            if match is None:
+                continue
+
+            timespan = DATE_AXIS.id_to_timespan(match.group('tp_id'))
+            hash_key = u'%s:%s' % (prefix, metrica.date_axis.timespan_to_id(**timespan))
+
+            if match.group('kind') == 'uniques':
+                done = _move_uniques(metrica, key, hash_key, match.group('rest'))
+            elif match.group('kind') == 'top':
+                done = _move_top(metrica, key, hash_key, match.group('rest'))
+            else:
+                if match.group('migrating'):
+                    # left by a run which has stopped halfway
+                    key = key[:-len(MIGRATING)]
+
+                done = _move_hash(metrica, key, hash_key + (match.group('postfix') or ''),
+                                  histogram=match.group('postfix') == ':__histogram__')
+
+            # None: the key is gone (it has expired, or it's moved already)
+            if done:
+                moved += 1
+            elif done is not None:
+                skipped += 1
+
+    return moved, skipped
+
+
+def _encode_field(metrica, field):
+    """Encodes a verbose field id, None if it can't be split by axes"""
+    if not metrica.axes:
+        return u'' if field == '' else None
+
+    parts = field.split(':')
+    if len(parts) != len(metrica.axes):
+        return None
+
+    return u':'.join(metrica.codes.encode(axis_kw, unicode(part, 'utf-8'), create=True)
+                     for (axis_kw, axis), part in zip(metrica.axes, parts))
+
+
+def _move_hash(metrica, key, new_key, histogram):
+    redis = metrica.redis
+    migrating_key = key + MIGRATING
+
+    # a copy left by a run which has stopped halfway is moved first, the key is moved by the next run
+    try:
+        redis.renamenx(key, migrating_key)
+    except ResponseError:
+        pass  # no key, only its copy can be there
+
+    fields = redis.hgetall(migrating_key)
+    if not fields:
+        return None
+
+    new_fields = {}
+
+    for field, value in fields.iteritems():
+        bucket = None
+        if histogram:
+            # "<field>:<bucket>"
+            field, _, bucket = field.rpartition(':')
+
+        new_field = _encode_field(metrica, field)
+        if new_field is None:
+            # left as it is, unless the key is there again
+            redis.renamenx(migrating_key, key)
+            return False
+
+        new_fields[new_field if bucket is None else u'%s:%s' % (new_field, bucket)] = int(value)
+
+    # fields are moved and the copy is deleted at once, so a run which has stopped does not count them twice
+    pipe = redis.pipeline()
+    for field, value in new_fields.iteritems():
+        metrica.layout.hincrby(pipe, new_key, field, value)
+
+    ttl = redis.pttl(migrating_key)
+    if ttl > 0:
+        metrica.layout.expire(pipe, new_key, (ttl + 999) // 1000)
+    pipe.delete(migrating_key)
+    pipe.execute()
+    return True
+
+
+def _move_uniques(metrica, key, hash_key, field):
+    new_field = _encode_field(metrica, field)
+    if new_field is None:
+        return False
+
+    redis = metrica.redis
+    new_key = metrica.uniques_key(hash_key, new_field)
+
+    # it has expired since it was scanned
+    hll = redis.get(key)
+    if hll is None:
+        return None
+
+    # the new key can be on another node of a sharded client, so the HyperLogLog is copied next to it
+    tmp_key = u'%s:__compacting__' % new_key
+    pipe = redis.pipeline(transaction=False)
+    pipe.set(tmp_key, hll)
+    pipe.pfmerge(new_key, tmp_key)
+    pipe.delete(tmp_key)
+    _move_ttl(redis, pipe, key, new_key)
+    pipe.delete(key)
+    pipe.execute()
+    return True
+
+
+def _move_top(metrica, key, hash_key, axis_kw):
+    redis = metrica.redis
+    new_key = metrica.top_key(hash_key, axis_kw)
+    pipe = redis.pipeline(transaction=False)
+
+    for member, score in redis.zrange(key, 0, -1, withscores=True):
+        pipe.zincrby(new_key, metrica.codes.encode(axis_kw, unicode(member, 'utf-8'), create=True), score)
+
+    _move_ttl(redis, pipe, key, new_key)
+    pipe.delete(key)
+    pipe.execute()
+    return True
+
+
+def _move_ttl(redis, pipe, key, new_key):
+    ttl = redis.pttl(key)
+    if ttl > 0:
+        pipe.pexpire(new_key, ttl)
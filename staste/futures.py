@@ -0,0 +1,109 @@
+"""
+Non-blocking wrappers for event-loop based code (Tornado, Twisted, asyncio).
+
+AsyncMetrica and AsyncMetricaValues mirror Metrica and MetricaValues, but every
+call which talks to Redis returns a concurrent.futures.Future right away,
+and the actual work is done by a thread pool. Tornado coroutines can yield
+these futures, asyncio code can await asyncio.wrap_future(future).
+
+The very same Metrica and MetricaValues objects do the work, so keys and fields
+are the same as for synchronous kicks and reads.
+
+Example:
+    async_metrica = AsyncMetrica(guests_metrica)
+
+    async_metrica.kick(gender='girl', age=18)
+    total = yield async_metrica.filter(gender='girl').total()
+
+Needs the "futures" package on Python 2.
+"""
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+# shared by all AsyncMetrica objects which have no executor of their own
+executor = ThreadPoolExecutor(max_workers=getattr(settings, 'STASTE_ASYNC_WORKERS', 4))
+
+
+class AsyncMetricaValues(object):
+    def __init__(self, values, executor=executor):
+        self.values = values
+        self.executor = executor
+
+    # FILTERING
+    def timespan(self, **kwargs):
+        return self.__class__(self.values.timespan(**kwargs), self.executor)
+
+    def filter(self, **kwargs):
+        return self.__class__(self.values.filter(**kwargs), self.executor)
+
+    # GETTING VALUES
+    def total(self):
+        return self.executor.submit(self.values.total)
+
+    def iterate(self, axis=None):
+        return self._submit_list(self.values.iterate, axis)
+
+    def timeserie(self, since, until, scale=None):
+        return self._submit_list(self.values.timeserie, since, until, scale)
+
+    # AveragedMetricaValues
+    def average(self):
+        return self.executor.submit(self.values.average)
+
+    def count(self):
+        return self.executor.submit(self.values.count)
+
+    def iterate_counts(self, axis=None):
+        return self._submit_list(self.values.iterate_counts, axis)
+
+    def iterate_averages(self, axis=None):
+        return self._submit_list(self.values.iterate_averages, axis)
+
+    def timeserie_counts_and_averages(self, since, until, scale=None):
+        return self._submit_list(self.values.timeserie_counts_and_averages, since, until, scale)
+
+    def _submit_list(self, method, *args):
+        # some of the methods are generators, let's consume them in the pool
+        return self.executor.submit(lambda: list(method(*args)))
+
+
+class AsyncMetrica(object):
+    values_class = AsyncMetricaValues
+
+    def __init__(self, metrica, executor=executor):
+        """
+        metrica - a Metrica (or AveragedMetrica) to wrap
+        executor - a concurrent.futures executor doing the work
+        """
+        self.metrica = metrica
+        self.executor = executor
+
+    def kick(self, value=1, date=None, **kwargs):
+        """
+        Registers an event, returns a Future.
+        The date is fixed now, not when the kick is sent.
+        """
+        if date is None:
+            date = datetime.datetime.now()
+
+        return self.executor.submit(self.metrica.kick, value=value, date=date, **kwargs)
+
+    def choices(self, axis_kw, choices_filter=None):
+        return self.executor.submit(self.metrica.choices, axis_kw, choices_filter)
+
+    # STATISTICS
+    def values(self):
+        return self.values_class(self.metrica.values(), self.executor)
+
+    def timespan(self, **kwargs):
+        return self.values().timespan(**kwargs)
+
+    def filter(self, **kwargs):
+        return self.values().filter(**kwargs)
+
+    def __getattr__(self, attr):
+        """total(), iterate(), timeserie() etc. for all the data out there"""
+        return getattr(self.values(), attr)
@@ -0,0 +1,255 @@
+"""
+How hashes of a metrica are laid out in Redis keys (see Metrica layout).
+
+Redis keeps small hashes (up to hash-max-ziplist-entries fields of up to
+hash-max-ziplist-value bytes) in a compact encoding, several times smaller than
+a real hash table, and every key costs about a hundred bytes more. So:
+
+    # a minute hash of an axis with 50000 values is split into 64 small ones
+    Metrica(name='pages', axes=[('url', StoredChoiceAxis())], layout=BucketedLayout(64))
+
+    # 1440 nearly empty minute hashes a day are packed into 24 hour ones
+    Metrica(name='signups', axes=[], layout=PackedLayout())
+
+Layouts are hidden behind MetricaValues, so total(), iterate(), timeserie() and such
+do not change. memory_stats() tells how much memory a metrica takes.
+"""
+import copy
+import zlib
+from collections import defaultdict
+
+from redis.exceptions import ResponseError
+
+from staste.dateaxis import DATE_AXIS
+from staste.utils import LRUCache
+
+PACKED_KEYS_CACHE_SIZE = 1024
+
+
+class HashLayout(object):
+    """Every hash of a metrica is a Redis hash, the default"""
+    metrica = None
+
+    def for_metrica(self, metrica):
+        """A copy of the layout for a metrica (a layout can be shared by metricas)"""
+        layout = copy.copy(self)
+        layout.metrica = metrica
+        return layout
+
+    def locate(self, hash_key, field):
+        """The key and the field a field of a hash is kept in"""
+        return hash_key, field
+
+    def keys(self, hash_key):
+        """All keys a hash is kept in"""
+        return [hash_key]
+
+    def hincrby(self, pipe, hash_key, field, value):
+        key, field = self.locate(hash_key, field)
+        pipe.hincrby(key, field, value)
+
+    def hincrby_many(self, pipe, hash_key, fields, value):
+        """Bumps lots of fields of a hash, that's what every kick does. Returns keys it has bumped"""
+        hincrby = pipe.hincrby
+
+        if type(self) is HashLayout:
+            for field in fields:
+                hincrby(hash_key, field, value)
+            return [hash_key]
+
+        locate = self.locate
+        keys = []
+        for field in fields:
+            key, key_field = locate(hash_key, field)
+            hincrby(key, key_field, value)
+            if key not in keys:
+                keys.append(key)
+
+        return keys
+
+    def expire(self, pipe, hash_key, expiration, keys=None):
+        """keys - keys of the hash to expire (e.g. bumped by hincrby_many()), all of them by default"""
+        for key in self.keys(hash_key) if keys is None else keys:
+            pipe.expire(key, expiration)
+
+    # Reading methods queue commands into a pipeline, and return a function which
+    # takes an iterator of the pipeline results and returns what is read
+
+    def hmget(self, pipe, hash_key, fields):
+        """Values of fields of a hash"""
+        keys = []
+        located = defaultdict(list)  # key => [(n, field), ...]
+
+        for n, field in enumerate(fields):
+            key, key_field = self.locate(hash_key, field)
+            if key not in located:
+                keys.append(key)
+            located[key].append((n, key_field))
+
+        for key in keys:
+            pipe.hmget(key, [key_field for n, key_field in located[key]])
+
+        def collect(results):
+            values = [None] * len(fields)
+            for key in keys:
+                for (n, key_field), value in zip(located[key], next(results)):
+                    values[n] = value
+            return values
+
+        return collect
+
+    def hgetall(self, pipe, hash_key):
+        """All fields of a hash, {field: value}"""
+        keys = self.keys(hash_key)
+        for key in keys:
+            pipe.hgetall(key)
+
+        def collect(results):
+            fields = {}
+            for key in keys:
+                fields.update(self._hash_fields(hash_key, key, next(results)))
+            return fields
+
+        return collect
+
+    def exists(self, pipe, hash_key):
+        """Whether a hash exists"""
+        keys = self.keys(hash_key)
+        for key in keys:
+            pipe.exists(key)
+
+        return lambda results: any([next(results) for key in keys])
+
+    def _hash_fields(self, hash_key, key, fields):
+        """Fields of a hash among all fields of a key it's kept in"""
+        return fields
+
+
+class BucketedLayout(HashLayout):
+    """
+    Every hash is split into `buckets` hashes by a hash of its fields, "<hash key>:__bucket__:<n>".
+    Good for high-cardinality axes: hashes of 16 buckets stay compact up to 16 * 512 fields
+    """
+
+    def __init__(self, buckets=16):
+        self.buckets = buckets
+
+    def locate(self, hash_key, field):
+        if isinstance(field, unicode):
+            field = field.encode('utf-8')
+
+        return u'%s:__bucket__:%d' % (hash_key, (zlib.crc32(field) & 0xffffffff) % self.buckets), field
+
+    def keys(self, hash_key):
+        return [u'%s:__bucket__:%d' % (hash_key, n) for n in xrange(self.buckets)]
+
+
+class PackedLayout(HashLayout):
+    """
+    Hashes of the finest date scale of a metrica (minutes, usually) are packed into a hash
+    of the coarser one, "<prefix>:<hour id>:__packed__", with fields "<minute>:<field>".
+    Good for metricas with few counters: 60 times less keys. Packed hashes expire
+    `expiration` seconds after their last kick, so minutes can be kept up to an hour longer
+    """
+
+    def for_metrica(self, metrica):
+        scales = [scale for scale in DATE_AXIS.default_scales if scale in metrica.date_scales]
+        if len(scales) < 2:
+            raise ValueError(u'Invalid date scales: {}, PackedLayout needs two at least'.format(scales))
+
+        layout = super(PackedLayout, self).for_metrica(metrica)
+        layout.scale = scales[-1]
+        layout._packed_keys = LRUCache(PACKED_KEYS_CACHE_SIZE)
+        return layout
+
+    def locate(self, hash_key, field):
+        key, n = self._packed_key(hash_key)
+        if n is None:
+            return key, field
+
+        return key, u'%d:%s' % (n, field.decode('utf-8') if isinstance(field, str) else field)
+
+    def keys(self, hash_key):
+        return [self._packed_key(hash_key)[0]]
+
+    def _hash_fields(self, hash_key, key, fields):
+        key, n = self._packed_key(hash_key)
+        if n is None:
+            return fields
+
+        prefix = '%d:' % n
+        return dict((field[len(prefix):], value) for field, value in fields.iteritems() if field.startswith(prefix))
+
+    def _packed_key(self, hash_key):
+        """The key a hash is packed into, and a number of its timespan (None if it's not packed)"""
+        packed = self._packed_keys.get(hash_key)
+        if packed is not None:
+            return packed
+
+        # a hash key is "<prefix>:<tp_id><postfix>", e.g. ":__len__"
+        prefix = self.metrica.key_prefix()
+        tp_id, sep, postfix = hash_key[len(prefix) + 1:].partition(':__')
+        timespan = self.metrica.date_axis.id_to_timespan(tp_id)
+
+        if self.scale in timespan:
+            n = timespan.pop(self.scale)
+            key = u'%s:%s%s%s:__packed__' % (prefix, self.metrica.date_axis._timespan_id(timespan), sep, postfix)
+            packed = key, n
+        else:
+            packed = hash_key, None
+
+        self._packed_keys.set(hash_key, packed)
+        return packed
+
+
+def memory_stats(metrica, count=1000):
+    """
+    Memory taken by hashes of a metrica, to compare layouts:
+    {'layout': 'BucketedLayout', 'keys': 120, 'fields': 51200, 'bytes': 3145728,
+     'encodings': {'ziplist': 118, 'hashtable': 2}}
+    bytes are None if Redis can't tell them (MEMORY USAGE needs Redis 4+)
+    count - keys scanned (and asked about) at once
+    """
+    stats = {'layout': metrica.layout.__class__.__name__, 'keys': 0, 'fields': 0, 'bytes': 0,
+             'encodings': defaultdict(int)}
+    redis = metrica.redis
+
+    # a sharded client is scanned node by node, see staste.sharding
+    for node in getattr(redis, 'nodes', [redis]):
+        keys = []
+        for key in node.scan_iter(match=u'%s:*' % metrica.key_prefix(), count=count):
+            keys.append(key)
+            if len(keys) == count:
+                _add_memory_stats(node, keys, stats)
+                keys = []
+
+        _add_memory_stats(node, keys, stats)
+
+    stats['encodings'] = dict(stats['encodings'])
+    return stats
+
+
+def _add_memory_stats(node, keys, stats):
+    pipe = node.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    hashes = [key for key, key_type in zip(keys, pipe.execute()) if key_type == 'hash']
+
+    with_bytes = stats['bytes'] is not None
+    for key in hashes:
+        pipe.hlen(key)
+        pipe.object('encoding', key)
+        if with_bytes:
+            pipe.execute_command('MEMORY', 'USAGE', key)
+
+    results = iter(pipe.execute(raise_on_error=False))
+    for key in hashes:
+        stats['keys'] += 1
+        stats['fields'] += next(results)
+        stats['encodings'][next(results)] += 1
+
+        if with_bytes:
+            usage = next(results)
+            if stats['bytes'] is None:
+                continue
+            stats['bytes'] = None if isinstance(usage, ResponseError) else stats['bytes'] + usage
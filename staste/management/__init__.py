@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+
+
+def import_metrics_modules():
+    """
+    Metricas are registered when they are created (see staste.metrica.registry),
+    so commands working on all of them import modules defining them first:
+    STASTE_METRICS_MODULES, or "metrics" modules of installed apps
+    """
+    modules = getattr(settings, 'STASTE_METRICS_MODULES', None)
+
+    if not modules:
+        modules = ['staste.middleware']
+
+        for app in settings.INSTALLED_APPS:
+            if module_has_submodule(import_module(app), 'metrics'):
+                modules.append('%s.metrics' % app)
+
+    for module in modules:
+        import_module(module)
@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from staste.compaction import compact_all
+from staste.management import import_metrics_modules
+
+
+class Command(BaseCommand):
+    help = ('Sums up finer hashes of timespans which are over to date scales '
+            'metricas do not store (see Metrica stored_scales). Run it every few minutes.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--delay', type='int', default=60,
+                    help='Seconds to wait for late kicks after a timespan is over'),
+        make_option('--pipeline-size', dest='pipeline_size', type='int', default=1000,
+                    help='Max commands sent to Redis in one pipeline'),
+    )
+
+    def handle(self, *args, **options):
+        import_metrics_modules()
+
+        made = compact_all(delay=options['delay'], pipeline_size=options['pipeline_size'])
+
+        for name, count in sorted(made.items()):
+            if count:
+                self.stdout.write('%s: %d hashes\n' % (name, count))
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from staste.encoding import migrate_all
+from staste.management import import_metrics_modules
+
+
+class Command(BaseCommand):
+    help = ('Moves values of metricas with compact_keys, kicked before they had them, '
+            'to compact keys and fields (see staste.encoding).')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--pipeline-size', dest='pipeline_size', type='int', default=1000,
+                    help='Max commands sent to Redis in one pipeline'),
+    )
+
+    def handle(self, *args, **options):
+        import_metrics_modules()
+
+        migrated = migrate_all(pipeline_size=options['pipeline_size'])
+
+        for name, (moved, skipped) in sorted(migrated.items()):
+            self.stdout.write('%s: %d keys moved, %d skipped\n' % (name, moved, skipped))
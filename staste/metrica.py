@@ -1,11 +1,36 @@
 # coding: utf-8
+import math
+import time
+import uuid
 import datetime
 import itertools
+from array import array
+from collections import defaultdict
 
 from django.conf import settings
 
-from staste import redis, CHOICES
-from staste.dateaxis import DATE_AXIS
+from staste import ALL, CHOICES
+from staste.connections import connections, DEFAULT_ALIAS
+from staste.dateaxis import DateAxis, CompactDateAxis, DATE_AXIS
+from staste.encoding import ValueCodes
+from staste.layout import HashLayout
+from staste.scripts import kick_script, rollup_script, top_script, execute
+from staste.buffer import KickAggregator
+from staste.batching import current_batch
+
+# max fields asked by one HMGET
+HMGET_CHUNK_SIZE = 1000
+ROLLUP_CHUNK_SIZE = 500  # max finer hashes a ROLLUP_LUA call sums up
+PFCOUNT_CHUNK_SIZE = 1000  # max HyperLogLogs counted (or merged) with one command
+
+# all metricas created, by name
+registry = {}
+
+
+def _exists(pipe, key):
+    """Like HashLayout.exists, for keys which are not hashes"""
+    pipe.exists(key)
+    return next
 
 
 class MetricaValues(object):
@@ -20,8 +45,8 @@ class MetricaValues(object):
         self._filter = filter or {}
 
         # we should do it now to raise an error eagerly
-        tp_id = self.metrica.date_axis.timespan_to_id(**self._timespan)
-        self._hash_key = u'%s:%s' % (self.metrica.key_prefix(), tp_id)
+        self._tp_id = self.metrica.date_axis.timespan_to_id(**self._timespan)
+        self._hash_key = u'%s:%s' % (self.metrica.key_prefix(), self._tp_id)
         self._hash_field_id = self.metrica.hash_field_id(**self._filter)
 
     # FILTERING
@@ -38,22 +63,54 @@ class MetricaValues(object):
     # GETTING VALUES
     def total(self):
         """Total events count in the subset"""
-        return int(redis.hget(self._hash_key, self._hash_field_id) or 0) / self.metrica.multiplier
+        [[value]] = self._get_fields([(self._hash_key, self._tp_id, [self._hash_field_id])],
+                                     self.metrica.multiplier)
+        return value
 
     def timeserie(self, since, until, scale=None, _hash_key_postfix='', _mult=None):
         mult = _mult or self.metrica.multiplier
         prefix = self.metrica.key_prefix()
-        ts_points = self.metrica.date_axis.timeserie(since, until, scale)
         points = []
-        pipe = redis.pipeline(transaction=False)
+        requests = []
 
-        for point, tp_id in ts_points:
+        for point, tp_id in self.metrica.date_axis.timeserie(since, until, scale):
             points.append(point)
             hash_key = u'%s:%s%s' % (prefix, tp_id, _hash_key_postfix)
-            pipe.hget(hash_key, self._hash_field_id)
+            requests.append((hash_key, tp_id, [self._hash_field_id]))
+
+        values = self._get_fields(requests, mult)
+        return zip(points, [value for [value] in values])
+
+    def timeserie_by(self, axis, since, until, scale=None, choices=None, _hash_key_postfix='', _mult=None):
+        """
+        Timeseries for all choices of an axis at once: time points are computed once,
+        and there is one HMGET per time point for all the choices.
+
+        choices - defaults to all stored choices. None in choices means "any value" (a total)
+
+        Returns (points, choices, columns), where columns[n] is an array of values
+        of choices[n] for every point
+        """
+        mult = _mult or self.metrica.multiplier
+        prefix = self.metrica.key_prefix()
+
+        if choices is None:
+            choices = self.metrica.choices(axis, self._filter.get(axis, None), since)
+        choices = list(choices)
+
+        fields = [self.metrica.hash_field_id(**dict(self._filter, **{axis: choice})) for choice in choices]
+        points = []
+        requests = []
+
+        for point, tp_id in self.metrica.date_axis.timeserie(since, until, scale):
+            points.append(point)
+            requests.append((u'%s:%s%s' % (prefix, tp_id, _hash_key_postfix), tp_id, fields))
+
+        rows = self._get_fields(requests, mult)
+        typecode = 'd' if isinstance(mult, float) else 'l'
+        columns = [array(typecode, [row[n] for row in rows]) for n in xrange(len(fields))]
 
-        values = pipe.execute()
-        return zip(points, [int(v or 0) / mult for v in values])
+        return points, choices, columns
 
     def iterate(self, axis=None):
         """
@@ -67,16 +124,137 @@ class MetricaValues(object):
         return self._iterate(axis, self._hash_key, self.metrica.multiplier)
 
     def _iterate(self, axis, _hash_key, mult):
-        keys = self.metrica.choices(axis, self._filter.get(axis, None))
-        pipe = redis.pipeline(transaction=False)
+        keys = self._choices(axis)
+        fields = [self.metrica.hash_field_id(**dict(self._filter, **{axis: key})) for key in keys]
+
+        [values] = self._get_fields([(_hash_key, self._tp_id, fields)], mult)
+        return zip(keys, values)
+
+    def iterate_stream(self, axis, page_size=1000):
+        """
+        Like iterate(axis), but yields (key, value) tuples reading choices with SSCAN
+        and their values with HMGET, page_size at once. For axes with lots of choices:
+        memory does not grow with them, and Redis is not blocked by a huge SMEMBERS
+        """
+        mult = self.metrica.multiplier
+        since = self.metrica.date_axis.timespan_start(**self._timespan)
+
+        for keys in self.metrica.choice_pages(axis, self._filter.get(axis, None), since, page_size):
+            fields = [self.metrica.hash_field_id(**dict(self._filter, **{axis: key})) for key in keys]
+            [values] = self._get_fields([(self._hash_key, self._tp_id, fields)], mult)
+
+            for pair in zip(keys, values):
+                yield pair
+
+    def _choices(self, axis):
+        """Choices of an axis, kicked within the timespan if the axis keeps only recent ones"""
+        since = self.metrica.date_axis.timespan_start(**self._timespan)
+        return self.metrica.choices(axis, self._filter.get(axis, None), since)
+
+    def iterate_top(self, axis, k=10):
+        """
+        Returns up to k (choice, value) tuples with the greatest values, greatest first.
+        The axis should keep its top choices (see StoredChoiceAxis top), only their values are read.
+        Values are exact, but a choice which is not heavy enough for the whole timespan can be missing
+        """
+        axis_obj = self.metrica.get_axis(axis)
+        if not axis_obj.top:
+            raise ValueError(u'Invalid axis: {}, axes with top are: {}'.format(
+                axis, [axis_kw for axis_n, axis_kw, top in self.metrica.top_axes]))
 
-        for key in keys:
-            fl = dict(self._filter, **{axis: key})
-            hash_field_id = self.metrica.hash_field_id(**fl)
-            pipe.hget(_hash_key, hash_field_id)
+        members = [member for member, score in self._top_members(self.metrica.top_key(self._hash_key, axis),
+                                                                  axis_obj.top)]
+        if self.metrica.codes is not None:
+            members = filter(None, [self.metrica.codes.decode(axis, member) for member in members])
 
-        values = pipe.execute()
-        return zip(keys, [int(v or 0) / mult for v in values])
+        choices = [axis_obj.value_from_string(member) for member in members]
+        fields = [self.metrica.hash_field_id(**dict(self._filter, **{axis: choice})) for choice in choices]
+        [values] = self._get_fields([(self._hash_key, self._tp_id, fields)], self.metrica.multiplier)
+
+        return sorted(zip(choices, values), key=lambda pair: pair[1], reverse=True)[:k]
+
+    def _top_members(self, top_key, k):
+        """Up to k (member, score) tuples of a top sorted set, summed up from finer ones if it's not stored"""
+        [rollup_keys] = self._rollup_keys([(top_key, self._tp_id)])
+
+        if rollup_keys is None or self.metrica.redis.exists(top_key):
+            return self.metrica.redis.zrevrange(top_key, 0, k - 1, withscores=True)
+
+        tmp_key = u'%s:__union__' % top_key
+        redis = self.metrica.redis
+
+        if getattr(redis, 'sharded', False):
+            # finer sorted sets are on other nodes, ShardedRedis merges them next to tmp_key
+            try:
+                redis.zunionstore(tmp_key, rollup_keys)
+                return redis.zrevrange(tmp_key, 0, k - 1, withscores=True)
+            finally:
+                redis.delete(tmp_key)
+
+        pipe = redis.pipeline()
+        pipe.zunionstore(tmp_key, rollup_keys)
+        pipe.zrevrange(tmp_key, 0, k - 1, withscores=True)
+        pipe.delete(tmp_key)
+
+        return pipe.execute()[1]
+
+    def iterate_all(self, axis):
+        """
+        Like iterate(axis), but reads the whole hash with one HGETALL instead of asking for stored choices.
+        Returns only choices which have values, in no particular order.
+        Good for high-cardinality axes, as long as their values do not contain ":"
+        """
+        return self._iterate_all(axis, self._hash_key, self.metrica.multiplier)
+
+    def _iterate_all(self, axis, _hash_key, mult):
+        axes_kws = [axis_kw for axis_kw, _ in self.metrica.axes]
+        axis_n = axes_kws.index(axis)
+        axis_obj = self.metrica.get_axis(axis)
+        choices_filter = self._filter.get(axis, None)
+
+        # the field is "<other axes ids before>:<choice>:<other axes ids after>"
+        parts = [a.get_field_main_id(self._filter.get(axis_kw, None)) for axis_kw, a in self.metrica.axes]
+
+        if self.metrica.combinations is not None:
+            self.metrica._check_materialized(n for n, part in enumerate(parts) if part != ALL or n == axis_n)
+        if self.metrica.codes is not None:
+            parts = [self.metrica.codes.encode(axis_kw, part) for (axis_kw, a), part in zip(self.metrica.axes, parts)]
+
+        head = u''.join(part + u':' for part in parts[:axis_n]).encode('utf-8')
+        tail = u''.join(u':' + part for part in parts[axis_n + 1:]).encode('utf-8')
+
+        layout = self.metrica.layout
+        pipe = self.metrica.redis.pipeline(transaction=False)
+        collect = layout.hgetall(pipe, _hash_key)
+        fields = collect(iter(pipe.execute()))
+        [rollup_keys] = self._rollup_keys([(_hash_key, self._tp_id)], layout.exists)
+
+        if rollup_keys is not None and not fields:
+            # not stored (and not compacted): summing up finer hashes
+            collects = [layout.hgetall(pipe, key) for key in rollup_keys]
+            results = iter(pipe.execute())
+
+            fields = defaultdict(int)
+            for collect in collects:
+                for field, value in collect(results).iteritems():
+                    fields[field] += int(value)
+
+        values = []
+        for field, value in fields.iteritems():
+            if not (field.startswith(head) and field.endswith(tail)) or len(field) < len(head) + len(tail):
+                continue
+
+            field_id = field[len(head):len(field) - len(tail)]
+            if self.metrica.codes is not None:
+                field_id = self.metrica.codes.decode(axis, field_id)
+                if field_id is None:
+                    continue
+
+            choice = axis_obj.choice_from_field_id(field_id, choices_filter)
+            if choice is not None:
+                values.append((choice, int(value) / mult))
+
+        return values
 
     def iterate_on_dateaxis(self):
         """
@@ -88,15 +266,161 @@ class MetricaValues(object):
     def _iterate_on_dateaxis(self, _hash_key_postfix, mult):
         prefix = self.metrica.key_prefix()
         keys = []
-        pipe = redis.pipeline(transaction=False)
+        requests = []
 
         for key, tp_id in self.metrica.date_axis.iterate(self):
             keys.append(key)
             hash_key = u'%s:%s' % (prefix, tp_id) + _hash_key_postfix
-            pipe.hget(hash_key, self._hash_field_id)
+            requests.append((hash_key, tp_id, [self._hash_field_id]))
+
+        values = self._get_fields(requests, mult)
+        return zip(keys, [value for [value] in values])
+
+    def _get_fields(self, requests, mult):
+        """
+        Reads values of hash fields, HMGETting up to HMGET_CHUNK_SIZE fields at once.
+        requests - a list of (hash_key, tp_id, [field, ...])
+        Returns a list of lists of values (divided by mult) for each request.
+
+        If the metrica has a result cache, cached values are not asked for, and values read are cached.
+        """
+        cache = self.metrica.cache
+        rows = [[None] * len(fields) for hash_key, tp_id, fields in requests]
+
+        if cache is not None:
+            cache.get_rows(requests, rows)
+
+        layout = self.metrica.layout
+        # finer hashes are on other nodes of a sharded client, or in other keys, so ROLLUP_LUA is done here
+        rollup_here = getattr(self.metrica.redis, 'sharded', False) or type(layout) is not HashLayout
+        missing = [[i for i in xrange(len(fields)) if row[i] is None]
+                   for row, (hash_key, tp_id, fields) in zip(rows, requests)]
+        rollups = iter(self._rollup_keys([(hash_key, tp_id) for (hash_key, tp_id, fields), row_missing
+                                          in zip(requests, missing) if row_missing], layout.exists))
+
+        pipe = self.metrica.redis.pipeline(transaction=False)
+        queued = []
+
+        for n, (hash_key, tp_id, fields) in enumerate(requests):
+            rollup_keys = next(rollups) if missing[n] else None
+
+            for start in xrange(0, len(missing[n]), HMGET_CHUNK_SIZE):
+                chunk = missing[n][start:start + HMGET_CHUNK_SIZE]
+                chunk_fields = [fields[i] for i in chunk]
+
+                if rollup_keys is None:
+                    collect = layout.hmget(pipe, hash_key, chunk_fields)
+                elif rollup_here:
+                    collects = [layout.hmget(pipe, key, chunk_fields) for key in [hash_key] + rollup_keys]
+                    collect = self._rollup(collects, layout.exists(pipe, hash_key))
+                else:
+                    # every call checks whether the hash exists, and sums up a chunk of finer ones if not
+                    calls = 0
+                    for keys_start in xrange(0, len(rollup_keys), ROLLUP_CHUNK_SIZE):
+                        rollup_script(keys=[hash_key] + rollup_keys[keys_start:keys_start + ROLLUP_CHUNK_SIZE],
+                                      args=chunk_fields, client=pipe)
+                        calls += 1
+                    collect = self._rollup_chunks(calls)
+
+                queued.append((n, chunk, collect))
+
+        if queued:
+            fetched = []
+            results = iter(execute(pipe))
+
+            for n, chunk, collect in queued:
+                values = collect(results)
+
+                for i, value in zip(chunk, values):
+                    rows[n][i] = int(value or 0)
+                fetched.append((n, chunk))
+
+            if cache is not None:
+                cache.set_rows(requests, rows, fetched, self.metrica.date_axis)
+
+        return [[value / mult for value in row] for row in rows]
+
+    def _rollup(self, collects, exists):
+        """Like ROLLUP_LUA: values of the hash if it exists, otherwise sums of values of finer ones"""
+        def collect(results):
+            rows = [collect(results) for collect in collects]
+            hash_exists = exists(results)
 
-        values = pipe.execute()
-        return zip(keys, [int(v or 0) / mult for v in values])
+            if hash_exists:
+                return rows[0]
+
+            return [sum(int(row[f] or 0) for row in rows[1:]) for f in xrange(len(rows[0]))]
+
+        return collect
+
+    def _rollup_chunks(self, calls):
+        """Collects results of ROLLUP_LUA calls of a hash: values of the hash if it exists, otherwise sums"""
+        def collect(results):
+            rows = [next(results) for n in xrange(calls)]
+
+            for hash_exists, values in rows:
+                if hash_exists:
+                    return values
+
+            return [sum(int(values[f] or 0) for hash_exists, values in rows) for f in xrange(len(rows[0][1]))]
+
+        return collect
+
+    def _rollup_keys(self, requests, exists=None):
+        """
+        Keys of finer hashes to sum up, for the ones of scales the metrica does not store.
+        requests - a list of (key, tp_id) of hashes (or of other keys of timespans, e.g. top_key())
+        exists - queues a check if a key exists into a pipeline (see HashLayout.exists). default: EXISTS
+
+        Returns a list of lists of keys, None for a key of a stored scale. Keys of the next finer scale are
+        summed up if it's stored, otherwise its compacted hashes are, and finer ones of the rest
+        (one scale at a time, checking which ones exist with a pipeline for every scale)
+        """
+        if self.metrica.stored_scales is None:
+            return [None] * len(requests)
+
+        date_axis = self.metrica.date_axis
+        stored_scales = self.metrica.stored_scales
+        exists = exists or _exists
+        prefix = self.metrica.key_prefix()
+        pending = []  # (keys of a request, key, tp_id, postfix) of not stored finer timespans
+        rollups = []
+
+        def expand(keys, finer_ids, postfix):
+            # finer timespans are of the same scale
+            finer_stored = date_axis.rollup_ids(finer_ids[0], stored_scales) is None
+
+            for finer_id in finer_ids:
+                finer_key = u'%s:%s%s' % (prefix, finer_id, postfix)
+                if finer_stored:
+                    keys.append(finer_key)
+                else:
+                    pending.append((keys, finer_key, finer_id, postfix))
+
+        for key, tp_id in requests:
+            finer_ids = date_axis.rollup_ids(tp_id, stored_scales)
+            if finer_ids is None:
+                rollups.append(None)
+                continue
+
+            # a key is "<prefix>:<tp_id><postfix>", e.g. ":__len__"
+            keys = []
+            expand(keys, finer_ids, key[len(prefix) + 1 + len(tp_id):])
+            rollups.append(keys)
+
+        while pending:
+            pipe = self.metrica.redis.pipeline(transaction=False)
+            checks = [(keys, key, tp_id, postfix, exists(pipe, key)) for keys, key, tp_id, postfix in pending]
+            results = iter(pipe.execute())
+            pending = []
+
+            for keys, key, tp_id, postfix, collect in checks:
+                if collect(results):
+                    keys.append(key)  # compacted
+                else:
+                    expand(keys, date_axis.rollup_ids(tp_id, stored_scales), postfix)
+
+        return rollups
 
 
 class Metrica(object):
@@ -110,8 +434,13 @@ class Metrica(object):
     Every time the event happens, you call Metrica.kick() function with all the parameters for all axes specified.
     """
     values_class = MetricaValues
+    counts_events = False  # whether kick() also bumps ":__len__" counters
+    counts_uniques = False  # whether kick() also adds uids to HyperLogLogs (see UniqueMetrica)
+    hash_key_postfixes = ('',)  # hashes kick() bumps for every date scale, e.g. ":__len__"
 
-    def __init__(self, name, axes, multiplier=None, date_scales=None):
+    def __init__(self, name, axes, multiplier=None, date_scales=None, lua_kick=False, buffer=None,
+                 cache=None, retention=None, combinations=None, stored_scales=None, using=DEFAULT_ALIAS,
+                 compact_keys=False, layout=None, compacted=False):
         """
         Constructor of a Metrica
 
@@ -121,67 +450,288 @@ class Metrica(object):
         date_scales — list/tuple of allowed date scales. default: ('year', 'month', 'day', 'hour', 'minute')
         it's useful since Redis does not understand floating point increments.
         (all totals() will be divided back by this)
+        lua_kick - expand axes product inside Redis with a Lua script (one EVALSHA per kick)
+        instead of sending every HINCRBY from the client
+        buffer - a staste.buffer.KickBuffer to coalesce kicks in memory and flush them periodically
+        (e.g. staste.buffer.kick_buffer, shared by the whole process). takes precedence over lua_kick
+        and staste.batch()
+        cache - a staste.cache.ResultCache for values read (closed periods are cached for long)
+        retention - how long to keep date scales, e.g. {'minute': '6h', 'hour': '7d'}.
+        defaults are in staste.dateaxis.DATE_SCALES_AND_EXPIRATIONS
+        combinations - axes combinations you are going to filter by, e.g. [('gender', 'age'), ('city',)].
+        only counters for them (and their subsets) are kicked, so more axes do not double the kick.
+        by default, all combinations are
+        stored_scales - date scales kick() writes, e.g. ('day', 'minute'). other date scales are summed up
+        from finer ones when read (or read from compacted hashes). default: all date_scales.
+        a year of minutes is half a million hashes to sum up, and they expire long before the year does,
+        so a stored scale should be kept as long as coarser ones summed up from it (see retention),
+        unless the metrica is compacted
+        compacted - staste_compact is run for the metrica (see staste.compaction), so scales which are
+        not stored are made of finer ones before these expire
+        using - an alias of the Redis client to keep the metrica in (see staste.connections)
+        compact_keys - shorter keys and fields: packed date ids and numbers of axes values
+        instead of values (see staste.encoding). date_scales should be the coarsest ones then
+        layout - how hashes are kept in Redis keys, e.g. staste.layout.BucketedLayout(64) for
+        high-cardinality axes (see staste.layout). default: a Redis hash for a hash
         """
         self.name = str(name)
         self.axes = list(axes)
-        self.date_axis = DATE_AXIS
         self.multiplier = float(multiplier) if multiplier else 1
         self.date_scales = date_scales or DATE_AXIS.default_scales
 
+        if compact_keys:
+            if tuple(self.date_scales) != DATE_AXIS.default_scales[:len(self.date_scales)]:
+                raise ValueError(u'Invalid date scales: {}, with compact_keys should be the first of {}'.format(
+                    self.date_scales, DATE_AXIS.default_scales))
+
+            self.date_axis = CompactDateAxis(retention)
+            self.codes = ValueCodes(self)
+        else:
+            self.date_axis = DateAxis(retention) if retention else DATE_AXIS
+            self.codes = None
+
+        self.lua_kick = lua_kick
+        self.buffer = buffer
+        self.using = using
+        self.cache = cache
+        self.combinations = self._materialized_combinations(combinations) if combinations is not None else None
+        self.stored_scales = tuple(stored_scales) if stored_scales is not None else None
+        self.compacted = compacted
+        self.top_axes = [(n, axis_kw, axis.top) for n, (axis_kw, axis) in enumerate(self.axes) if axis.top]
+
+        # kick plan: what every kick needs is computed once
+        self._choice_keys = [u'%s:%s' % (CHOICES, axis_kw) for axis_kw, axis in self.axes]
+        self._metrics_prefix = self._key_prefix = None
+        self._date_scales_memo = None  # ((year, month, day, hour, minute), date scales of the minute)
+        self.layout = (layout or HashLayout()).for_metrica(self)
+
+        if lua_kick and type(self.layout) is not HashLayout:
+            raise ValueError(u'Invalid lua_kick: {} is computed by the client'.format(self.layout.__class__.__name__))
+
+        if self.stored_scales is not None:
+            finest = [scale for scale in DATE_AXIS.default_scales if scale in self.date_scales][-1]
+
+            if not set(self.stored_scales) <= set(self.date_scales) or finest not in self.stored_scales:
+                raise ValueError(u'Invalid stored scales: {}, should be some of {}, including {}'.format(
+                    self.stored_scales, self.date_scales, finest))
+
+            if not compacted:
+                self._check_rollup_retention()
+
+        registry[self.name] = self
+
+    def _check_rollup_retention(self):
+        """Scales which are not stored are summed up from finer ones, those should not expire before"""
+        expirations = dict(self.date_axis.scales_and_expirations)
+        finer = None
+
+        # finest first, it's always stored
+        for scale in reversed([scale for scale in DATE_AXIS.default_scales if scale in self.date_scales]):
+            if scale in self.stored_scales:
+                finer = scale
+            elif expirations[finer] and not 0 < expirations[scale] <= expirations[finer]:
+                raise ValueError(u'Invalid stored scales: {}, {} expires before {} summed up from it, '
+                                 u'keep it longer (see retention) or compact the metrica (compacted=True)'.format(
+                                     self.stored_scales, finer, scale))
+
     def kick(self, value=1, date=None, **kwargs):
         """
         Registers an event with parameters (for each of axis)
         """
         date = date or datetime.datetime.now()
         value = int(self.multiplier * value)
-        
-        hash_key_prefix = self.key_prefix()
 
+        hash_field_id_parts, choices_sets_to_append = self._kick_parts(kwargs)
+        self._kick(value, date, self._date_scales(date), hash_field_id_parts, choices_sets_to_append)
+
+    def _date_scales(self, date):
+        """
+        DateScale objects of a date (see DateAxis.scales). Most kicks are of now,
+        so they are remembered for the minute of the last kick
+        """
+        minute = (date.year, date.month, date.day, date.hour, date.minute)
+        memo = self._date_scales_memo
+
+        if memo is None or memo[0] != minute:
+            memo = minute, tuple(self.date_axis.scales(date, self.date_scales, self.stored_scales))
+            self._date_scales_memo = memo
+
+        return memo[1]
+
+    def _kick(self, value, date, date_scales, hash_field_id_parts, choices_sets_to_append):
+        if self._kicks_with_lua():
+            self._kick_lua(value, date, date_scales, hash_field_id_parts, choices_sets_to_append)
+        else:
+            pipe = self._pipeline()
+            self._kick_pipeline(pipe, value, date, date_scales, hash_field_id_parts, choices_sets_to_append)
+            execute(pipe)
+
+    def _kicks_with_lua(self):
+        # keys of a kick are on different nodes of a sharded client, so the script can't do it
+        return self.lua_kick and self.buffer is None and not getattr(self.redis, 'sharded', False)
+
+    def kick_many(self, events, chunk_size=100000, pipeline_size=5000):
+        """
+        Registers lots of events at once, e.g. for a backfill.
+
+        events - an iterable (a generator is fine) of dicts of kick() keyword arguments:
+        [{'date': dt, 'value': 2, 'gender': 'boy'}, ...] (and 'uid' of a UniqueMetrica)
+        chunk_size - events are summed up on the client in chunks of this many events
+        pipeline_size - max commands sent in one pipeline
+
+        So Redis gets about one command per distinct counter of a chunk, not per event.
+        Returns a number of events registered.
+        """
+        aggregator = KickAggregator(self.using)
+        n = 0
+
+        for n, event in enumerate(events, 1):
+            self._kick_event(aggregator, dict(event))
+
+            if n % chunk_size == 0:
+                aggregator.flush(pipeline_size)
+
+        aggregator.flush(pipeline_size)
+        return n
+
+    def _kick_event(self, pipe, event):
+        """Queues an event of kick_many(). Returns its date scales and field id parts"""
+        date = event.pop('date', None) or datetime.datetime.now()
+        value = int(self.multiplier * event.pop('value', 1))
+
+        hash_field_id_parts, choices_sets_to_append = self._kick_parts(event)
+        date_scales = self._date_scales(date)
+        self._kick_pipeline(pipe, value, date, date_scales, hash_field_id_parts, choices_sets_to_append)
+        return date_scales, hash_field_id_parts
+
+    def _kick_parts(self, kwargs):
+        """
+        Returns axes field id parts (to be multiplied) and choices sets to append
+        """
         choices_sets_to_append = []
         hash_field_id_parts = []
+        codes = self.codes
 
-        for axis_kw, axis in self.axes:
+        for (axis_kw, axis), choice_key in zip(self.axes, self._choice_keys):
             param_value = kwargs.pop(axis_kw, None)
-            
-            hash_field_id_parts.append(
-                list(axis.get_field_id_parts(param_value))
-            )
+            parts = list(axis.get_field_id_parts(param_value))
+
+            if codes is not None:
+                parts = [codes.encode(axis_kw, part, create=True) for part in parts]
+
+            hash_field_id_parts.append(parts)
 
             if axis.store_choice:
                 for key_postfix, choice in axis.choices_from_value(param_value):
-                    choice_key_parts = (CHOICES, axis_kw, key_postfix) if key_postfix else (CHOICES, axis_kw)
-                    choices_sets_to_append.append((u':'.join(choice_key_parts), choice))
+                    key = u'%s:%s' % (choice_key, key_postfix) if key_postfix else choice_key
+                    choices_sets_to_append.append((key, choice, axis.max_choices))
 
         if kwargs:
             raise TypeError("Invalid kwargs left: %s" % kwargs)
 
-        choices_sets_to_append = filter(None, choices_sets_to_append)
-            
+        return hash_field_id_parts, filter(None, choices_sets_to_append)
+
+    def _kick_pipeline(self, pipe, value, date, date_scales, hash_field_id_parts, choices_sets_to_append):
+        hash_key_prefix = self.key_prefix()
+        hash_field_ids = [u':'.join(parts) for parts in self._field_id_products(hash_field_id_parts)]
+
         # Here we go: bumping all counters out there
-        pipe = redis.pipeline(transaction=False)
+        for date_scale in date_scales:
+            if date_scale.id is not None:
+                hash_key = u'%s:%s' % (hash_key_prefix, date_scale.id)
+                keys = self._increment_many(pipe, hash_key, hash_field_ids, value)
 
-        for date_scale in self.date_axis.scales(date, self.date_scales):
-            hash_key = u'%s:%s' % (hash_key_prefix, date_scale.id)
+                if date_scale.expiration:
+                    self.layout.expire(pipe, hash_key, date_scale.expiration, keys)
+
+                for axis_n, axis_kw, top in self.top_axes:
+                    parts = hash_field_id_parts[axis_n]
+                    if len(parts) < 2:
+                        continue
 
-            for parts in itertools.product(*hash_field_id_parts):
-                hash_field_id = u':'.join(parts)
-                self._increment(pipe, hash_key, hash_field_id, value)
-            
-            if date_scale.expiration:
-                pipe.expire(hash_key, date_scale.expiration)
+                    self._top_increment(pipe, self.top_key(hash_key, axis_kw), parts[1], value,
+                                        top, date_scale.expiration)
 
             if date_scale.store:
-                choices_sets_to_append.append((date_scale.store, date_scale.value))
+                choices_sets_to_append.append((date_scale.store, date_scale.value, None))
+
+        score = None
+        for key, s_value, max_choices in choices_sets_to_append:
+            key = u'%s:%s' % (hash_key_prefix, key)
+
+            if max_choices:
+                # bounded choices: the least recently kicked ones are evicted, by the time of kicks,
+                # so values of a backfill are choices of its timespans (see MetricaValues._choices)
+                if score is None:
+                    score = time.mktime(date.timetuple())
+                pipe.zadd(key, score, s_value)
+                pipe.zremrangebyrank(key, 0, -max_choices - 1)
+            else:
+                pipe.sadd(key, s_value)
+
+    def _kick_lua(self, value, date, date_scales, hash_field_id_parts, choices_sets_to_append, client=None):
+        """
+        Ships only axes parts, date scales and choices to the kick script,
+        which multiplies them inside Redis. See staste.scripts.KICK_LUA
+        client - a pipeline to queue the script into. default: the batch pipeline, or the Redis client
+        """
+        args = [self.key_prefix(), value, 1 if self.counts_events else 0]
+
+        date_scales = list(date_scales)
+        args.append(len([date_scale for date_scale in date_scales if date_scale.id is not None]))
+        for date_scale in date_scales:
+            if date_scale.id is not None:
+                args.extend((date_scale.id, date_scale.expiration))
+
+            if date_scale.store:
+                choices_sets_to_append.append((date_scale.store, date_scale.value, None))
+
+        args.append(len(hash_field_id_parts))
+        for parts in hash_field_id_parts:
+            args.append(len(parts))
+            args.extend(parts)
 
-        for key, s_value in choices_sets_to_append:
-            pipe.sadd(u'%s:%s' % (hash_key_prefix, key), s_value)
+        masks = [sum(1 << n for n in combination) for combination in self.combinations or ()]
+        args.append(len(masks))
+        args.extend(masks)
 
-        pipe.execute()
+        args.append(len(choices_sets_to_append))
+        args.append(time.mktime(date.timetuple()))
+        for key, s_value, max_choices in choices_sets_to_append:
+            args.extend((key, s_value, max_choices or 0))
 
-    def choices(self, axis_kw, choices_filter=None):
-        return dict(self.axes)[axis_kw].get_choices(
-            self.key_for_axis_choices(axis_kw), choices_filter=choices_filter
+        args.append(len(self.top_axes))
+        for axis_n, axis_kw, top in self.top_axes:
+            args.extend((axis_n + 1, axis_kw, top))
+
+        if client is None:
+            batch = current_batch()
+            client = batch.pipeline(self.using) if batch is not None else self.redis
+
+        kick_script(args=args, client=client)
+
+    def choices(self, axis_kw, choices_filter=None, since=None):
+        """since - only values kicked since then, for axes with bounded choices (see StoredChoiceAxis)"""
+        choices = dict(self.axes)[axis_kw].get_choices(
+            self.key_for_axis_choices(axis_kw), choices_filter=choices_filter, since=since, client=self.redis
         )
+        self._prefetch_codes(axis_kw, choices)
+        return choices
+
+    def choice_pages(self, axis_kw, choices_filter=None, since=None, page_size=1000):
+        """Like choices(), but yields lists of choices read page by page (see Axis.get_choice_pages)"""
+        for page in dict(self.axes)[axis_kw].get_choice_pages(
+            self.key_for_axis_choices(axis_kw), page_size, choices_filter=choices_filter, since=since,
+            client=self.redis
+        ):
+            self._prefetch_codes(axis_kw, page)
+            yield page
+
+    def _prefetch_codes(self, axis_kw, choices):
+        """Codes of choices are read at once, not by hash_field_id() one by one"""
+        if self.codes is not None:
+            axis = self.get_axis(axis_kw)
+            self.codes.prefetch(axis_kw, [axis.get_field_main_id(choice) for choice in choices])
 
     # STATISTICS
     def values(self):
@@ -198,9 +748,18 @@ class Metrica(object):
             return getattr(self.values(), attr, *args)
 
     # UTILS
+    @property
+    def redis(self):
+        """The Redis client the metrica is kept in"""
+        return connections.get(self.using)
+
     def key_prefix(self):
         metrics_prefix = settings.STASTE_METRICS_PREFIX
-        return u'%s:%s' % (metrics_prefix, self.name)
+
+        if metrics_prefix != self._metrics_prefix:
+            self._metrics_prefix, self._key_prefix = metrics_prefix, u'%s:%s' % (metrics_prefix, self.name)
+
+        return self._key_prefix
 
     def hash_field_id(self, **kwargs):
         hash_field_id_parts = []
@@ -213,6 +772,13 @@ class Metrica(object):
         if kwargs:
             raise TypeError("Invalid kwargs left: %s" % kwargs)
 
+        if self.combinations is not None:
+            self._check_materialized(n for n, part in enumerate(hash_field_id_parts) if part != ALL)
+
+        if self.codes is not None:
+            hash_field_id_parts = [self.codes.encode(axis_kw, part)
+                                   for (axis_kw, axis), part in zip(self.axes, hash_field_id_parts)]
+
         return u':'.join(hash_field_id_parts)
 
     def get_axis(self, axis_kw):
@@ -221,8 +787,75 @@ class Metrica(object):
     def key_for_axis_choices(self, axis_kw):
         return u'%s:%s:%s' % (self.key_prefix(), CHOICES, axis_kw)
 
-    def _increment(self, pipe, hash_key, hash_field_id, value):
-        pipe.hincrby(hash_key, hash_field_id, value)
+    def top_key(self, hash_key, axis_kw):
+        """A key of the sorted set of heaviest values of an axis (see StoredChoiceAxis top)"""
+        return u'%s:__top__:%s' % (hash_key, axis_kw)
+
+    def _materialized_combinations(self, combinations):
+        """
+        Converts combinations of axes keywords to a list of all combinations
+        of axes numbers to kick (all their subsets too)
+        """
+        axes_numbers = dict((axis_kw, n) for n, (axis_kw, axis) in enumerate(self.axes))
+        materialized = set()
+
+        for combination in combinations:
+            for axis_kw in combination:
+                if axis_kw not in axes_numbers:
+                    raise ValueError(u'Invalid axis: {}, choices are: {}'.format(axis_kw, axes_numbers.keys()))
+
+            numbers = sorted(axes_numbers[axis_kw] for axis_kw in combination)
+            for size in xrange(len(numbers) + 1):
+                materialized.update(itertools.combinations(numbers, size))
+
+        return sorted(materialized, key=lambda c: (len(c), c))
+
+    def _check_materialized(self, axes_numbers):
+        combination = tuple(sorted(axes_numbers))
+
+        if combination not in self.combinations:
+            raise ValueError(u'Combination of axes {} is not kicked, combinations are: {}'.format(
+                [self.axes[n][0] for n in combination],
+                [[self.axes[n][0] for n in c] for c in self.combinations]
+            ))
+
+    def _field_id_products(self, hash_field_id_parts):
+        """
+        Yields field id parts for all counters to kick.
+        The first part of an axis parts is ALL, the rest are values
+        """
+        if self.combinations is None:
+            return itertools.product(*hash_field_id_parts)
+
+        return itertools.chain.from_iterable(
+            itertools.product(*[parts[1:] if n in combination else parts[:1]
+                                for n, parts in enumerate(hash_field_id_parts)])
+            for combination in self.combinations
+        )
+
+    def _pipeline(self):
+        if self.buffer is not None:
+            return self.buffer.pipeline(using=self.using)
+
+        return self._redis_pipeline()
+
+    def _redis_pipeline(self):
+        """A pipeline of the current staste.batch(), if any, which is executed when the batch is over"""
+        batch = current_batch()
+        if batch is not None:
+            return batch.pipeline(self.using)
+
+        return self.redis.pipeline(transaction=False)
+
+    def _increment_many(self, pipe, hash_key, hash_field_ids, value):
+        """Bumps hashes of a timespan, returns keys to expire with it"""
+        return self.layout.hincrby_many(pipe, hash_key, hash_field_ids, value)
+
+    def _top_increment(self, pipe, top_key, member, value, top, expiration):
+        if isinstance(pipe, KickAggregator):
+            pipe.top_increment(top_key, member, value, top, expiration)
+        else:
+            top_script(keys=[top_key], args=[member, value, top, expiration], client=pipe)
 
 
 class AveragedMetricaValues(MetricaValues):
@@ -230,7 +863,8 @@ class AveragedMetricaValues(MetricaValues):
         return self.total() / self.count()
 
     def count(self):
-        return int(redis.hget(u'%s:__len__' % self._hash_key, self._hash_field_id) or 0)
+        [[value]] = self._get_fields([(u'%s:__len__' % self._hash_key, self._tp_id, [self._hash_field_id])], 1)
+        return value
 
     def iterate_counts(self, axis=None):
         if not axis:
@@ -281,7 +915,303 @@ class AveragedMetrica(Metrica):
     So you can ask for .average or .count
     """
     values_class = AveragedMetricaValues
+    counts_events = True
+    hash_key_postfixes = ('', ':__len__')
+
+    def _increment_many(self, pipe, hash_key, hash_field_ids, value):
+        keys = super(AveragedMetrica, self)._increment_many(pipe, hash_key, hash_field_ids, value)
+        return keys + self.layout.hincrby_many(pipe, u'%s:__len__' % hash_key, hash_field_ids, 1)
+
+
+class HistogramMetricaValues(AveragedMetricaValues):
+    def percentiles(self, percents=(50, 95, 99)):
+        """Percentiles of values in the subset: {50: 0.12, 95: 0.8, 99: 2.5}. None if there are no values"""
+        [counts] = self._get_fields([(u'%s:__histogram__' % self._hash_key, self._tp_id,
+                                      self.metrica.histogram_fields(self._hash_field_id))], 1)
+        return self.metrica.percentiles_from_counts(counts, percents)
+
+    def iterate_percentiles(self, axis=None, percents=(50, 95, 99)):
+        """Like iterate(), but with percentiles of values (see percentiles())"""
+        prefix = self.metrica.key_prefix()
+        keys, requests = [], []
+
+        if not axis:
+            fields = self.metrica.histogram_fields(self._hash_field_id)
+
+            for key, tp_id in self.metrica.date_axis.iterate(self):
+                keys.append(key)
+                requests.append((u'%s:%s:__histogram__' % (prefix, tp_id), tp_id, fields))
+        else:
+            hash_key = u'%s:__histogram__' % self._hash_key
+
+            for key in self._choices(axis):
+                keys.append(key)
+                field = self.metrica.hash_field_id(**dict(self._filter, **{axis: key}))
+                requests.append((hash_key, self._tp_id, self.metrica.histogram_fields(field)))
+
+        rows = self._get_fields(requests, 1)
+        return zip(keys, [self.metrica.percentiles_from_counts(counts, percents) for counts in rows])
+
+    def timeserie_percentiles(self, since, until, scale=None, percents=(50, 95, 99)):
+        """Like timeserie(), but with percentiles of values (see percentiles())"""
+        prefix = self.metrica.key_prefix()
+        fields = self.metrica.histogram_fields(self._hash_field_id)
+        points, requests = [], []
+
+        for point, tp_id in self.metrica.date_axis.timeserie(since, until, scale):
+            points.append(point)
+            requests.append((u'%s:%s:__histogram__' % (prefix, tp_id), tp_id, fields))
+
+        rows = self._get_fields(requests, 1)
+        return zip(points, [self.metrica.percentiles_from_counts(counts, percents) for counts in rows])
+
+
+class HistogramMetrica(AveragedMetrica):
+    """
+    HistogramMetrica works like AveragedMetrica, but also counts values in log-scaled buckets,
+    so you can ask for .percentiles, e.g. 95th percentile of response times.
+
+    Bucket n counts values (multiplied) from 2 ** ((n - 1) / buckets_per_octave) up to the next bucket,
+    bucket 0 counts values below 1. So with 8 buckets per octave percentiles are within 4.5%.
+    Buckets are fields "<hash field id>:<n>" of "<hash key>:__histogram__" hashes.
+    """
+    values_class = HistogramMetricaValues
+    hash_key_postfixes = ('', ':__len__', ':__histogram__')
+
+    def __init__(self, name, axes, buckets_per_octave=8, max_value=None, **kwargs):
+        """
+        buckets_per_octave - more buckets are more precise, but take more memory
+        max_value - greater values are counted in the last bucket. default: 2 ** 31 (multiplied)
+        other arguments are the same as Metrica ones, except for lua_kick, which is not supported
+        """
+        if kwargs.get('lua_kick'):
+            raise ValueError(u'Invalid lua_kick: HistogramMetrica buckets are computed by the client')
+
+        super(HistogramMetrica, self).__init__(name, axes, **kwargs)
+        self.buckets_per_octave = buckets_per_octave
+
+        max_value = self.multiplier * max_value if max_value else 2 ** 31
+        self.buckets = self._log_bucket(max_value) + 1
+
+    def bucket(self, value):
+        """A number of the bucket of a (multiplied) value"""
+        return min(self._log_bucket(value), self.buckets - 1)
+
+    def _log_bucket(self, value):
+        if value < 1:
+            return 0
+
+        return int(math.floor(math.log(value, 2) * self.buckets_per_octave)) + 1
+
+    def bucket_value(self, n):
+        """A value (divided back) representing a bucket, its geometric middle"""
+        if n == 0:
+            return 0
+
+        return 2 ** ((n - 0.5) / self.buckets_per_octave) / self.multiplier
+
+    def histogram_fields(self, hash_field_id):
+        return [u'%s:%d' % (hash_field_id, n) for n in xrange(self.buckets)]
+
+    def percentiles_from_counts(self, counts, percents):
+        """Percentiles of values counted in buckets, None if there are no values"""
+        total = sum(counts)
+        result = {}
+
+        for percent in percents:
+            if not total:
+                result[percent] = None
+                continue
+
+            rank = max(int(math.ceil(total * percent / 100.0)), 1)
+            seen = 0
+
+            for n, count in enumerate(counts):
+                seen += count
+                if seen >= rank:
+                    result[percent] = self.bucket_value(n)
+                    break
+
+        return result
+
+    def _increment_many(self, pipe, hash_key, hash_field_ids, value):
+        keys = super(HistogramMetrica, self)._increment_many(pipe, hash_key, hash_field_ids, value)
+
+        # histograms expire with their hashes
+        bucket = u':%d' % self.bucket(value)
+        return keys + self.layout.hincrby_many(pipe, u'%s:__histogram__' % hash_key,
+                                               [hash_field_id + bucket for hash_field_id in hash_field_ids], 1)
+
+
+class UniqueMetricaValues(MetricaValues):
+    def unique(self, since=None, until=None, scale=None):
+        """
+        Distinct uids count in the subset (approximate, the standard error is 0.81%).
+        since, until - count distinct uids of a time range instead, e.g. of the last 30 days
+        """
+        if since is None:
+            tp_ids = [self._tp_id]
+        else:
+            tp_ids = [tp_id for point, tp_id in self.metrica.date_axis.timeserie(since, until, scale)]
+
+        keys = []
+        for tp_id in tp_ids:
+            keys.extend(self._uniques_keys(tp_id, self._hash_field_id))
+
+        return self._count_union(keys)
+
+    def iterate_unique(self, axis=None):
+        """Like iterate(), but with distinct uids counts"""
+        if not axis:
+            keys, requests = [], []
+
+            for key, tp_id in self.metrica.date_axis.iterate(self):
+                keys.append(key)
+                requests.append((tp_id, self._hash_field_id))
+
+            return zip(keys, self._count_uniques(requests))
+
+        keys = self._choices(axis)
+        requests = [(self._tp_id, self.metrica.hash_field_id(**dict(self._filter, **{axis: key}))) for key in keys]
+
+        return zip(keys, self._count_uniques(requests))
+
+    def timeserie_unique(self, since, until, scale=None):
+        """Like timeserie(), but with distinct uids counts"""
+        points, requests = [], []
+
+        for point, tp_id in self.metrica.date_axis.timeserie(since, until, scale):
+            points.append(point)
+            requests.append((tp_id, self._hash_field_id))
+
+        return zip(points, self._count_uniques(requests))
+
+    def _count_uniques(self, requests):
+        """requests - a list of (tp_id, field). Returns a list of distinct uids counts, read in one pipeline"""
+        redis = self.metrica.redis
+        sharded = getattr(redis, 'sharded', False)
+        pipe = redis.pipeline(transaction=False)
+        counts = []
+
+        for tp_id, field in requests:
+            keys = self._uniques_keys(tp_id, field)
+
+            # HyperLogLogs of different nodes are merged by ShardedRedis, one request at a time.
+            # The others are counted in a pipeline of their node
+            if len(keys) > PFCOUNT_CHUNK_SIZE or sharded and len(set(map(redis.node_n, keys))) > 1:
+                counts.append(self._count_union(keys))
+            else:
+                pipe.pfcount(*keys)
+                counts.append(None)
+
+        results = iter(pipe.execute() if len(pipe) else [])
+        return [next(results) if count is None else count for count in counts]
+
+    def _count_union(self, keys):
+        """
+        Distinct uids count of the union of HyperLogLogs. PFCOUNT of several keys counts it,
+        but lots of keys (a year of minutes) are merged into a temporary key chunk by chunk first
+        """
+        redis = self.metrica.redis
+
+        if len(keys) <= PFCOUNT_CHUNK_SIZE:
+            return redis.pfcount(*keys) if keys else 0
+
+        # it is kept on the node of the first key (see staste.sharding)
+        tmp_key = u'%s:__union__:%s' % (keys[0], uuid.uuid4().hex)
+
+        if getattr(redis, 'sharded', False):
+            try:
+                for start in xrange(0, len(keys), PFCOUNT_CHUNK_SIZE):
+                    redis.pfmerge(tmp_key, *keys[start:start + PFCOUNT_CHUNK_SIZE])
+                return redis.pfcount(tmp_key)
+            finally:
+                redis.delete(tmp_key)
+
+        # PFMERGE merges the destination key too
+        pipe = redis.pipeline(transaction=False)
+        for start in xrange(0, len(keys), PFCOUNT_CHUNK_SIZE):
+            pipe.pfmerge(tmp_key, *keys[start:start + PFCOUNT_CHUNK_SIZE])
+        pipe.pfcount(tmp_key)
+        pipe.delete(tmp_key)
+
+        return pipe.execute()[-2]
+
+    def _uniques_keys(self, tp_id, field):
+        """
+        Keys of HyperLogLogs to count the union of.
+        If the scale is not stored, finer ones are (and the compacted one, if it's there)
+        """
+        key = self.metrica.uniques_key(u'%s:%s' % (self.metrica.key_prefix(), tp_id), field)
+        [rollup_keys] = self._rollup_keys([(key, tp_id)])
+
+        return [key] + (rollup_keys or [])
+
+
+class UniqueMetrica(Metrica):
+    """
+    UniqueMetrica works like a normal metrica, but also counts distinct uids (e.g. user ids)
+    with HyperLogLogs, one for each counter (needs Redis 2.8.9+).
+    So you can ask for .unique, e.g. unique visitors of a page within an hour:
+
+        metrica.kick(uid=request.user.id, page='/')
+        metrica.timespan(year=2011, month=10, day=7, hour=3).filter(page='/').unique()
+
+    Every HyperLogLog takes up to 12kb, so keep the number of axes and date scales low.
+    """
+    values_class = UniqueMetricaValues
+    counts_uniques = True
+
+    def kick(self, value=1, date=None, uid=None, **kwargs):
+        """
+        Registers an event with parameters (for each of axis) for a uid.
+        Kicks without a uid are only summed up
+        """
+        date = date or datetime.datetime.now()
+        value = int(self.multiplier * value)
+
+        hash_field_id_parts, choices_sets_to_append = self._kick_parts(kwargs)
+        self._kick(value, date, self._date_scales(date), hash_field_id_parts, choices_sets_to_append, uid)
+
+    def _kick(self, value, date, date_scales, hash_field_id_parts, choices_sets_to_append, uid=None):
+        if uid is None:
+            return super(UniqueMetrica, self)._kick(value, date, date_scales, hash_field_id_parts,
+                                                    choices_sets_to_append)
+
+        # counters (or the kick script) and PFADDs of a kick go in one pipeline (or the buffer)
+        pipe = self._pipeline()
+        if self._kicks_with_lua():
+            self._kick_lua(value, date, date_scales, hash_field_id_parts, choices_sets_to_append, pipe)
+        else:
+            self._kick_pipeline(pipe, value, date, date_scales, hash_field_id_parts, choices_sets_to_append)
+
+        self._kick_uniques(pipe, uid, date_scales, hash_field_id_parts)
+        execute(pipe)
+
+    def _kick_event(self, pipe, event):
+        uid = event.pop('uid', None)
+        date_scales, hash_field_id_parts = super(UniqueMetrica, self)._kick_event(pipe, event)
+
+        if uid is not None:
+            self._kick_uniques(pipe, uid, date_scales, hash_field_id_parts)
+
+        return date_scales, hash_field_id_parts
+
+    def _kick_uniques(self, pipe, uid, date_scales, hash_field_id_parts):
+        hash_key_prefix = self.key_prefix()
+
+        for date_scale in date_scales:
+            if date_scale.id is None:
+                continue
+
+            hash_key = u'%s:%s' % (hash_key_prefix, date_scale.id)
+            for parts in self._field_id_products(hash_field_id_parts):
+                key = self.uniques_key(hash_key, u':'.join(parts))
+                pipe.pfadd(key, uid)
+
+                if date_scale.expiration:
+                    pipe.expire(key, date_scale.expiration)
 
-    def _increment(self, pipe, hash_key, hash_field_id, value):
-        super(AveragedMetrica, self)._increment(pipe, hash_key, hash_field_id, value)
-        pipe.hincrby(u'%s:__len__' % hash_key, hash_field_id, 1)
\ No newline at end of file
+    def uniques_key(self, hash_key, hash_field_id):
+        """A key of the HyperLogLog of a counter"""
+        return u'%s:__uniques__:%s' % (hash_key, hash_field_id)
@@ -1,12 +1,24 @@
 import time
 
-from staste.metrica import AveragedMetrica
+from django.conf import settings
+
+from staste.metrica import AveragedMetrica, HistogramMetrica
 from staste.axis import StoredChoiceAxis
+from staste.workers import KickQueue
+
+# STASTE_MIDDLEWARE_HISTOGRAM = True also counts response times in buckets,
+# so there are percentiles: response_time_metrica.percentiles() (averages are still there)
+metrica_class = HistogramMetrica if getattr(settings, 'STASTE_MIDDLEWARE_HISTOGRAM', False) else AveragedMetrica
+
+response_time_metrica = metrica_class('response_time_metrica',
+                                      [('view', StoredChoiceAxis()),
+                                       ('exception', StoredChoiceAxis())],
+                                      multiplier=10000)
 
-response_time_metrica = AveragedMetrica('response_time_metrica',
-                                        [('view', StoredChoiceAxis()),
-                                         ('exception', StoredChoiceAxis())],
-                                        multiplier=10000)
+# STASTE_MIDDLEWARE_KICK_QUEUE = {'maxsize': 10000, 'workers': 1, 'policy': 'drop'}
+# makes the middleware kick from background threads, so responses do not wait for Redis
+kick_queue_options = getattr(settings, 'STASTE_MIDDLEWARE_KICK_QUEUE', None)
+kick_queue = KickQueue(**kick_queue_options) if kick_queue_options is not None else None
 
 class ResponseTimeMiddleware(object):
     def process_request(self, request):
@@ -45,6 +57,10 @@ class ResponseTimeMiddleware(object):
         
         total_time = time.time() - request._staste_time_start
 
-        response_time_metrica.kick(value=total_time,
-                                   **request._staste_params)
+        if kick_queue is not None:
+            kick_queue.kick(response_time_metrica, value=total_time,
+                            **request._staste_params)
+        else:
+            response_time_metrica.kick(value=total_time,
+                                       **request._staste_params)
         
@@ -0,0 +1,329 @@
+"""
+Lua scripts executed inside Redis.
+
+Scripts are registered lazily (SCRIPT LOAD is sent when a script is called for the first time),
+so importing this module does not talk to Redis.
+They are not bound to a client: pass the client of a metrica (see staste.connections).
+
+Pipelines queue plain EVALSHA of scripts loaded before, instead of asking Redis for
+SCRIPT EXISTS on every execute() like redis-py does. Execute pipelines with scripts
+with execute(pipe), which runs their calls again if Redis has lost the scripts.
+"""
+import weakref
+import hashlib
+
+from redis import StrictRedis
+from redis.client import Script, BasePipeline
+from redis.exceptions import NoScriptError
+
+from staste.sharding import ShardedRedis, ShardedPipeline
+
+# commands which are sent again after script calls, when these are run again (see execute)
+TTL_COMMANDS = ('EXPIRE', 'PEXPIRE', 'EXPIREAT', 'PEXPIREAT')
+
+
+class LuaScript(Script):
+    """A redis-py Script which is always called with a client (or a pipeline)"""
+    by_sha = {}
+
+    def __init__(self, script):
+        self.registered_client = None
+        self.script = script
+        self.sha = hashlib.sha1(script).hexdigest()
+        self._loaded = weakref.WeakSet()  # connection pools of Redis instances which have the script
+        LuaScript.by_sha[self.sha] = self
+
+    def __call__(self, keys=[], args=[], client=None):
+        if client is None:
+            raise TypeError('A client is required to run a script')
+
+        # a pipeline which is executed later (see staste.batching.BatchPipeline)
+        pipe = getattr(client, 'pipeline', None)
+        if isinstance(pipe, BasePipeline):
+            client = pipe
+
+        if isinstance(client, BasePipeline):
+            self.load(client.connection_pool)
+            return client.evalsha(self.sha, len(keys), *(tuple(keys) + tuple(args)))
+
+        if isinstance(client, ShardedPipeline):
+            # loads scripts on nodes on execute()
+            client.scripts.add(self)
+        elif isinstance(client, ShardedRedis):
+            # keys of a script should be on one node
+            client = client.nodes[client.node_for_command('evalsha', (self.sha, len(keys)) + tuple(keys))]
+
+        return super(LuaScript, self).__call__(keys, args, client)
+
+    def load(self, connection_pool):
+        """Loads the script into the Redis of a connection pool, if it's not there yet"""
+        if connection_pool not in self._loaded:
+            StrictRedis(connection_pool=connection_pool).script_load(self.script)
+            self._loaded.add(connection_pool)
+
+
+def execute(pipe):
+    """
+    pipe.execute() of a pipeline with scripts. If Redis has lost them (it was restarted,
+    or SCRIPT FLUSH was there), they are loaded again and their calls are run again
+    """
+    if not isinstance(pipe, BasePipeline):
+        return pipe.execute()
+
+    commands = [args for args, options in pipe.command_stack]
+    results = pipe.execute(raise_on_error=False)
+
+    failed = [n for n, result in enumerate(results)
+              if isinstance(result, NoScriptError) and commands[n][1] in LuaScript.by_sha]
+    if failed:
+        _run_again(pipe.connection_pool, commands, results, failed)
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    return results
+
+
+def _run_again(connection_pool, commands, results, failed):
+    """
+    Runs failed script calls of a pipeline again, once their scripts are loaded.
+    Commands after the first of them have run already, but TTLs they set could be set
+    before keys of scripts were there, so these are sent again (in the same order)
+    """
+    for sha in set(commands[n][1] for n in failed):
+        script = LuaScript.by_sha[sha]
+        script._loaded.discard(connection_pool)
+        script.load(connection_pool)
+
+    pipe = StrictRedis(connection_pool=connection_pool).pipeline(transaction=False)
+    again = []
+
+    for n in xrange(failed[0], len(commands)):
+        if n in failed or commands[n][0].upper() in TTL_COMMANDS:
+            pipe.execute_command(*commands[n])
+            again.append(n)
+
+    for n, result in zip(again, pipe.execute(raise_on_error=False)):
+        results[n] = result
+
+
+# Space-Saving: a sorted set keeps up to `top` members, and a new member takes
+# the place (and the score) of the lightest one, so heavy members stay there
+# whatever the order they come in. Their scores can be overestimated, never underestimated.
+TOP_INCREMENT_LUA = """
+if redis.call('ZSCORE', key, member) or redis.call('ZCARD', key) < top then
+    redis.call('ZINCRBY', key, amount, member)
+else
+    local lightest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+    redis.call('ZREM', key, lightest[1])
+    redis.call('ZADD', key, tonumber(lightest[2]) + amount, member)
+end
+
+if expiration > 0 then
+    redis.call('EXPIRE', key, expiration)
+end
+"""
+
+# Expands the Cartesian product of axis field id parts for every date scale
+# inside Redis, so Metrica.kick() only ships O(axes + scales) arguments.
+#
+# ARGV layout:
+#   prefix, value, count,
+#   n_scales, (scale_id, expiration) * n_scales,
+#   n_axes, (n_parts, part * n_parts) * n_axes,
+#   n_masks, mask * n_masks,
+#   n_sets, now, (set_key, member, max_choices) * n_sets,
+#   n_tops, (axis_n, axis_kw, top) * n_tops
+#
+# count is 1 for AveragedMetrica (bumps the ":__len__" hash too), 0 otherwise.
+# masks are bit masks of axes to materialize values of (see Metrica combinations),
+# other axes get only their first part (ALL). No masks means the whole product.
+# max_choices is 0 for plain choices sets, otherwise they are sorted sets
+# scored by the date of the last kick (now, a timestamp) and trimmed to max_choices members.
+# tops are axes keeping sorted sets of their heaviest values (see StoredChoiceAxis top).
+KICK_LUA = """
+local function top_increment(key, member, amount, top, expiration)
+""" + TOP_INCREMENT_LUA + """
+end
+
+local prefix = ARGV[1]
+local value = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local i = 4
+
+local scales = {}
+local n_scales = tonumber(ARGV[i])
+i = i + 1
+for s = 1, n_scales do
+    scales[s] = {ARGV[i], tonumber(ARGV[i + 1])}
+    i = i + 2
+end
+
+local axes = {}
+local n_axes = tonumber(ARGV[i])
+i = i + 1
+for a = 1, n_axes do
+    local n_parts = tonumber(ARGV[i])
+    local parts = {}
+    for p = 1, n_parts do
+        parts[p] = ARGV[i + p]
+    end
+    axes[a] = parts
+    i = i + n_parts + 1
+end
+
+local function product(mask)
+    local fields = {''}
+    for a = 1, n_axes do
+        local parts = axes[a]
+        local first, last = 1, #parts
+        if mask then
+            if math.floor(mask / 2 ^ (a - 1)) % 2 == 1 then
+                first = 2
+            else
+                last = 1
+            end
+        end
+        local expanded = {}
+        for _, field in ipairs(fields) do
+            for p = first, last do
+                if a == 1 then
+                    expanded[#expanded + 1] = parts[p]
+                else
+                    expanded[#expanded + 1] = field .. ':' .. parts[p]
+                end
+            end
+        end
+        fields = expanded
+    end
+    return fields
+end
+
+local fields
+local n_masks = tonumber(ARGV[i])
+i = i + 1
+if n_masks == 0 then
+    fields = product(nil)
+else
+    fields = {}
+    for m = 1, n_masks do
+        for _, field in ipairs(product(tonumber(ARGV[i]))) do
+            fields[#fields + 1] = field
+        end
+        i = i + 1
+    end
+end
+
+for _, scale in ipairs(scales) do
+    local hash_key = prefix .. ':' .. scale[1]
+    for _, field in ipairs(fields) do
+        redis.call('HINCRBY', hash_key, field, value)
+        if count ~= 0 then
+            redis.call('HINCRBY', hash_key .. ':__len__', field, count)
+        end
+    end
+    if scale[2] > 0 then
+        redis.call('EXPIRE', hash_key, scale[2])
+        if count ~= 0 then
+            redis.call('EXPIRE', hash_key .. ':__len__', scale[2])
+        end
+    end
+end
+
+local n_sets = tonumber(ARGV[i])
+local now = ARGV[i + 1]
+i = i + 2
+for s = 1, n_sets do
+    local set_key = prefix .. ':' .. ARGV[i]
+    local max_choices = tonumber(ARGV[i + 2])
+    if max_choices > 0 then
+        redis.call('ZADD', set_key, now, ARGV[i + 1])
+        redis.call('ZREMRANGEBYRANK', set_key, 0, -max_choices - 1)
+    else
+        redis.call('SADD', set_key, ARGV[i + 1])
+    end
+    i = i + 3
+end
+
+local n_tops = tonumber(ARGV[i])
+i = i + 1
+for t = 1, n_tops do
+    local parts = axes[tonumber(ARGV[i])]
+    local top = tonumber(ARGV[i + 2])
+    if #parts > 1 then
+        for _, scale in ipairs(scales) do
+            local top_key = prefix .. ':' .. scale[1] .. ':__top__:' .. ARGV[i + 1]
+            top_increment(top_key, parts[2], value, top, scale[2])
+        end
+    end
+    i = i + 3
+end
+
+return #fields * n_scales
+"""
+
+kick_script = LuaScript(KICK_LUA)
+
+
+# Bumps a member of a top sorted set (see StoredChoiceAxis top and TOP_INCREMENT_LUA)
+#
+# KEYS: the sorted set
+# ARGV: member, amount, top, expiration
+TOP_LUA = """
+local key, member = KEYS[1], ARGV[1]
+local amount, top, expiration = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+""" + TOP_INCREMENT_LUA
+
+top_script = LuaScript(TOP_LUA)
+
+
+# Reads fields of a date scale which is not stored by kick() (see Metrica stored_scales)
+# summing them up from finer scales. If the hash exists (it's compacted), it is read instead.
+#
+# KEYS: the hash, then finer hashes to sum up
+# ARGV: fields
+# Returns {1, values of the hash} if it exists, {0, sums} otherwise
+ROLLUP_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return {1, redis.call('HMGET', KEYS[1], unpack(ARGV))}
+end
+
+local sums = {}
+for f = 1, #ARGV do
+    sums[f] = 0
+end
+
+for k = 2, #KEYS do
+    local values = redis.call('HMGET', KEYS[k], unpack(ARGV))
+    for f = 1, #ARGV do
+        if values[f] then
+            sums[f] = sums[f] + tonumber(values[f])
+        end
+    end
+end
+
+return {0, sums}
+"""
+
+rollup_script = LuaScript(ROLLUP_LUA)
+
+
+# Gives a value of an axis a code (see staste.encoding.ValueCodes), or returns the one it has.
+# Codes are 1, 2, 3... in the order values come in
+#
+# KEYS: value => code hash, code => value hash
+# ARGV: value
+CODE_LUA = """
+local code = redis.call('HGET', KEYS[1], ARGV[1])
+if code then
+    return code
+end
+
+code = tostring(redis.call('HLEN', KEYS[2]) + 1)
+redis.call('HSET', KEYS[1], ARGV[1], code)
+redis.call('HSET', KEYS[2], code, ARGV[1])
+return code
+"""
+
+code_script = LuaScript(CODE_LUA)
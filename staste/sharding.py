@@ -0,0 +1,284 @@
+"""
+Client-side sharding of metricas across several Redis nodes.
+
+ShardedRedis looks like a Redis client, but sends every command to the node its key
+belongs to, by consistent hashing. Keys of a hash ("<prefix>:<name>:<tp_id>") and keys
+kept next to it (":__len__", ":__uniques__:...", ":__top__:..." and such) are on the same node.
+Choices sets and the years set are just keys, so they are routed the same way.
+
+Pipelines are split into a pipeline per node, executed in parallel by a pool of threads
+(started once in a process, see ShardedRedis workers).
+
+    STASTE_REDIS_CONNECTIONS = {
+        'default': {'host': 'localhost'},
+        'sharded': {'shards': [{'port': 6380}, {'port': 6381}, {'host': 'redis3', 'name': 'third'}],
+                    'max_connections': 20},
+    }
+
+    metrica = Metrica(name='hot_stuff', axes=[...], using='sharded')
+
+Nodes are named by host, port and db (or 'name'), so the order of shards does not matter,
+and adding a node moves only about 1/N of keys (they are not moved for you, though).
+
+Commands with keys on different nodes raise ValueError. So date scales which are not stored
+(see Metrica stored_scales) are summed up by the client, and lua_kick is not used.
+PFCOUNT, PFMERGE and ZUNIONSTORE (of unique(), iterate_top() and compaction) are the exception:
+keys of other nodes are copied next to the first key (or the destination) to merge them there.
+"""
+import os
+import re
+import uuid
+import bisect
+import hashlib
+import threading
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from redis import StrictRedis
+
+VIRTUAL_NODES = 160
+WORKERS_PER_NODE = 4
+COPY_TTL = 60 * 1000  # milliseconds, copies of keys of other nodes are deleted anyway
+
+# postfixes of keys kept on the node of their hash
+ROUTING_KEY_RE = re.compile(
+    r':__(?:len|histogram|uniques|top|compacting|union|codes|bucket|packed|migrating)__(?::|$)')
+
+# commands with more than one key: command => a function returning keys of args
+MULTI_KEY_COMMANDS = {
+    'delete': lambda args: args,
+    'pfcount': lambda args: args,
+    'pfmerge': lambda args: args,
+    'rename': lambda args: args[:2],
+    'zunionstore': lambda args: [args[0]] + list(args[1]),
+    'evalsha': lambda args: args[2:2 + int(args[1])],
+}
+
+
+def routing_key(key):
+    """The part of a key which tells its node: "<prefix>:<name>:<tp_id>" for all keys of a hash"""
+    match = ROUTING_KEY_RE.search(key)
+    return key[:match.start()] if match else key
+
+
+class ShardedRedis(object):
+    sharded = True
+
+    def __init__(self, shards, virtual_nodes=VIRTUAL_NODES, workers=None, **defaults):
+        """
+        shards - a list of StrictRedis keyword arguments (or clients) of nodes.
+        'name' names a node in the ring, host:port/db by default
+        workers - threads executing pipelines of nodes, shared by threads of the process.
+        default: WORKERS_PER_NODE for a node
+        defaults - keyword arguments for every node, like max_connections
+        """
+        self.nodes = []
+        names = []
+
+        for shard in shards:
+            if isinstance(shard, StrictRedis):
+                kwargs = shard.connection_pool.connection_kwargs
+                names.append(kwargs.get('path') or '%s:%s/%s' % (kwargs.get('host'), kwargs.get('port'),
+                                                                 kwargs.get('db', 0)))
+                self.nodes.append(shard)
+                continue
+
+            config = dict(defaults, **shard)
+            name = config.pop('name', None) or config.get('unix_socket_path') or '%s:%s/%s' % (
+                config.get('host', 'localhost'), config.get('port', 6379), config.get('db', 0))
+            names.append(name)
+            self.nodes.append(StrictRedis(**config))
+
+        if len(set(names)) != len(names):
+            raise ValueError(u'Invalid shards: {}, their names should be unique'.format(names))
+
+        ring = sorted((self._hash(u'%s#%d' % (name, n)), node_n)
+                      for node_n, name in enumerate(names) for n in xrange(virtual_nodes))
+        self._ring_hashes = [h for h, node_n in ring]
+        self._ring_nodes = [node_n for h, node_n in ring]
+
+        self.workers = workers or WORKERS_PER_NODE * len(self.nodes)
+        self._pool = self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def node_n(self, key):
+        """A number of the node a key is kept in"""
+        n = bisect.bisect(self._ring_hashes, self._hash(routing_key(key))) % len(self._ring_hashes)
+        return self._ring_nodes[n]
+
+    def node_for_command(self, command, args):
+        keys = MULTI_KEY_COMMANDS.get(command, lambda args: args[:1])(args)
+        nodes = set(self.node_n(key) for key in keys)
+
+        if len(nodes) != 1:
+            raise ValueError(u'Invalid keys of {}: {}, they should be on one node'.format(command, keys))
+
+        return nodes.pop()
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def pool(self):
+        """Threads executing pipelines of nodes. A forked process does not have them, so it starts its own"""
+        if self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool_pid != os.getpid():
+                    self._pool = ThreadPool(self.workers)
+                    self._pool_pid = os.getpid()
+
+        return self._pool
+
+    def keys(self, pattern='*'):
+        return [key for node in self.nodes for key in node.keys(pattern)]
+
+    def script_load(self, script):
+        return [node.script_load(script) for node in self.nodes][0]
+
+    def pfcount(self, *keys):
+        node, keys, copies = self._gather(keys[0], keys)
+        try:
+            return node.pfcount(*keys)
+        finally:
+            self._drop(node, copies)
+
+    def pfmerge(self, dest, *sources):
+        node, sources, copies = self._gather(dest, sources)
+        try:
+            # merging a key into itself makes an empty HyperLogLog, as missing keys do
+            return node.pfmerge(dest, *(sources or [dest]))
+        finally:
+            self._drop(node, copies)
+
+    def zunionstore(self, dest, keys, aggregate=None):
+        node, keys, copies = self._gather(dest, keys)
+        try:
+            if not keys:
+                node.delete(dest)
+                return 0
+
+            return node.zunionstore(dest, keys, aggregate)
+        finally:
+            self._drop(node, copies)
+
+    def _gather(self, key, keys):
+        """
+        Copies keys of other nodes (with DUMP and RESTORE) to the node of a key.
+        Returns the node, keys to use there instead and copies to delete afterwards.
+        Keys which do not exist are not copied
+        """
+        node_n = self.node_n(key)
+        others = defaultdict(list)
+        here = []
+
+        for k in keys:
+            if self.node_n(k) == node_n:
+                here.append(k)
+            else:
+                others[self.node_n(k)].append(k)
+
+        node = self.nodes[node_n]
+        copies = []
+        restore = node.pipeline(transaction=False)
+
+        for other_n, other_keys in others.iteritems():
+            pipe = self.nodes[other_n].pipeline(transaction=False)
+            for k in other_keys:
+                pipe.dump(k)
+
+            for dump in pipe.execute():
+                if dump is not None:
+                    # "<key>:__union__:..." is on the node of the key
+                    copy = u'%s:__union__:%s' % (key, uuid.uuid4().hex)
+                    restore.restore(copy, COPY_TTL, dump)
+                    copies.append(copy)
+
+        if copies:
+            restore.execute()
+
+        return node, here + copies, copies
+
+    def _drop(self, node, copies):
+        if copies:
+            node.delete(*copies)
+
+    def __getattr__(self, command):
+        def execute(*args, **kwargs):
+            return getattr(self.nodes[self.node_for_command(command, args)], command)(*args, **kwargs)
+
+        return execute
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class ShardedPipeline(object):
+    """Queues commands into a pipeline per node, executed in parallel (see ShardedRedis.pool)"""
+
+    def __init__(self, sharded, transaction=True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.scripts = set()  # staste.scripts.LuaScript adds scripts to load on nodes
+        self._reset()
+
+    def _reset(self):
+        self._pipes = {}
+        self._order = []  # (node number, number of the command in the node pipeline)
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            node_n = self.sharded.node_for_command(command, args)
+
+            if node_n not in self._pipes:
+                self._pipes[node_n] = self.sharded.nodes[node_n].pipeline(transaction=self.transaction)
+
+            pipe = self._pipes[node_n]
+            getattr(pipe, command)(*args, **kwargs)
+            self._order.append((node_n, len(pipe) - 1))
+            return self
+
+        return queue
+
+    def __len__(self):
+        return len(self._order)
+
+    def execute(self):
+        from staste.scripts import execute as execute_pipeline
+
+        pipes, order = self._pipes, self._order
+        self._reset()
+
+        # loaded once for a node, see staste.scripts.LuaScript
+        for pipe in pipes.itervalues():
+            for script in self.scripts:
+                script.load(pipe.connection_pool)
+
+        if not pipes:
+            return []
+
+        results = {}
+        errors = []
+
+        # the first pipeline is executed by this thread, while the pool executes the others
+        items = pipes.items()
+        node_n, pipe = items[0]
+        pending = [(other_n, self.sharded.pool().apply_async(execute_pipeline, (other,)))
+                   for other_n, other in items[1:]]
+
+        try:
+            results[node_n] = execute_pipeline(pipe)
+        except Exception as e:
+            errors.append(e)
+
+        for other_n, result in pending:
+            try:
+                results[other_n] = result.get()
+            except Exception as e:
+                errors.append(e)
+
+        if errors:
+            raise errors[0]
+
+        return [results[node_n][n] for node_n, n in order]
@@ -1,12 +1,28 @@
 # coding: utf-8
+import time
+import random
+import logging
 import datetime
+import threading
 
 from django.test import TestCase
 from django.conf import settings
 
 from staste import redis
-from staste.metrica import Metrica, AveragedMetrica
+from staste import metrica as metrica_module
+from staste.metrica import Metrica, AveragedMetrica, UniqueMetrica, HistogramMetrica
 from staste.axis import Axis, StoredChoiceAxis, HierarchicalAxis
+from staste.buffer import KickBuffer
+from staste.workers import KickQueue
+from staste.futures import AsyncMetrica
+from staste.dateaxis import DATE_AXIS
+from staste.cache import ResultCache
+from staste.compaction import compact
+from staste.connections import connections
+from staste.encoding import migrate
+from staste.layout import BucketedLayout, PackedLayout, memory_stats
+from staste.batching import batch
+from staste.scripts import top_script, execute as execute_pipeline
 
 
 def dtt(*args, **kwargs):
@@ -38,6 +54,25 @@ class TestStatsApi(TestCase):
     def tearDown(self):
         self.removeAllKeys()
         settings.STASTE_METRICS_PREFIX = self.old_prefix
+
+    def configureConnection(self, alias, **kwargs):
+        """connections.configure() for a test, the alias is put back as it was when the test is over"""
+        configs, clients = connections._configs, connections._clients
+        config, client = configs.get(alias), clients.get(alias)
+        configured = alias in configs
+
+        def restore():
+            with connections._lock:
+                clients.pop(alias, None)
+                configs.pop(alias, None)
+                if configured:
+                    configs[alias] = config
+                if client is not None:
+                    clients[alias] = client
+
+        self.addCleanup(restore)
+        connections.configure(alias, **kwargs)
+        return connections.get(alias)
             
     def testTheSimplestCase(self):
         # so we want to count my guests
@@ -298,4 +333,974 @@ class TestStatsApi(TestCase):
         self.assertEqual(
             metrica.filter(id=id1, label=('exp', 'city')).iterate('label'),
             [(('exp', 'city', 'all'), 2), (('exp', 'city', 'tag'), 2)]
-        )
\ No newline at end of file
+        )
+
+    def testLuaKick(self):
+        axes = [('gender', Axis(choices=['boy', 'girl'])), ('age', StoredChoiceAxis())]
+        plain = AveragedMetrica(name='plain_kick', axes=axes, multiplier=100)
+        lua = AveragedMetrica(name='lua_kick', axes=axes, multiplier=100, lua_kick=True)
+
+        for metrica in (plain, lua):
+            metrica.kick(date=dtt(2010, 2, 7), value=2.5, gender='boy', age=17)
+            metrica.kick(date=dtt(2010, 2, 7, 10), value=1, gender='girl', age=18)
+            metrica.kick(date=dtt(2011, 3, 1), value=4, gender='girl')
+
+        for metrica in (plain, lua):
+            self.assertEquals(metrica.total(), 7.5)
+            self.assertEquals(metrica.count(), 3)
+            self.assertEquals(metrica.filter(gender='girl').timespan(year=2010).total(), 1)
+            self.assertEquals(set(metrica.iterate('age')), set([('17', 2.5), ('18', 1)]))
+            self.assertEquals(set(metrica.iterate()), set([(2010, 3.5), (2011, 4)]))
+
+        plain_keys = set(k.split(':', 2)[2] for k in redis.keys(plain.key_prefix() + ':*'))
+        lua_keys = set(k.split(':', 2)[2] for k in redis.keys(lua.key_prefix() + ':*'))
+        self.assertEquals(plain_keys, lua_keys)
+
+        # expirations are set like in a pipelined kick
+        minute_key = u'%s:year:2010:month:2:day:7:hour:10:minute:0' % lua.key_prefix()
+        self.assertTrue(redis.ttl(minute_key) > 0)
+
+    def testBufferedKick(self):
+        buffer = KickBuffer(max_delay=3600, max_events=5)
+        metrica = AveragedMetrica(name='buffered', axes=[('age', StoredChoiceAxis())], buffer=buffer)
+
+        for i in xrange(4):
+            metrica.kick(date=dtt(2010, 2, 7), value=2, age=17)
+
+        # nothing is sent yet
+        self.assertEquals(metrica.total(), 0)
+        self.assertEquals(metrica.choices('age'), [])
+
+        metrica.kick(date=dtt(2010, 2, 8), value=4, age=18)  # 5th kick flushes
+
+        self.assertEquals(metrica.total(), 12)
+        self.assertEquals(metrica.count(), 5)
+        self.assertEquals(metrica.timespan(year=2010, month=2, day=7).average(), 2)
+        self.assertEquals(set(metrica.iterate_counts('age')), set([('17', 4), ('18', 1)]))
+
+        metrica.kick(date=dtt(2010, 2, 8), value=1, age=19)
+        buffer.flush()
+        self.assertEquals(metrica.filter(age=19).total(), 1)
+
+    def testKickQueue(self):
+        metrica = Metrica(name='queued', axes=[('view', StoredChoiceAxis())])
+        queue = KickQueue(workers=2)
+
+        for i in xrange(10):
+            queue.kick(metrica, date=dtt(2010, 2, 7), view='index')
+        queue.join()
+
+        self.assertEquals(metrica.timespan(year=2010).total(), 10)
+        self.assertEquals(queue.stats(), {'queued': 0, 'kicked': 10, 'dropped': 0, 'failed': 0})
+
+    def testKickQueueDrops(self):
+        released = threading.Event()
+
+        class SlowMetrica(Metrica):
+            def kick(self, *args, **kwargs):
+                released.wait()
+                super(SlowMetrica, self).kick(*args, **kwargs)
+
+        metrica = SlowMetrica(name='queued_slow', axes=[])
+        queue = KickQueue(maxsize=2, workers=1)
+
+        for i in xrange(10):
+            queue.kick(metrica)
+
+        # one kick is being sent by the worker, two are waiting, the rest are dropped
+        self.assertTrue(queue.dropped >= 7)
+
+        released.set()
+        queue.join()
+        self.assertEquals(metrica.total(), 10 - queue.dropped)
+
+    def testKickMany(self):
+        axes = [('gender', Axis(choices=['boy', 'girl'])), ('age', StoredChoiceAxis())]
+        one_by_one = AveragedMetrica(name='one_by_one', axes=axes, multiplier=100)
+        many = AveragedMetrica(name='many', axes=axes, multiplier=100)
+
+        def events():
+            for i in xrange(50):
+                yield {'date': dtt(2010, 2, 7 + i % 3, i % 24), 'value': i % 5,
+                       'gender': ('boy', 'girl')[i % 2], 'age': 17 + i % 4}
+
+        for event in events():
+            one_by_one.kick(**event)
+
+        self.assertEquals(many.kick_many(events(), chunk_size=20, pipeline_size=7), 50)
+
+        for metrica in (one_by_one, many):
+            self.assertEquals(metrica.total(), 100)
+            self.assertEquals(metrica.count(), 50)
+            self.assertEquals(metrica.filter(gender='girl').timespan(year=2010, month=2, day=8).count(), 9)
+            self.assertEquals(set(metrica.iterate_counts('age')),
+                              set([('17', 13), ('18', 13), ('19', 12), ('20', 12)]))
+
+        one_by_one_keys = set(k.split(':', 2)[2] for k in redis.keys(one_by_one.key_prefix() + ':*'))
+        many_keys = set(k.split(':', 2)[2] for k in redis.keys(many.key_prefix() + ':*'))
+        self.assertEquals(one_by_one_keys, many_keys)
+
+    def testAsyncMetrica(self):
+        metrica = AveragedMetrica(name='async', axes=[('c', Axis(choices=['a', 'b']))])
+        async_metrica = AsyncMetrica(metrica)
+
+        futures = [async_metrica.kick(date=dtt(2010, 2, 7), value=v, c=c)
+                   for v, c in [(1, 'a'), (3, 'a'), (5, 'b')]]
+        for future in futures:
+            future.result()
+
+        # async writers and sync readers (and vice versa) share the same data
+        self.assertEquals(metrica.total(), 9)
+        metrica.kick(date=dtt(2010, 2, 8), value=1, c='b')
+
+        self.assertEquals(async_metrica.total().result(), 10)
+        self.assertEquals(async_metrica.filter(c='a').average().result(), 2)
+        self.assertEquals(async_metrica.timespan(year=2010, month=2).iterate().result()[6:8], [(7, 9), (8, 1)])
+        self.assertEquals(async_metrica.iterate_averages('c').result(), [('a', 2), ('b', 3)])
+        self.assertEquals(async_metrica.choices('c').result(), ['a', 'b'])
+
+    def testTimeserieBy(self):
+        metrica = Metrica(name='timeserie_by', axes=[('gender', Axis(choices=['boy', 'girl'])),
+                                                    ('age', StoredChoiceAxis())])
+
+        for hours_ago, gender, age in [(1, 'boy', 17), (1, 'girl', 18), (2, 'girl', 18), (5, 'boy', 19)]:
+            metrica.kick(date=dtm(hours=hours_ago), gender=gender, age=age)
+
+        since, until = dtm(hours=6), dtm()
+        points, choices, columns = metrica.filter(gender='girl').timeserie_by('age', since, until, 'hour')
+
+        self.assertEquals(choices, metrica.choices('age'))
+        for choice, column in zip(choices, columns):
+            self.assertEquals(zip(points, column),
+                              metrica.filter(gender='girl', age=choice).timeserie(since, until, 'hour'))
+
+        points, choices, columns = metrica.timeserie_by('gender', since, until, 'hour', choices=[None, 'boy'])
+        self.assertEquals(sum(columns[0]), 4)
+        self.assertEquals(sum(columns[1]), 2)
+        self.assertEquals(zip(points, columns[0]), metrica.timeserie(since, until, 'hour'))
+
+    def testIterateAll(self):
+        metrica = Metrica(name='iterate_all', axes=[
+            ('gender', Axis(choices=['boy', 'girl'])),
+            ('label', HierarchicalAxis()),
+            ('age', StoredChoiceAxis()),
+        ])
+
+        metrica.kick(date=dtt(2010, 2, 7), gender='boy', label=('a', 'b'), age=17)
+        metrica.kick(date=dtt(2010, 2, 7), gender='girl', label=('a', 'c'), age=18)
+        metrica.kick(date=dtt(2010, 2, 7), gender='girl', label=('a', 'c', 'd'), age=18)
+        metrica.kick(date=dtt(2010, 2, 8), gender='girl', label=('e',), age=19)
+
+        for values in (metrica.values(), metrica.filter(gender='girl'),
+                       metrica.timespan(year=2010, month=2, day=7).filter(label=('a',))):
+            iterated = set((k, v) for k, v in values.iterate('age') if v)
+            self.assertEquals(set(values.iterate_all('age')), iterated)
+
+        self.assertEquals(set(metrica.iterate_all('label')), set([(('a',), 3), (('e',), 1)]))
+        self.assertEquals(set(metrica.filter(label=('a',)).iterate_all('label')),
+                          set([(('a', 'b'), 1), (('a', 'c'), 2)]))
+        self.assertEquals(set(metrica.filter(age=18).iterate_all('gender')), set([('girl', 2)]))
+
+    def testTimeseriePoints(self):
+        from dateutil import rrule
+
+        freqs = {'day': rrule.DAILY, 'hour': rrule.HOURLY, 'minute': rrule.MINUTELY}
+        since = dtt(2011, 2, 27, 22, 58, 31)
+
+        for scale, freq in freqs.items():
+            for until in (since, dtt(2011, 3, 1, 0, 2, 30), dtt(2011, 3, 1, 0, 2, 31), dtt(2011, 2, 27)):
+                expected = [(scale, DATE_AXIS.scale_point(scale, p))
+                            for p in rrule.rrule(dtstart=since, until=until, freq=freq)]
+                self.assertEquals(list(DATE_AXIS.scale_timeserie(scale, since, until)), expected)
+
+        # plans are cached
+        until = dtm()
+        since = until - datetime.timedelta(hours=3)
+        plan = DATE_AXIS.timeserie(since, until, 'minute', now=until)
+        self.assertEquals(len(plan), 181)
+        self.assertTrue(DATE_AXIS.timeserie(since, until, 'minute', now=until) is plan)
+
+        # dates are not truncated to the minute
+        since = dtt(2011, 2, 27, 22, 58, 31)
+        until = dtt(2011, 2, 27, 23, 1, 30)
+        self.assertEquals([point for point, tp_id in DATE_AXIS.timeserie(since, until, 'minute', now=until)],
+                          [dtt(2011, 2, 27, 22, 58, 30), dtt(2011, 2, 27, 22, 59, 30), dtt(2011, 2, 27, 23, 0, 30)])
+
+    def testResultCache(self):
+        metrica = AveragedMetrica(name='cached', axes=[('c', Axis(choices=['a', 'b']))],
+                                  cache=ResultCache(open_timeout=0))
+
+        metrica.kick(date=dtt(2010, 2, 7), value=2, c='a')
+        metrica.kick(value=3, c='b')
+
+        closed = metrica.timespan(year=2010, month=2)
+        self.assertEquals(closed.total(), 2)
+        self.assertEquals(closed.iterate('c'), [('a', 2), ('b', 0)])
+        self.assertEquals(closed.iterate()[6], (7, 2))
+        self.assertEquals(closed.count(), 1)
+        self.assertEquals(metrica.total(), 5)
+
+        # a late kick: closed timespans are cached, open ones are not
+        metrica.kick(date=dtt(2010, 2, 7), value=2, c='b')
+        metrica.kick(value=3, c='b')
+
+        self.assertEquals(closed.total(), 2)
+        self.assertEquals(closed.iterate('c'), [('a', 2), ('b', 0)])
+        self.assertEquals(closed.iterate()[6], (7, 2))
+        self.assertEquals(closed.count(), 1)
+        self.assertEquals(closed.timespan(day=8).total(), 0)
+        self.assertEquals(metrica.total(), 10)
+        self.assertEquals(metrica.timespan(year=2010).total(), 4)
+
+        metrica.cache.clear()
+        self.assertEquals(closed.total(), 4)
+
+    def testTimespanEnd(self):
+        self.assertEquals(DATE_AXIS.timespan_end(), None)
+        self.assertEquals(DATE_AXIS.timespan_end(year=2011), dtt(2012, 1, 1))
+        self.assertEquals(DATE_AXIS.timespan_end(year=2011, month=12), dtt(2012, 1, 1))
+        self.assertEquals(DATE_AXIS.timespan_end(year=2011, month=2), dtt(2011, 3, 1))
+        self.assertEquals(DATE_AXIS.timespan_end(year=2011, month=2, day=28), dtt(2011, 3, 1))
+        self.assertEquals(DATE_AXIS.timespan_end(year=2011, month=2, day=28, hour=23, minute=59),
+                          dtt(2011, 3, 1))
+        self.assertEquals(DATE_AXIS.id_to_timespan('year:2011:month:2'), {'year': 2011, 'month': 2})
+
+    def testRetention(self):
+        metrica = Metrica(name='retention', axes=[], retention={'minute': '2h', 'hour': 0})
+        self.assertRaises(ValueError, Metrica, name='retention', axes=[], retention={'second': '1h'})
+        self.assertRaises(ValueError, Metrica, name='retention', axes=[], retention={'minute': '1 month'})
+
+        date = dtm(minutes=1)
+        metrica.kick(date=date)
+
+        date_ids = dict((date_scale.id.split(':')[-2], date_scale.id)
+                        for date_scale in metrica.date_axis.scales(date) if date_scale.id != '__all__')
+        self.assertTrue(0 < redis.ttl(u'%s:%s' % (metrica.key_prefix(), date_ids['minute'])) <= 2 * 60 * 60)
+        self.assertTrue(redis.ttl(u'%s:%s' % (metrica.key_prefix(), date_ids['hour'])) in (-1, None))
+        self.assertTrue(redis.ttl(u'%s:%s' % (metrica.key_prefix(), date_ids['day'])) > 0)
+
+        # minutes are only asked for the last two hours, hours before that
+        until = dtm()
+        points = metrica.date_axis.timeserie(until - datetime.timedelta(hours=4), until, 'minute', now=until)
+        self.assertEquals(len([tp_id for point, tp_id in points if 'minute' in tp_id]), 121)
+        self.assertEquals(len([tp_id for point, tp_id in points if 'minute' not in tp_id]), 3)
+
+    def testCombinations(self):
+        axes = [('gender', Axis(choices=['boy', 'girl'])), ('age', StoredChoiceAxis()), ('city', StoredChoiceAxis())]
+        self.assertRaises(ValueError, Metrica, name='combinations', axes=axes, combinations=[('height',)])
+
+        for lua_kick in (False, True):
+            metrica = Metrica(name='combinations_%s' % lua_kick, axes=axes, lua_kick=lua_kick,
+                              combinations=[('gender', 'age'), ('city',)])
+
+            metrica.kick(date=dtt(2010, 2, 7), gender='boy', age=17, city='Moscow')
+            metrica.kick(date=dtt(2010, 2, 7), gender='girl', age=17, city='Paris')
+            metrica.kick(date=dtt(2010, 2, 7), gender='girl', city='Paris')
+
+            self.assertEquals(metrica.total(), 3)
+            self.assertEquals(metrica.filter(gender='girl').total(), 2)
+            self.assertEquals(metrica.filter(gender='girl', age=17).total(), 1)
+            self.assertEquals(metrica.filter(city='Paris').total(), 2)
+            self.assertEquals(set(metrica.filter(gender='girl').iterate('age')), set([('17', 1)]))
+            self.assertEquals(set(metrica.iterate_all('city')), set([('Moscow', 1), ('Paris', 2)]))
+
+            self.assertRaises(ValueError, metrica.filter, gender='girl', city='Paris')
+            self.assertRaises(ValueError, metrica.filter(city='Paris').iterate, 'gender')
+            self.assertRaises(ValueError, metrica.filter(city='Paris').iterate_all, 'age')
+
+            # (), (gender), (age), (gender, age), (city)
+            fields = redis.hkeys(u'%s:__all__' % metrica.key_prefix())
+            self.assertEquals(len(fields), 1 + 2 + 1 + 2 + 2)
+
+    def testStoredScales(self):
+        self.assertRaises(ValueError, Metrica, name='rollup', axes=[], stored_scales=('day', 'hour'))
+
+        # months and years are summed up from days, which expire, hours from minutes
+        self.assertRaises(ValueError, Metrica, name='rollup', axes=[], stored_scales=('day', 'minute'))
+        self.assertRaises(ValueError, Metrica, name='rollup', axes=[], stored_scales=('day', 'minute'),
+                          retention={'day': 0})
+
+        axes = [('c', Axis(choices=['a', 'b']))]
+        kept = {'day': 0, 'minute': '14d'}
+        stored = AveragedMetrica(name='all_scales', axes=axes)
+        rolled = AveragedMetrica(name='rolled_up', axes=axes, stored_scales=('day', 'minute'), retention=kept)
+        rolled_lua = AveragedMetrica(name='rolled_up_lua', axes=axes, stored_scales=('day', 'minute'), retention=kept,
+                                     lua_kick=True)
+
+        dates = [dtm(minutes=5), dtm(minutes=65), dtm(hours=30), dtt(2010, 2, 7, 10), dtt(2010, 3, 1)]
+        for metrica in (stored, rolled, rolled_lua):
+            for n, date in enumerate(dates):
+                metrica.kick(date=date, value=n + 1, c='ab'[n % 2])
+
+        # hour, month and year hashes are not written
+        self.assertFalse(redis.exists(rolled.key_prefix() + ':year:2010:month:2:day:7:hour:10'))
+        self.assertFalse(redis.exists(rolled.key_prefix() + ':year:2010:month:2'))
+        self.assertFalse(redis.exists(rolled.key_prefix() + ':year:2010'))
+        self.assertEquals(set(rolled.iterate()), set(stored.iterate()))
+        self.assertEquals(set(k.split(':', 2)[2] for k in redis.keys(rolled.key_prefix() + ':*')),
+                          set(k.split(':', 2)[2] for k in redis.keys(rolled_lua.key_prefix() + ':*')))
+
+        now = dtm()
+        for metrica in (stored, rolled):
+            self.assertEquals(metrica.timespan(year=2010, month=2).total(), 4)
+            self.assertEquals(metrica.timespan(year=2010).count(), 2)
+            self.assertEquals(metrica.timespan(year=2010).filter(c='b').total(), 4)
+            self.assertEquals(metrica.timespan(year=2010, month=2, day=7, hour=10).total(), 4)
+            self.assertEquals(set(metrica.timespan(year=2010).iterate_all('c')), set([('a', 5), ('b', 4)]))
+
+        for values in (lambda m: m.values(), lambda m: m.timespan(year=now.year, month=now.month)):
+            self.assertEquals(values(rolled).iterate('c'), values(stored).iterate('c'))
+            self.assertEquals(values(rolled).iterate(), values(stored).iterate())
+
+        since = now - datetime.timedelta(hours=40)
+        self.assertEquals(rolled.timeserie(since, now, 'hour'), stored.timeserie(since, now, 'hour'))
+        self.assertEquals(list(rolled.timeserie_counts_and_averages(since, now, 'hour')),
+                          list(stored.timeserie_counts_and_averages(since, now, 'hour')))
+
+    def testCompaction(self):
+        axes = [('c', Axis(choices=['a', 'b']))]
+        stored = AveragedMetrica(name='all_scales', axes=axes)
+        rolled = AveragedMetrica(name='compacted', axes=axes, stored_scales=('day', 'minute'), compacted=True)
+
+        now = dtt(2011, 10, 7, 12, 20)
+        dates = [dtt(2011, 10, 7, 9, 10), dtt(2011, 10, 7, 10, 40), dtt(2011, 8, 28, 5)]
+        for metrica in (stored, rolled):
+            for n, date in enumerate(dates):
+                metrica.kick(date=date, value=n + 1, c='ab'[n % 2])
+
+        self.assertEquals(compact(stored, now), 0)
+        # two hours (and their ":__len__" hashes), and a month
+        self.assertEquals(compact(rolled, now), 6)
+        # it starts where it has stopped
+        self.assertEquals(compact(rolled, now), 0)
+
+        hour = dates[0].replace(minute=0, second=0, microsecond=0)
+        hour_id = DATE_AXIS.datetime_to_id('hour', hour)
+        self.assertTrue(redis.exists(u'%s:%s' % (rolled.key_prefix(), hour_id)))
+        self.assertTrue(redis.exists(u'%s:%s:__len__' % (rolled.key_prefix(), hour_id)))
+        self.assertTrue(redis.exists(u'%s:year:%d:month:%d' % (rolled.key_prefix(), dates[2].year, dates[2].month)))
+
+        # minutes can expire now
+        for key in redis.keys(rolled.key_prefix() + ':*:minute:*'):
+            redis.delete(key)
+
+        since = now - datetime.timedelta(hours=5)
+        until = now - datetime.timedelta(hours=1)
+        self.assertEquals(rolled.timeserie(since, until, 'hour'), stored.timeserie(since, until, 'hour'))
+        self.assertEquals(list(rolled.timeserie_counts_and_averages(since, until, 'hour')),
+                          list(stored.timeserie_counts_and_averages(since, until, 'hour')))
+        self.assertEquals(rolled.timespan(year=dates[2].year, month=dates[2].month).filter(c='a').total(), 3)
+
+    def testUniqueMetrica(self):
+        axes = [('page', StoredChoiceAxis())]
+        stored = UniqueMetrica(name='uniques', axes=axes)
+        rolled = UniqueMetrica(name='rolled_up_uniques', axes=axes, stored_scales=('day', 'minute'), compacted=True)
+        buffer = KickBuffer(max_delay=60, max_events=10 ** 6)
+        metricas = [stored, rolled, UniqueMetrica(name='uniques_lua', axes=axes, lua_kick=True),
+                    UniqueMetrica(name='uniques_buffered', axes=axes, buffer=buffer)]
+
+        now = dtm()
+        hour_ago = now - datetime.timedelta(hours=1)
+        for metrica in metricas:
+            for uid in xrange(100):
+                metrica.kick(uid=uid % 30, page='/', date=now)
+                metrica.kick(uid=uid % 20, page='/about', date=hour_ago)
+            metrica.kick(page='/')
+
+        # uids are buffered with their counters
+        self.assertEquals(metricas[3].unique(), 0)
+        buffer.flush()
+
+        # an hour of minutes is merged a few minutes at a time
+        chunk_size, metrica_module.PFCOUNT_CHUNK_SIZE = metrica_module.PFCOUNT_CHUNK_SIZE, 7
+        try:
+            for metrica in metricas:
+                self.assertEquals(metrica.total(), 201)
+                self.assertEquals(metrica.unique(), 30)
+                self.assertEquals(metrica.filter(page='/about').unique(), 20)
+                self.assertEquals(set(metrica.iterate_unique('page')), set([('/', 30), ('/about', 20)]))
+                self.assertEquals(metrica.timespan(year=now.year, month=now.month, day=now.day, hour=now.hour)
+                                  .filter(page='/about').unique(), 0)
+
+                serie = metrica.filter(page='/').timeserie_unique(now - datetime.timedelta(hours=3), now, 'hour')
+                self.assertEquals([count for point, count in serie], [0, 0, 0, 30])
+                self.assertEquals(metrica.unique(now - datetime.timedelta(hours=3), now, 'hour'), 30)
+        finally:
+            metrica_module.PFCOUNT_CHUNK_SIZE = chunk_size
+        self.assertFalse(redis.keys(rolled.key_prefix() + ':*:__union__*'))
+
+        # hours are merged from minutes
+        self.assertTrue(compact(rolled, now + datetime.timedelta(hours=2)) >= 2)
+        for key in redis.keys(rolled.key_prefix() + ':*:minute:*'):
+            redis.delete(key)
+        self.assertEquals(rolled.filter(page='/about').timeserie_unique(hour_ago, hour_ago, 'hour'),
+                          stored.filter(page='/about').timeserie_unique(hour_ago, hour_ago, 'hour'))
+
+    def testHistogramMetrica(self):
+        self.assertRaises(ValueError, HistogramMetrica, name='histogram', axes=[], lua_kick=True)
+
+        metrica = HistogramMetrica(name='histogram', axes=[('view', StoredChoiceAxis())], multiplier=10000)
+        now = dtm()
+
+        for n in xrange(1, 101):
+            metrica.kick(value=n / 1000.0, view='fast', date=now)
+            metrica.kick(value=n / 10.0, view='slow', date=now)
+
+        def assertClose(percentiles, expected):
+            for percent, value in expected.iteritems():
+                self.assertTrue(abs(percentiles[percent] - value) / value < 0.05, (percentiles, expected))
+
+        assertClose(metrica.filter(view='fast').percentiles(), {50: 0.05, 95: 0.095, 99: 0.099})
+        assertClose(metrica.percentiles((50, 99.5)), {50: 0.1, 99.5: 10})
+        self.assertEquals(metrica.count(), 200)
+
+        by_view = dict(metrica.iterate_percentiles('view'))
+        assertClose(by_view['slow'], {50: 5, 95: 9.5, 99: 9.9})
+        assertClose(by_view['fast'], {50: 0.05})
+
+        serie = metrica.filter(view='slow').timeserie_percentiles(now - datetime.timedelta(minutes=1), now, 'minute')
+        self.assertEquals(serie[0][1], {50: None, 95: None, 99: None})
+        assertClose(serie[1][1], {50: 5, 95: 9.5, 99: 9.9})
+
+        self.assertEquals(metrica.bucket(0), 0)
+        self.assertEquals(metrica.bucket(10 ** 12), metrica.buckets - 1)
+
+    def testIterateTop(self):
+        axes = lambda: [('url', StoredChoiceAxis(top=5)), ('gender', Axis(choices=['boy', 'girl']))]
+        buffer = KickBuffer(max_delay=60, max_events=10 ** 6)
+        metricas = [Metrica(name='top', axes=axes()),
+                    Metrica(name='top_lua', axes=axes(), lua_kick=True),
+                    Metrica(name='top_buffered', axes=axes(), buffer=buffer),
+                    Metrica(name='top_rolled_up', axes=axes(), stored_scales=('day', 'minute'), compacted=True)]
+
+        self.assertRaises(ValueError, metricas[0].iterate_top, 'gender')
+
+        # a and b are heavy enough to be kept whatever the order is
+        urls = ['/a'] * 10 + ['/b'] * 6 + ['/c'] * 4 + ['/x%d' % n for n in xrange(8)]
+        random.Random(1).shuffle(urls)
+
+        now = dtm()
+        for metrica in metricas:
+            girls_b = 0
+            for url in urls:
+                girl = url == '/a' or (url == '/b' and girls_b < 2)
+                girls_b += url == '/b' and girl
+                metrica.kick(url=url, gender='girl' if girl else 'boy', date=now)
+            metrica.kick(gender='girl', date=now)
+        buffer.flush()
+
+        hour = dict(year=now.year, month=now.month, day=now.day, hour=now.hour)
+        for metrica in metricas:
+            self.assertEquals(metrica.iterate_top('url', 2), [('/a', 10), ('/b', 6)])
+            self.assertEquals(metrica.timespan(**hour).iterate_top('url', 2), [('/a', 10), ('/b', 6)])
+            self.assertEquals(metrica.filter(gender='girl').iterate_top('url', 2), [('/a', 10), ('/b', 2)])
+            # only 5 choices are kept
+            self.assertEquals(redis.zcard(metrica.top_key(metrica._hash_key, 'url')), 5)
+
+        rolled = metricas[3]
+        self.assertFalse(redis.exists(rolled.top_key(rolled.timespan(**hour)._hash_key, 'url')))
+
+        compact(rolled, now + datetime.timedelta(hours=2))
+        for key in redis.keys(rolled.key_prefix() + ':*:minute:*'):
+            redis.delete(key)
+        self.assertEquals(rolled.timespan(**hour).iterate_top('url', 2), [('/a', 10), ('/b', 6)])
+
+    def testBoundedChoices(self):
+        buffer = KickBuffer(max_delay=60, max_events=10 ** 6)
+        metricas = [Metrica(name='bounded', axes=[('url', StoredChoiceAxis(max_choices=3))]),
+                    Metrica(name='bounded_lua', axes=[('url', StoredChoiceAxis(max_choices=3))], lua_kick=True),
+                    Metrica(name='bounded_buffered', axes=[('url', StoredChoiceAxis(max_choices=3))], buffer=buffer)]
+
+        now = dtm()
+        for metrica in metricas:
+            for n, url in enumerate(['/1', '/2', '/old', '/3', '/4', '/3']):
+                metrica.kick(url=url, date=now - datetime.timedelta(seconds=6 - n))
+        buffer.flush()
+
+        for metrica in metricas:
+            key = metrica.key_for_axis_choices('url')
+            # the least recently kicked are gone
+            self.assertEquals(redis.zcard(key), 3)
+            self.assertEquals(set(metrica.choices('url')), set(['/old', '/3', '/4']))
+
+            # as if /old was kicked two days ago
+            redis.zadd(key, time.time() - 2 * 24 * 60 * 60, '/old')
+            self.assertEquals(set(metrica.iterate('url')), set([('/old', 1), ('/3', 2), ('/4', 1)]))
+            self.assertEquals(set(metrica.timespan(year=now.year, month=now.month, day=now.day).iterate('url')),
+                              set([('/3', 2), ('/4', 1)]))
+            points, choices, columns = metrica.timeserie_by('url', now - datetime.timedelta(hours=1), now, 'hour')
+            self.assertEquals(set(choices), set(['/3', '/4']))
+
+        # choices are scored by the date of a kick, so a backfill is not a choice of recent timespans
+        metricas = [Metrica(name='backfilled', axes=[('url', StoredChoiceAxis(max_choices=10))]),
+                    Metrica(name='backfilled_lua', axes=[('url', StoredChoiceAxis(max_choices=10))], lua_kick=True)]
+        for metrica in metricas:
+            metrica.kick(url='/new', date=now)
+            metrica.kick(url='/2010', date=dtt(2010, 2, 7))
+            metrica.kick_many([{'url': '/2011', 'date': dtt(2011, 2, 7)}])
+
+            self.assertEquals(metrica.timespan(year=now.year).iterate('url'), [('/new', 1)])
+            # choices kicked since a timespan has started
+            self.assertEquals(set(metrica.timespan(year=2011).iterate('url')), set([('/2011', 1), ('/new', 0)]))
+            self.assertEquals(len(metrica.timespan().iterate('url')), 3)
+
+    def testIterateStream(self):
+        metrica = Metrica(name='stream', axes=[('user', StoredChoiceAxis()), ('c', Axis(choices=['a', 'b']))])
+        bounded = Metrica(name='stream_bounded', axes=[('user', StoredChoiceAxis(max_choices=50))])
+        hierarchical = Metrica(name='stream_hierarchical', axes=[('place', HierarchicalAxis())])
+
+        for n in xrange(100):
+            metrica.kick(user='u%d' % n, c='ab'[n % 2], value=n)
+            bounded.kick(user='u%d' % n, value=n)
+            hierarchical.kick(place=('city', n % 7))
+
+        stream = metrica.iterate_stream('user', page_size=10)
+        self.assertEquals(type(stream).__name__, 'generator')
+        self.assertEquals(sorted(stream), sorted(metrica.iterate('user')))
+        self.assertEquals(sorted(metrica.filter(c='a').iterate_stream('user', 10)),
+                          sorted(metrica.filter(c='a').iterate('user')))
+        self.assertEquals(sorted(metrica.iterate_stream('c')), [('a', 2450), ('b', 2500)])
+        self.assertEquals(sorted(bounded.iterate_stream('user', 10)), sorted(bounded.iterate('user')))
+        self.assertEquals(len(list(bounded.iterate_stream('user'))), 50)
+        cities = sorted(hierarchical.filter(place=('city',)).iterate_stream('place'))
+        self.assertEquals(len(cities), 7)
+        self.assertEquals(cities, sorted(hierarchical.filter(place=('city',)).iterate('place')))
+
+    def testConnections(self):
+        self.assertRaises(ValueError, Metrica(name='nowhere', axes=[], using='nowhere').kick)
+
+        analytics = self.configureConnection('analytics', db=1, max_connections=5)
+        self.assertTrue(connections.get('analytics') is analytics)
+        self.assertEquals(analytics.connection_pool.max_connections, 5)
+
+        buffer = KickBuffer(max_delay=60, max_events=10 ** 6)
+        axes = [('user', StoredChoiceAxis()), ('c', Axis(choices=['a', 'b']))]
+        metricas = [Metrica(name='elsewhere', axes=axes, using='analytics'),
+                    Metrica(name='elsewhere_lua', axes=axes, using='analytics', lua_kick=True),
+                    Metrica(name='elsewhere_buffered', axes=axes, using='analytics', buffer=buffer)]
+        here = Metrica(name='here', axes=axes, buffer=buffer)
+
+        try:
+            for metrica in metricas + [here]:
+                for n in xrange(10):
+                    metrica.kick(user='u%d' % (n % 3), c='ab'[n % 2], date=dtt(2010, 2, 7, 10))
+            buffer.flush()
+
+            for metrica in metricas + [here]:
+                self.assertEquals(metrica.total(), 10)
+                self.assertEquals(sorted(metrica.iterate('user')), [('u0', 4), ('u1', 3), ('u2', 3)])
+                self.assertEquals(metrica.iterate(), [(2010, 10)])
+
+            for metrica in metricas:
+                self.assertFalse(redis.keys(metrica.key_prefix() + ':*'))
+                self.assertTrue(analytics.keys(metrica.key_prefix() + ':*'))
+            self.assertFalse(analytics.keys(here.key_prefix() + ':*'))
+        finally:
+            for key in analytics.keys(settings.STASTE_METRICS_PREFIX + '*'):
+                analytics.delete(key)
+
+        # other tests don't get the alias
+        self.doCleanups()
+        self.assertFalse('analytics' in connections.aliases())
+
+    def testSharding(self):
+        sharded = self.configureConnection('sharded', shards=[{'db': 2}, {'db': 3, 'name': 'second'}],
+                                           max_connections=5)
+        self.assertEquals(len(sharded.nodes), 2)
+
+        buffer = KickBuffer(max_delay=60, max_events=10 ** 6)
+        axes = [('user', StoredChoiceAxis()), ('c', Axis(choices=['a', 'b']))]
+        here = AveragedMetrica(name='unsharded', axes=axes, stored_scales=('day', 'minute'), compacted=True)
+        metricas = [AveragedMetrica(name='sharded', axes=axes, using='sharded', stored_scales=('day', 'minute'),
+                                    compacted=True),
+                    AveragedMetrica(name='sharded_lua', axes=axes, using='sharded', lua_kick=True,
+                                    stored_scales=('day', 'minute'), compacted=True),
+                    AveragedMetrica(name='sharded_buffered', axes=axes, using='sharded', buffer=buffer,
+                                    stored_scales=('day', 'minute'), compacted=True)]
+
+        dates = [dtm(minutes=5), dtm(minutes=65), dtm(hours=30), dtt(2010, 2, 7, 10), dtt(2010, 3, 1)]
+
+        try:
+            for metrica in metricas + [here]:
+                for n in xrange(20):
+                    metrica.kick(user='u%d' % (n % 3), c='ab'[n % 2], value=n, date=dates[n % len(dates)])
+            buffer.flush()
+
+            # the same key is always on the same node, keys of a hash are kept together
+            key = metricas[0].key_prefix() + ':year:2010'
+            self.assertEquals(sharded.node_n(key), sharded.node_n(key + ':__len__'))
+            self.assertTrue(all(node.keys(settings.STASTE_METRICS_PREFIX + '*') for node in sharded.nodes))
+            self.assertRaises(ValueError, sharded.delete, *['key%d' % n for n in xrange(10)])
+
+            # pipelines of nodes are executed by the same threads
+            threads = Metrica(name='sharded_threads', axes=axes, using='sharded')
+            threads.kick(user='u0', c='a')
+            started = []
+            start = threading.Thread.start
+            threading.Thread.start = lambda thread: started.append(thread) or start(thread)
+            try:
+                for n in xrange(10):
+                    threads.kick(user='u%d' % n, c='a')
+            finally:
+                threading.Thread.start = start
+            self.assertEquals(started, [])
+
+            now = dtm()
+            since = now - datetime.timedelta(hours=40)
+            for metrica in metricas:
+                self.assertEquals(metrica.total(), here.total())
+                self.assertEquals(set(metrica.iterate('user')), set(here.iterate('user')))
+                self.assertEquals(metrica.iterate(), here.iterate())
+                self.assertEquals(metrica.timespan(year=2010).filter(c='b').total(),
+                                  here.timespan(year=2010).filter(c='b').total())
+                self.assertEquals(list(metrica.timespan(year=now.year, month=now.month).iterate_on_dateaxis()),
+                                  list(here.timespan(year=now.year, month=now.month).iterate_on_dateaxis()))
+                self.assertEquals(metrica.timeserie(since, now, 'hour'), here.timeserie(since, now, 'hour'))
+                self.assertEquals(metrica.timespan(year=2010).average(), here.timespan(year=2010).average())
+        finally:
+            for node in sharded.nodes:
+                for key in node.keys(settings.STASTE_METRICS_PREFIX + '*'):
+                    node.delete(key)
+
+    def testShardedMerges(self):
+        sharded = self.configureConnection('sharded', shards=[{'db': 2}, {'db': 3, 'name': 'second'}],
+                                           max_connections=5)
+
+        def make(name, **kwargs):
+            return UniqueMetrica(name=name, axes=[('page', StoredChoiceAxis(top=5))], stored_scales=('day', 'minute'),
+                                 compacted=True, compact_keys=True, **kwargs)
+
+        here = make('unsharded_merges')
+        there = make('sharded_merges', using='sharded')
+
+        now = dtt(2011, 10, 7, 12, 20)
+        dates = [dtt(2011, 10, 7, 9, minute) for minute in xrange(0, 60, 7)] + [dtt(2011, 10, 7, 10, 40)]
+
+        try:
+            for metrica in (here, there):
+                for n in xrange(60):
+                    metrica.kick(uid=n % 25, page='/p%d' % (n % 7), date=dates[n % len(dates)])
+
+            # minutes of an hour are on both nodes
+            hour_keys = [u'%s:%s' % (there.key_prefix(), there.date_axis.datetime_to_id('minute', date))
+                         for date in dates[:-1]]
+            self.assertEquals(len(set(sharded.node_n(key) for key in hour_keys)), 2)
+
+            def check():
+                for metrica in (here, there):
+                    hour = metrica.timespan(year=2011, month=10, day=7, hour=9)
+                    self.assertEquals(hour.unique(), here.timespan(year=2011, month=10, day=7, hour=9).unique())
+                    self.assertEquals(hour.iterate_top('page', 3),
+                                      here.timespan(year=2011, month=10, day=7, hour=9).iterate_top('page', 3))
+                self.assertEquals(there.timespan(year=2011, month=10, day=7).unique(), 25)
+                self.assertEquals(there.timeserie_unique(dtt(2011, 10, 7, 8), dtt(2011, 10, 7, 11), 'hour'),
+                                  here.timeserie_unique(dtt(2011, 10, 7, 8), dtt(2011, 10, 7, 11), 'hour'))
+
+                # keys of a node (a day) are counted in its pipeline, keys of several nodes (an hour) are merged
+                for timespan in ({'day': 7}, {'day': 7, 'hour': 9}):
+                    self.assertEquals(set(there.timespan(year=2011, month=10, **timespan).iterate_unique('page')),
+                                      set(here.timespan(year=2011, month=10, **timespan).iterate_unique('page')))
+
+            check()
+            self.assertEquals(compact(there, now), compact(here, now))
+            for node in sharded.nodes:
+                for key in node.keys(there.key_prefix() + ':*:minute:*'):
+                    node.delete(key)
+            check()
+
+            # copies of keys of other nodes are gone
+            self.assertFalse([key for node in sharded.nodes for key in node.keys('*:__union__*')])
+        finally:
+            for node in sharded.nodes:
+                for key in node.keys(settings.STASTE_METRICS_PREFIX + '*'):
+                    node.delete(key)
+
+    def testCompactKeys(self):
+        self.assertRaises(ValueError, Metrica, name='gaps', axes=[], date_scales=('year', 'day'), compact_keys=True)
+
+        date_axis = Metrica(name='compact_dates', axes=[], compact_keys=True).date_axis
+        for timespan in ({}, {'year': 2011}, {'year': 2011, 'month': 12}, {'year': 2012, 'month': 2, 'day': 29},
+                         {'year': 2011, 'month': 10, 'day': 7, 'hour': 3, 'minute': 15}):
+            self.assertEquals(date_axis.id_to_timespan(date_axis.timespan_to_id(**timespan)), timespan)
+
+        def make(name, **kwargs):
+            axes = [('page', HierarchicalAxis()), ('user', StoredChoiceAxis(value_type=unicode, top=5)),
+                    ('c', Axis(choices=['a', 'b']))]
+            return AveragedMetrica(name=name, axes=axes, stored_scales=('day', 'minute'), compacted=True, **kwargs)
+
+        def kick(metrica):
+            dates = [dtm(minutes=5), dtm(minutes=65), dtm(hours=30), dtt(2010, 2, 7, 10), dtt(2010, 3, 1)]
+            for n in xrange(20):
+                metrica.kick(page=('blog', 'post%d' % (n % 4)), user=u'юзер%d' % (n % 3), c='ab'[n % 2],
+                             value=n, date=dates[n % len(dates)])
+
+        verbose = make('verbose')
+        migrated = make('migrated')
+        for metrica in (verbose, migrated):
+            kick(metrica)
+
+        compact = make('compact', compact_keys=True)
+        compact_lua = make('compact_lua', compact_keys=True, lua_kick=True)
+        for metrica in (compact, compact_lua):
+            kick(metrica)
+
+        # kicked before compact_keys was turned on
+        migrated = make('migrated', compact_keys=True)
+
+        # a run which has stopped halfway has left a copy of a hash
+        key = migrated.key_prefix() + ':year:2010:month:2:day:7'
+        redis.rename(key, key + ':__migrating__')
+
+        moved, skipped = migrate(migrated)
+        self.assertTrue(moved)
+        self.assertEquals(skipped, 0)
+        self.assertEquals(migrate(migrated), (0, 0))
+        self.assertFalse(redis.keys(migrated.key_prefix() + ':*:__migrating__'))
+
+        def longest(metrica):
+            keys = [key for key in redis.keys(metrica.key_prefix() + ':*') if redis.type(key) == 'hash']
+            return max(len(key) for key in keys), max(len(field) for key in keys for field in redis.hkeys(key))
+
+        self.assertTrue(longest(compact) < longest(verbose))
+
+        now = dtm()
+        since = now - datetime.timedelta(hours=40)
+        for metrica in (compact, compact_lua, migrated):
+            self.assertEquals(metrica.total(), verbose.total())
+            self.assertEquals(metrica.count(), verbose.count())
+            self.assertEquals(metrica.filter(user=u'никто').total(), 0)
+            self.assertEquals(metrica.filter(c='b', user=u'юзер1').total(),
+                              verbose.filter(c='b', user=u'юзер1').total())
+            self.assertEquals(set(metrica.iterate('user')), set(verbose.iterate('user')))
+            self.assertEquals(set(metrica.iterate('page')), set(verbose.iterate('page')))
+            self.assertEquals(set(metrica.filter(page=('blog',)).iterate('page')),
+                              set(verbose.filter(page=('blog',)).iterate('page')))
+            self.assertEquals(set(metrica.iterate_all('user')), set(verbose.iterate_all('user')))
+            self.assertEquals(metrica.iterate_top('user'), verbose.iterate_top('user'))
+            self.assertEquals(metrica.timespan(year=2010).iterate(), verbose.timespan(year=2010).iterate())
+            self.assertEquals(metrica.timespan(year=now.year, month=now.month).iterate(),
+                              verbose.timespan(year=now.year, month=now.month).iterate())
+            self.assertEquals(metrica.timeserie(since, now, 'hour'), verbose.timeserie(since, now, 'hour'))
+
+    def testHashLayouts(self):
+        self.assertRaises(ValueError, Metrica, name='lua', axes=[], layout=BucketedLayout(), lua_kick=True)
+        self.assertRaises(ValueError, Metrica, name='years', axes=[], layout=PackedLayout(), date_scales=('year',))
+
+        def make(name, **kwargs):
+            axes = [('user', StoredChoiceAxis()), ('c', Axis(choices=['a', 'b']))]
+            return AveragedMetrica(name=name, axes=axes, stored_scales=('day', 'minute'), compacted=True, **kwargs)
+
+        plain = make('plain')
+        metricas = [make('bucketed', layout=BucketedLayout(8)), make('packed', layout=PackedLayout()),
+                    make('packed_compact', layout=PackedLayout(), compact_keys=True)]
+
+        dates = [dtm(minutes=5), dtm(minutes=6), dtm(minutes=65), dtm(hours=30), dtt(2010, 2, 7, 10, 5),
+                 dtt(2010, 2, 7, 10, 6), dtt(2010, 3, 1)]
+        for metrica in [plain] + metricas:
+            for n in xrange(50):
+                metrica.kick(user='u%d' % (n % 20), c='ab'[n % 2], value=n, date=dates[n % len(dates)])
+
+        compact(plain, now=dtt(2010, 4, 1))
+        now = dtm()
+        since = now - datetime.timedelta(hours=40)
+        for metrica in metricas:
+            self.assertEquals(metrica.total(), plain.total())
+            self.assertEquals(metrica.count(), plain.count())
+            self.assertEquals(set(metrica.iterate('user')), set(plain.iterate('user')))
+            self.assertEquals(set(metrica.iterate_all('user')), set(plain.iterate_all('user')))
+            self.assertEquals(metrica.timespan(year=2010).iterate(), plain.timespan(year=2010).iterate())
+            self.assertEquals(metrica.timespan(year=2010, month=2, day=7, hour=10).iterate(),
+                              plain.timespan(year=2010, month=2, day=7, hour=10).iterate())
+            self.assertEquals(metrica.timeserie(since, now, 'hour'), plain.timeserie(since, now, 'hour'))
+            self.assertEquals(metrica.timeserie(since, now, 'minute'), plain.timeserie(since, now, 'minute'))
+
+            compact(metrica, now=dtt(2010, 4, 1))
+            self.assertEquals(metrica.timespan(year=2010, month=2).filter(c='a').total(),
+                              plain.timespan(year=2010, month=2).filter(c='a').total())
+
+        stats = dict((metrica.name, memory_stats(metrica)) for metrica in [plain] + metricas)
+        self.assertEquals(stats['bucketed']['layout'], 'BucketedLayout')
+        self.assertEquals(stats['bucketed']['fields'], stats['plain']['fields'])
+        self.assertTrue(stats['bucketed']['keys'] > stats['plain']['keys'] > stats['packed']['keys'])
+        self.assertTrue(stats['packed_compact']['bytes'] < stats['plain']['bytes'])
+
+        # a kick expires only buckets it has bumped (4 fields here), not all 64 of every hash
+        def expires(metrica):
+            calls = redis.info('commandstats').get('cmdstat_expire', {}).get('calls', 0)
+            metrica.kick(user='u1', c='a', value=1)
+            return redis.info('commandstats').get('cmdstat_expire', {}).get('calls', 0) - calls
+
+        plain_expires = expires(plain)
+        self.assertTrue(plain_expires > 0)
+        self.assertTrue(plain_expires < expires(make('wide', layout=BucketedLayout(64))) <= 4 * plain_expires)
+
+        # counts of averages expire with their values
+        for metrica in (plain, make('wide', layout=BucketedLayout(64)), make('counted_lua', lua_kick=True)):
+            metrica.kick(user='u1', c='a', value=1)
+            len_keys = [key for key in redis.keys(metrica.key_prefix() + ':*')
+                        if ':__len__' in key and ':minute:' in key]
+            self.assertTrue(len_keys)
+            self.assertTrue(all(redis.ttl(key) > 0 for key in len_keys))
+
+    def testBatch(self):
+        axes = [('user', StoredChoiceAxis())]
+        metricas = [Metrica(name='batched', axes=axes), AveragedMetrica(name='batched_avg', axes=axes),
+                    Metrica(name='batched_lua', axes=axes, lua_kick=True),
+                    UniqueMetrica(name='batched_uniques', axes=axes)]
+
+        with batch():
+            with batch():
+                for metrica in metricas:
+                    metrica.kick(user='u1', value=2, **({'uid': 1} if metrica.counts_uniques else {}))
+
+            # nothing is sent until the outer batch is over
+            for metrica in metricas:
+                self.assertEquals(metrica.total(), 0)
+                self.assertEquals(metrica.choices('user'), [])
+
+        for metrica in metricas:
+            self.assertEquals(metrica.total(), 2)
+            self.assertEquals(metrica.iterate('user'), [('u1', 2)])
+        self.assertEquals(metricas[1].count(), 1)
+        self.assertEquals(metricas[3].unique(), 1)
+
+        def kick_and_fail():
+            with batch():
+                for metrica in metricas[:3]:
+                    metrica.kick(user='u2')
+                raise ZeroDivisionError
+
+        self.assertRaises(ZeroDivisionError, kick_and_fail)
+        for metrica in metricas[:3]:
+            self.assertEquals(metrica.filter(user='u2').total(), 1)
+
+        # an error of sending kicks is logged, the one of the block is raised
+        class Records(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record)
+
+        def fail_to_send():
+            raise ValueError(u'Invalid kick')
+
+        def fail_twice():
+            with batch() as kicks:
+                metricas[0].kick(user='u3')
+                kicks.execute = fail_to_send
+                raise ZeroDivisionError
+
+        handler = Records()
+        logger = logging.getLogger('staste.batching')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.assertRaises(ZeroDivisionError, fail_twice)
+        self.assertEquals(len(handler.records), 1)
+        self.assertEquals(handler.records[0].exc_info[0], ValueError)
+
+    def testKickPlan(self):
+        metrica = AveragedMetrica(name='planned', axes=[('user', StoredChoiceAxis()),
+                                                        ('path', HierarchicalAxis())])
+
+        # the key prefix is cached, but follows the settings
+        settings.STASTE_METRICS_PREFIX = self.old_prefix + '_test_plan_test'
+        metrica.kick(user='u1', path=('a', 'b'), value=3, date=dtt(2011, 10, 7, 3, 15, 10))
+        self.assertEquals(redis.keys(self.old_prefix + '_test:planned:*'), [])
+        self.assertTrue(redis.keys(self.old_prefix + '_test_plan_test:planned:*'))
+        self.assertEquals(metrica.total(), 3)
+
+        # date scales are remembered for a minute only
+        metrica.kick(user='u2', path=('a', 'c'), value=5, date=dtt(2011, 10, 7, 3, 15, 50))
+        metrica.kick(user='u2', value=7, date=dtt(2011, 10, 7, 3, 16, 0))
+        metrica.kick(user='u1', value=1, date=dtt(2011, 10, 7, 4, 16, 0))
+        self.assertEquals(metrica.timespan(year=2011, month=10, day=7, hour=3, minute=15).total(), 8)
+        self.assertEquals(metrica.timespan(year=2011, month=10, day=7, hour=3, minute=16).total(), 7)
+        self.assertEquals(metrica.timespan(year=2011, month=10, day=7, hour=3).count(), 3)
+        self.assertEquals(metrica.timespan(year=2011, month=10, day=7, hour=4).total(), 1)
+        self.assertEquals(sorted(metrica.iterate('user')), [('u1', 4), ('u2', 12)])
+        self.assertEquals(sorted(metrica.filter(path=('a',)).iterate('path')), [(('a', 'b'), 3), (('a', 'c'), 5)])
+
+        histogram = HistogramMetrica(name='planned_histogram', axes=[('user', StoredChoiceAxis())])
+        for n in xrange(1, 11):
+            histogram.kick(user='u1', value=n, date=dtm())
+        self.assertEquals(histogram.filter(user='u1').count(), 10)
+        self.assertTrue(4.5 < histogram.filter(user='u1').percentiles((50,))[50] < 5.5)
+
+    def testRollupOneScaleAtATime(self):
+        self.assertEquals(len(DATE_AXIS.rollup_ids('year:2011', ('day', 'minute'))), 12)
+        self.assertEquals(DATE_AXIS.rollup_ids('year:2011:month:10:day:7:hour:3', ('day', 'minute'))[:2],
+                          ['year:2011:month:10:day:7:hour:3:minute:0', 'year:2011:month:10:day:7:hour:3:minute:1'])
+
+        rolled = Metrica(name='rolled_by_scale', axes=[], stored_scales=('day', 'minute'), compacted=True)
+        dates = [dtt(2011, 8, 3, 5, 10), dtt(2011, 9, 20, 8), dtt(2011, 10, 7, 9, 30)]
+        for date in dates:
+            rolled.kick(date=date)
+
+        self.assertEquals(rolled.timespan(year=2011).total(), 3)
+        self.assertEquals(compact(rolled, dtt(2011, 10, 7, 12)), 3)
+
+        # compacted months are read instead of their days
+        for key in redis.keys(rolled.key_prefix() + ':year:2011:month:[89]:day:*'):
+            redis.delete(key)
+        self.assertEquals(rolled.timespan(year=2011).total(), 3)
+        self.assertEquals(rolled.timespan(year=2011).iterate()[6:10], [(7, 0), (8, 1), (9, 1), (10, 1)])
+
+        # a day of minutes is summed up with several calls of the script
+        minutes = Metrica(name='rolled_from_minutes', axes=[], stored_scales=('minute',), retention={'minute': 0})
+        minutes.kick(date=dates[2], value=2)
+        chunk_size, metrica_module.ROLLUP_CHUNK_SIZE = metrica_module.ROLLUP_CHUNK_SIZE, 7
+        try:
+            self.assertEquals(minutes.timespan(year=2011, month=10, day=7).total(), 2)
+            self.assertEquals(minutes.timespan(year=2011, month=10, day=8).total(), 0)
+        finally:
+            metrica_module.ROLLUP_CHUNK_SIZE = chunk_size
+
+    def testUniqueMetricaKickMany(self):
+        metrica = UniqueMetrica(name='uniques_backfilled', axes=[('page', StoredChoiceAxis())])
+        now = dtm()
+        hour_ago = now - datetime.timedelta(hours=1)
+
+        events = [{'uid': uid % 30, 'page': '/', 'date': now} for uid in xrange(100)]
+        events += [{'uid': uid % 20, 'page': '/about', 'date': hour_ago} for uid in xrange(100)]
+        events.append({'page': '/'})
+        self.assertEquals(metrica.kick_many(events, chunk_size=70), 201)
+
+        self.assertEquals(metrica.total(), 201)
+        self.assertEquals(metrica.unique(), 30)
+        self.assertEquals(metrica.filter(page='/about').unique(), 20)
+        self.assertEquals(metrica.timespan(year=hour_ago.year, month=hour_ago.month, day=hour_ago.day,
+                                           hour=hour_ago.hour).filter(page='/about').unique(), 20)
+
+        minute_key = u'%s:%s' % (metrica.key_prefix(), DATE_AXIS.datetime_to_id('minute', now))
+        key = metrica.uniques_key(minute_key, '__all__')
+        self.assertTrue(0 < redis.ttl(key) <= DATE_AXIS.scales_and_expirations[-1][1])
+
+    def testScriptsInPipelines(self):
+        metrica = Metrica(name='top_scripts', axes=[('url', StoredChoiceAxis(top=3))])
+        metrica.kick(url='/')
+
+        # scripts are loaded once, pipelines don't ask for SCRIPT EXISTS
+        scripts = redis.info('commandstats').get('cmdstat_script', {}).get('calls', 0)
+        for n in xrange(5):
+            metrica.kick(url='/about')
+        with batch():
+            metrica.kick(url='/about')
+        self.assertEquals(redis.info('commandstats').get('cmdstat_script', {}).get('calls', 0), scripts)
+
+        # Redis has lost them
+        redis.script_flush()
+        metrica.kick(url='/about')
+        with batch():
+            metrica.kick(url='/')
+        self.assertEquals(metrica.iterate_top('url'), [('/about', 7), ('/', 2)])
+
+        # a TTL set after a script call is set again, once the script has made its key
+        key = metrica.top_key(metrica.key_prefix(), 'url')
+        redis.script_flush()
+        pipe = redis.pipeline(transaction=False)
+        top_script(keys=[key], args=['/', 1, 3, 0], client=pipe)
+        pipe.expire(key, 100)
+        self.assertEquals(execute_pipeline(pipe), [None, True])
+        self.assertTrue(0 < redis.ttl(key) <= 100)
@@ -1 +1,68 @@
-    
+import re
+import datetime
+import threading
+from collections import OrderedDict
+
+
+DURATION_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+    'y': 365 * 24 * 60 * 60,
+}
+
+DURATION_RE = re.compile(r'^\s*(\d+)\s*([smhdwy])\s*$')
+
+
+def duration_to_seconds(duration):
+    """
+    Converts a duration to seconds.
+    Accepts seconds, timedelta objects or strings like '30s', '15m', '6h', '7d', '2w', '1y'
+    """
+    if isinstance(duration, datetime.timedelta):
+        return duration.days * DURATION_UNITS['d'] + duration.seconds
+
+    if isinstance(duration, basestring):
+        match = DURATION_RE.match(duration)
+        if not match:
+            raise ValueError(u'Invalid duration: {}'.format(duration))
+
+        return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+    return int(duration)
+
+
+class LRUCache(object):
+    """A small thread-safe dict which forgets least recently used keys"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,99 @@
+"""
+Background kicking.
+
+KickQueue moves Metrica.kick() calls out of the calling thread: kicks are put on
+a bounded queue and sent to Redis by a pool of daemon worker threads.
+When the queue is full, a kick is either dropped right away (policy='drop')
+or waits up to `timeout` seconds for a free slot and is dropped after that (policy='block').
+Dropped and failed kicks are counted.
+"""
+import os
+import datetime
+import threading
+from Queue import Queue, Full
+
+
+class KickQueue(object):
+    def __init__(self, maxsize=10000, workers=1, policy='drop', timeout=0.1):
+        if policy not in ('drop', 'block'):
+            raise ValueError(u'Invalid policy: {}, choices are: drop, block'.format(policy))
+
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self.timeout = timeout
+
+        self.queue = Queue(maxsize)
+        self.kicked = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def kick(self, metrica, value=1, date=None, **kwargs):
+        """Queues metrica.kick(). The date is fixed now, not when the kick is sent"""
+        self._ensure_workers()
+
+        item = (metrica, value, date or datetime.datetime.now(), kwargs)
+
+        try:
+            if self.policy == 'drop':
+                self.queue.put_nowait(item)
+            else:
+                self.queue.put(item, timeout=self.timeout)
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def join(self):
+        """Blocks until all queued kicks are sent"""
+        self.queue.join()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'kicked': self.kicked,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _ensure_workers(self):
+        # threads do not survive fork(), so prefork servers need workers per process
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            if self._pid is not None:
+                # a forked child: queued kicks belong to the parent
+                self.queue = Queue(self.maxsize)
+
+            self._pid = os.getpid()
+            self._threads = []
+
+            for n in xrange(self.workers):
+                thread = threading.Thread(target=self._run, name='staste-kick-worker-%s' % n)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        queue = self.queue
+
+        while True:
+            metrica, value, date, kwargs = queue.get()
+
+            try:
+                metrica.kick(value=value, date=date, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+            else:
+                with self._lock:
+                    self.kicked += 1
+            finally:
+                queue.task_done()
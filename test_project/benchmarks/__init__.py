@@ -0,0 +1,17 @@
+"""
+Benchmarks of staste, run from test_project against a local redis-server:
+
+    python -m benchmarks                                  # everything, JSON to stdout
+    python -m benchmarks kick query --quick               # some of them, smaller
+    python -m benchmarks --output new.json --compare old.json
+
+kick - kicks a second (with and without Redis) and Redis commands per kick
+       for different axes, cardinalities and date scales
+query - latency of total(), iterate(), timeserie() and chart views
+memory - Redis memory per million events
+
+Everything is kept under the STASTE_METRICS_PREFIX + ':benchmark' keys, which are deleted afterwards.
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
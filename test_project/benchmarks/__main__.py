@@ -0,0 +1,111 @@
+"""
+python -m benchmarks [kick] [query] [memory] [--quick] [--output FILE] [--compare FILE] [--tolerance 0.2]
+
+Results are written as JSON. With --compare, results which got worse than the ones
+of an older run by more than --tolerance are listed, and the exit status is 1.
+"""
+import sys
+import json
+import time
+import platform
+from optparse import OptionParser
+
+from staste import redis
+
+from . import kick, query, memory
+
+BENCHMARKS = [('kick', kick), ('query', query), ('memory', memory)]
+
+QUICK = {
+    'kick': {'kicks': 2000, 'redis_kicks': 200},
+    'query': {'events': 5000, 'repeat': 5},
+    'memory': {'events': 2000},
+}
+
+# measures which should not go down, and ones which should not go up
+HIGHER_IS_BETTER = ('kicks_per_sec_cpu', 'kicks_per_sec_redis')
+LOWER_IS_BETTER = ('commands_per_kick', 'ms_median', 'commands', 'bytes_per_million_events')
+
+
+def describe(result):
+    measures = ', '.join('%s=%.4g' % (measure, result[measure]) for measure in HIGHER_IS_BETTER + LOWER_IS_BETTER
+                         if result.get(measure) is not None)
+    return '%s %s: %s' % (result['benchmark'], result['case'], measures)
+
+
+def regressions(results, baseline, tolerance):
+    """Descriptions of measures which got worse than the baseline ones by more than tolerance (0.2 is 20%)"""
+    old_results = dict(((result['benchmark'], result['case']), result) for result in baseline['results'])
+
+    for result in results:
+        old = old_results.get((result['benchmark'], result['case']))
+        if old is None:
+            continue
+
+        for measure in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            value, old_value = result.get(measure), old.get(measure)
+            if not value or not old_value:
+                continue
+
+            change = float(value - old_value) / old_value
+            if measure in HIGHER_IS_BETTER:
+                change = -change
+
+            if change > tolerance:
+                yield '%s %s: %s is %.4g, was %.4g' % (result['benchmark'], result['case'], measure,
+                                                       value, old_value)
+
+
+def main(argv):
+    parser = OptionParser(usage=__doc__.strip().splitlines()[0])
+    parser.add_option('--quick', action='store_true', default=False,
+                      help='Less kicks and events, to see that everything works')
+    parser.add_option('--output', help='A file to write results to, stdout by default')
+    parser.add_option('--compare', help='Results of an older run')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='How much worse than the older run is fine, 0.2 is 20%')
+    options, names = parser.parse_args(argv)
+
+    available = dict(BENCHMARKS)
+    for name in names:
+        if name not in available:
+            parser.error(u'Invalid benchmark: {}, choices are: {}'.format(name, [n for n, b in BENCHMARKS]))
+
+    results = []
+    for name, benchmark in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        for result in benchmark.run(**(QUICK[name] if options.quick else {})):
+            sys.stderr.write(describe(result) + '\n')
+            results.append(result)
+
+    report = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'redis': redis.info()['redis_version'],
+        'quick': options.quick,
+        'results': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            worse = list(regressions(results, json.load(baseline), options.tolerance))
+
+        for line in worse:
+            sys.stderr.write('worse: %s\n' % line)
+
+        return 1 if worse else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
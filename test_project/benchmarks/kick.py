@@ -0,0 +1,72 @@
+"""
+How fast Metrica.kick() is.
+
+Client-side CPU is measured with a pipeline which only counts commands, so Redis
+and the network are out of the picture. Then some of the same kicks are sent to Redis.
+"""
+import time
+import datetime
+
+from staste.axis import StoredChoiceAxis
+from staste.metrica import Metrica, AveragedMetrica
+
+from .utils import CountingPipeline, benchmark_prefix, commands_done, random_events
+
+# (metrica class, axes, cardinality of every axis, date scales)
+CASES = [
+    (Metrica, 1, 100, None),
+    (Metrica, 3, 100, None),
+    (Metrica, 5, 100, None),
+    (Metrica, 3, 10, None),
+    (Metrica, 3, 10000, None),
+    (Metrica, 3, 100, ('day', 'hour')),
+    (Metrica, 3, 100, ('minute',)),
+    (AveragedMetrica, 3, 100, None),
+]
+
+
+def case_name(metrica_class, axes, cardinality, date_scales):
+    return u'%s-%daxes-%dvalues-%s' % (metrica_class.__name__, axes, cardinality,
+                                       '+'.join(date_scales) if date_scales else 'all')
+
+
+def run(kicks=20000, redis_kicks=2000):
+    with benchmark_prefix():
+        for metrica_class, axes, cardinality, date_scales in CASES:
+            name = case_name(metrica_class, axes, cardinality, date_scales)
+            axes_kw = ['axis%d' % n for n in xrange(axes)]
+            metrica = metrica_class(name=u'benchmark_%s' % name, axes=[(axis_kw, StoredChoiceAxis())
+                                                                       for axis_kw in axes_kw],
+                                    date_scales=date_scales)
+
+            # kicks are of now, like the middleware ones
+            now = datetime.datetime.now()
+            events = list(random_events(kicks, axes_kw, cardinality, minutes=1))
+            for event in events:
+                event['date'] = now
+
+            pipe = CountingPipeline()
+            metrica._pipeline = lambda: pipe
+            cpu = kick(metrica, events)
+            del metrica._pipeline
+
+            commands = commands_done()
+            redis = kick(metrica, events[:redis_kicks])
+            commands = commands_done() - commands
+
+            yield {
+                'benchmark': 'kick',
+                'case': name,
+                'params': {'metrica': metrica_class.__name__, 'axes': axes, 'cardinality': cardinality,
+                           'date_scales': list(metrica.date_scales)},
+                'kicks_per_sec_cpu': kicks / cpu,
+                'kicks_per_sec_redis': redis_kicks / redis,
+                'commands_per_kick': float(commands) / redis_kicks,
+            }
+
+
+def kick(metrica, events):
+    started = time.time()
+    for event in events:
+        metrica.kick(**event)
+    return time.time() - started
@@ -0,0 +1,55 @@
+"""
+How much Redis memory events take, for different axes, cardinalities and layouts.
+Events are spread over the last day, so it's about a day of minute hashes.
+Memory is what MEMORY USAGE tells about every key of a metrica (needs Redis 4+).
+"""
+from staste.axis import StoredChoiceAxis
+from staste.metrica import Metrica
+from staste.layout import BucketedLayout, PackedLayout, memory_stats
+
+from .utils import benchmark_prefix, delete_keys, keys_memory, random_events
+
+MINUTES = 24 * 60
+
+# (axes, cardinality of every axis, layout, compact_keys)
+CASES = [
+    (1, 10, None, False),
+    (3, 10, None, False),
+    (2, 1000, None, False),
+    (2, 1000, None, True),
+    (2, 1000, BucketedLayout(16), False),
+    (1, 10, PackedLayout(), False),
+]
+
+
+def case_name(axes, cardinality, layout, compact_keys):
+    return u'%daxes-%dvalues-%s%s' % (axes, cardinality, layout.__class__.__name__ if layout else 'HashLayout',
+                                      '-compact' if compact_keys else '')
+
+
+def run(events=100000):
+    with benchmark_prefix():
+        for axes, cardinality, layout, compact_keys in CASES:
+            name = case_name(axes, cardinality, layout, compact_keys)
+            axes_kw = ['axis%d' % n for n in xrange(axes)]
+            metrica = Metrica(name=u'benchmark_%s' % name,
+                              axes=[(axis_kw, StoredChoiceAxis()) for axis_kw in axes_kw],
+                              layout=layout, compact_keys=compact_keys)
+
+            metrica.kick_many(random_events(events, axes_kw, cardinality, MINUTES))
+            memory = keys_memory(metrica.key_prefix())
+            stats = memory_stats(metrica)
+            delete_keys()
+
+            yield {
+                'benchmark': 'memory',
+                'case': name,
+                'params': {'axes': axes, 'cardinality': cardinality, 'layout': stats['layout'],
+                           'compact_keys': compact_keys, 'events': events, 'minutes': MINUTES},
+                'bytes_per_million_events': memory * 1000000.0 / events,
+                'hash_bytes_per_million_events': (stats['bytes'] * 1000000.0 / events
+                                                  if stats['bytes'] is not None else None),
+                'keys': stats['keys'],
+                'fields': stats['fields'],
+                'encodings': stats['encodings'],
+            }
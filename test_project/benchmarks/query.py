@@ -0,0 +1,67 @@
+"""
+How long reading takes: MetricaValues methods and get_context_data() of every chart view,
+over a metrica kicked all over the last two days.
+"""
+import datetime
+
+from django.test.client import RequestFactory
+
+from staste.axis import StoredChoiceAxis
+from staste.metrica import AveragedMetrica
+from staste.charts.views import PieChart, TimelineChart, TimeserieChart, LatestCountAndAverageChart
+
+from .utils import benchmark_prefix, latency, random_events
+
+MINUTES = 2 * 24 * 60
+
+
+def chart(view_class, params=None, **kwargs):
+    """get_context_data() of a chart view, as if it was asked for with GET params"""
+    def get_context_data():
+        view = view_class(**kwargs)
+        view.request = RequestFactory().get('/', params or {})
+        return view.get_context_data()
+    return get_context_data
+
+
+def queries(metrica):
+    now = datetime.datetime.now()
+    today = metrica.timespan(year=now.year, month=now.month, day=now.day)
+    hour_ago, day_ago = now - datetime.timedelta(hours=1), now - datetime.timedelta(days=1)
+
+    return [
+        ('total', metrica.total),
+        ('total_today', today.total),
+        ('total_filtered', metrica.filter(view=u'view1').total),
+        ('iterate', lambda: metrica.iterate('view')),
+        ('iterate_today', lambda: today.iterate('view')),
+        ('iterate_dateaxis', lambda: metrica.iterate()),
+        ('timeserie_minutes_of_hour', lambda: metrica.timeserie(hour_ago, now, scale='minute')),
+        ('timeserie_hours_of_day', lambda: metrica.timeserie(day_ago, now, scale='hour')),
+        ('timeserie_by_view', lambda: metrica.timeserie_by('view', day_ago, now, scale='hour')),
+        ('PieChart', chart(PieChart, metrica=metrica, axis_keyword='view')),
+        ('PieChart_iterate_all', chart(PieChart, metrica=metrica, axis_keyword='view', iterate_all=True)),
+        ('TimelineChart', chart(TimelineChart, metrica=metrica)),
+        ('TimeserieChart', chart(TimeserieChart, {'show_axis': 'exception', 'timescale': 'hour', 'day__ago': '1'},
+                                 metrica=metrica)),
+        ('LatestCountAndAverageChart', chart(LatestCountAndAverageChart, {'scale': 'minute'}, metrica=metrica)),
+        ('LatestCountAndAverageChart_hours', chart(LatestCountAndAverageChart, {'scale': 'hour'},
+                                                   metrica=metrica)),
+    ]
+
+
+def run(events=100000, cardinality=50, repeat=50):
+    with benchmark_prefix():
+        # like the middleware one: views and exceptions
+        metrica = AveragedMetrica(name='benchmark_query', axes=[('view', StoredChoiceAxis()),
+                                                                ('exception', StoredChoiceAxis())])
+        metrica.kick_many(random_events(events, ['view', 'exception'], cardinality, MINUTES))
+
+        for name, func in queries(metrica):
+            result = {
+                'benchmark': 'query',
+                'case': name,
+                'params': {'events': events, 'cardinality': cardinality, 'minutes': MINUTES},
+            }
+            result.update(latency(func, repeat))
+            yield result
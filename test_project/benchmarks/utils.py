@@ -0,0 +1,94 @@
+import time
+import random
+import datetime
+from contextlib import contextmanager
+from collections import defaultdict
+
+from django.conf import settings
+
+from staste import redis
+
+
+class CountingPipeline(object):
+    """Looks like a Redis pipeline, but just counts commands"""
+
+    def __init__(self):
+        self.commands = defaultdict(int)
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            self.commands[command] += 1
+        return queue
+
+    def execute(self):
+        return []
+
+
+@contextmanager
+def benchmark_prefix():
+    """Metricas keep their keys under STASTE_METRICS_PREFIX + ':benchmark' meanwhile"""
+    old_prefix = settings.STASTE_METRICS_PREFIX
+    settings.STASTE_METRICS_PREFIX = u'%s:benchmark' % old_prefix
+
+    try:
+        yield
+    finally:
+        delete_keys()
+        settings.STASTE_METRICS_PREFIX = old_prefix
+
+
+def delete_keys():
+    pipe = redis.pipeline(transaction=False)
+    for key in redis.scan_iter(match=u'%s:*' % settings.STASTE_METRICS_PREFIX, count=1000):
+        pipe.delete(key)
+    pipe.execute()
+
+
+def commands_done():
+    """How many commands Redis has done so far, INFO is not counted"""
+    stats = redis.info('commandstats')
+    return sum(stat['calls'] for stat in stats.itervalues()) - stats.get('cmdstat_info', {}).get('calls', 0)
+
+
+def keys_memory(prefix):
+    """Bytes taken by keys of a prefix (all of them, hashes, sets, HyperLogLogs), see MEMORY USAGE"""
+    memory = 0
+    pipe = redis.pipeline(transaction=False)
+
+    for key in redis.scan_iter(match=u'%s:*' % prefix, count=1000):
+        pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0)
+        if len(pipe) == 1000:
+            memory += sum(pipe.execute())
+
+    return memory + sum(pipe.execute())
+
+
+def latency(func, repeat):
+    """Milliseconds func() takes: {'ms_min': 0.4, 'ms_median': 0.5, 'ms_p95': 0.9, 'commands': 3.0}"""
+    timings = []
+    commands = commands_done()
+
+    for n in xrange(repeat):
+        started = time.time()
+        func()
+        timings.append((time.time() - started) * 1000)
+
+    commands = float(commands_done() - commands) / repeat
+    timings.sort()
+    return {'ms_min': timings[0], 'ms_median': timings[len(timings) // 2],
+            'ms_p95': timings[min(int(len(timings) * 0.95), len(timings) - 1)], 'commands': commands}
+
+
+def random_events(count, axes, cardinality, minutes, seed=0):
+    """
+    Events for kick_many(): values of every axis are one of `cardinality`, dates are
+    within the last `minutes`
+    """
+    rnd = random.Random(seed)
+    now = datetime.datetime.now()
+
+    for n in xrange(count):
+        event = dict((axis_kw, u'%s%d' % (axis_kw, rnd.randrange(cardinality))) for axis_kw in axes)
+        event['date'] = now - datetime.timedelta(minutes=rnd.randrange(minutes))
+        event['value'] = rnd.randint(1, 100)
+        yield event